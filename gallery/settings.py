@@ -8,7 +8,7 @@ INTERNAL_IPS = ('127.0.0.1', )
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'utils.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'database.sqlite3')
     }
 }
@@ -95,6 +95,7 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'utils.middleware.ExceptionLoggingMiddleware',
+    'stream.middleware.ActionBufferMiddleware',
 )
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'public', 'media')
@@ -111,6 +112,53 @@ AUTH_CODE_ADMIN_GROUP = 'Admin Group'
 
 PHOTOS_PER_PAGE = 50
 
+# Thumbnails are generated in the background by the process_thumbnails
+# management command. Every size listed here is generated for each photo.
+THUMBNAIL_SIZES = ('200x200-fit', '800x600-thumb')
+# Number of processes used by process_thumbnails (None means one per CPU).
+THUMBNAIL_WORKERS = None
+
+# Size of the chunks browsers upload photos in. Each chunk is read in to
+# memory, so keep this to a few megabytes.
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+# Largest file, in bytes, that can be uploaded in chunks. Space for the whole
+# file is set aside on disk when its upload starts.
+MAX_UPLOAD_SIZE = 200 * 1024 * 1024
+
+# Uploaded files are hashed (SHA-256) while they stream in, so that copies of
+# photos that are already in the gallery can be found.
+FILE_UPLOAD_HANDLERS = (
+    'utils.filestorage.uploads.HashingMemoryFileUploadHandler',
+    'utils.filestorage.uploads.HashingTemporaryFileUploadHandler',
+)
+# Whether a photo that is a copy of an existing one uses the stored file and
+# thumbnails of that photo instead of storing them again.
+REUSE_DUPLICATE_FILES = True
+# Photos whose perceptual hashes differ in at most this many (of 64) bits are
+# listed as near duplicates. Bigger values find more, but are slower and
+# find more photos that merely look alike.
+NEAR_DUPLICATE_DISTANCE = 4
+
+# Path or name of jpegtran, which rotates JPEGs without decoding them. When
+# it isn't installed (or this is None), JPEGs are rotated by changing their
+# EXIF orientation.
+JPEGTRAN = 'jpegtran'
+
+# Number of seconds the photo IDs matching a search are cached for. Changes
+# to the photos expire them right away.
+SEARCH_CACHE_TIMEOUT = 60 * 60
+
+# Actions of a user that repeat their previous action (such as adding photos
+# to the same album) within this many seconds of it are merged in to it.
+STREAM_MERGE_WINDOW = 10 * 60
+
+# Lets the web server send downloaded photos instead of Django: None to send
+# them from Django, 'x-accel-redirect' for nginx or 'x-sendfile' for Apache
+# (mod_xsendfile) and lighttpd. For nginx, SENDFILE_URL is the internal
+# location that maps to MEDIA_ROOT.
+SENDFILE_BACKEND = None
+SENDFILE_URL = '/protected/media/'
+
 try:
     from .settings_local import *
 except ImportError:
@@ -81,11 +81,10 @@ $(function() {
             method: "POST",
             url: $(this).attr("href"),
             success: function(data){
-                // Simply reload the image (which will be rotated).
-                // Strip off the previous querystring from the image first.
-                img = $(".photo-main .photo img");
-                img.attr("src", img.attr("src").split("?")[0] + "?" +
-                    new Date().getTime());
+                // The rotated photo has new thumbnails with new URLs.
+                if (data.thumbnail) {
+                    $(".photo-main .photo img").attr("src", data.thumbnail);
+                }
             },
             error: function(data){
                 errorProcessing(data);
@@ -93,6 +92,40 @@ $(function() {
         });
     });
 
+    // Thumbnails that are still being generated are shown as placeholders.
+    // Poll for them every few seconds and swap them in once they are ready,
+    // or show a broken image for the ones that could not be generated.
+    function pollThumbnails() {
+        var pending = $("img[data-thumbnail]");
+        if (!pending.length) {
+            return;
+        }
+        var ids = pending.map(function() {
+            return $(this).data("thumbnail");
+        }).get();
+        $.ajax({
+            url: pending.data("thumbnail-status"),
+            data: {id: ids, size: pending.data("thumbnail-size")},
+            dataType: "json",
+            traditional: true,
+            success: function(data) {
+                $.each(data.ready, function(pk, url) {
+                    $("img[data-thumbnail=" + pk + "]")
+                        .attr("src", url)
+                        .removeAttr("data-thumbnail");
+                });
+                $.each(data.failed, function(index, pk) {
+                    var img = $("img[data-thumbnail=" + pk + "]");
+                    img.attr("src", img.data("thumbnail-broken"))
+                        .addClass("broken")
+                        .removeAttr("data-thumbnail");
+                });
+                setTimeout(pollThumbnails, 3000);
+            }
+        });
+    }
+    setTimeout(pollThumbnails, 3000);
+
     // Display the form when any modal form links are clicked.
     $("[data-modal='form']").click(function(event){
         event.preventDefault();
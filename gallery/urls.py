@@ -3,11 +3,13 @@ from django.conf.urls.static import static
 from django.contrib import admin
 from django.conf import settings
 
-from stream.views import action_list
+from stream.views import action_atom, action_json, action_list
 
 urlpatterns = patterns(
     '',
     url(r'^$', action_list, name='home'),
+    url(r'^activity\.json$', action_json, name='action_json'),
+    url(r'^activity\.atom$', action_atom, name='action_atom'),
     url(r'^auth/', include('accounts.urls', 'accounts')),
     url(r'^admin/', include(admin.site.urls)),
     url(r'^', include('photos.urls')),
@@ -2,6 +2,42 @@ import os
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gallery.settings')
 
-from django.core.wsgi import get_wsgi_application
+import django
+from django.core.handlers.wsgi import WSGIHandler
 
-application = get_wsgi_application()
+
+class ResponseFile:
+    """
+    Wraps the file of a response for wsgi.file_wrapper. Closing it closes the
+    response, so the request_finished signal is still sent.
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.file = response.file_to_stream
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def close(self):
+        self.response.close()
+
+
+class FileWrapperWSGIHandler(WSGIHandler):
+    """
+    Hands responses that send a whole file (see utils.sendfile) to the
+    server's wsgi.file_wrapper, which lets servers such as gunicorn send the
+    file with sendfile instead of reading it in Python.
+    """
+
+    def __call__(self, environ, start_response):
+        response = super().__call__(environ, start_response)
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if getattr(response, 'file_to_stream', None) is not None and \
+                file_wrapper is not None:
+            return file_wrapper(ResponseFile(response))
+        return response
+
+
+django.setup()
+application = FileWrapperWSGIHandler()
@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from photos.models import Person, Location, Album, Photo, Thumbnail
+from photos.models import Person, Location, Album, Photo, Thumbnail, \
+    ThumbnailJob, UploadSession
 
 
 class NameOnlyAdmin(admin.ModelAdmin):
@@ -21,7 +22,17 @@ class PhotoAdmin(admin.ModelAdmin):
     inlines = [ThumbnailInline, ]
 
 
+class ThumbnailJobAdmin(admin.ModelAdmin):
+    list_display = ['photo', 'created', 'started', 'attempts', ]
+
+
+class UploadSessionAdmin(admin.ModelAdmin):
+    list_display = ['filename', 'album', 'user', 'created', 'completed', ]
+
+
 admin.site.register(Person, NameOnlyAdmin)
 admin.site.register(Location, NameOnlyAdmin)
 admin.site.register(Album, AlbumAdmin)
 admin.site.register(Photo, PhotoAdmin)
+admin.site.register(ThumbnailJob, ThumbnailJobAdmin)
+admin.site.register(UploadSession, UploadSessionAdmin)
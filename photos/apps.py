@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class PhotosConfig(AppConfig):
+    name = 'photos'
+
+    def ready(self):
+        # Keep the search index in sync with the photos.
+        from photos.search import connect_signals
+        connect_signals()
@@ -0,0 +1,84 @@
+import os
+import zipfile
+
+from django.core.files import File
+
+from photos.duplicates import create_photo
+from photos.models import ThumbnailJob, update_photo_counts
+from photos.utils import file_allowed, friendly_filename, split_extension
+from utils.filestorage.uploads import file_sha256
+
+# Number of photos whose thumbnail jobs and counts are saved at once, so the
+# thumbnail workers can start on an archive while it is still being imported.
+BATCH_SIZE = 50
+
+
+def is_zip(filename):
+    return split_extension(filename)[1] == 'zip'
+
+
+def get_photo_members(archive):
+    """
+    Returns the members of a zip archive that are photos: files (not folders)
+    that are allowed by file_allowed, leaving out nested archives and the
+    hidden files some archivers add (such as __MACOSX/._photo.jpg).
+    """
+    members = []
+    for info in archive.infolist():
+        name = info.filename.replace('\\', '/')
+        if name.endswith('/') or not file_allowed(name) or is_zip(name):
+            continue
+        if any(part.startswith(('.', '__MACOSX')) for part in name.split('/')):
+            continue
+        members.append(info)
+    return members
+
+
+def import_zip(album, file_handle, progress=None):
+    """
+    Adds the photos in a zip archive to an album and returns how many were
+    added. Each member is streamed from the archive straight to storage, so
+    nothing is extracted to a temporary folder and memory use doesn't depend
+    on the size of the archive. The thumbnails are queued in batches as the
+    photos are stored, so the process_thumbnails workers render them in
+    parallel with the import.
+    If given, progress is called after each photo with the number of photos
+    done, the total number of photos and the name of the member.
+    """
+    count = 0
+    pending = 0
+    jobs = []
+
+    def flush():
+        nonlocal pending
+        ThumbnailJob.objects.bulk_create(jobs)
+        update_photo_counts(
+            pending, albums=[album.pk], locations=[album.location_id])
+        del jobs[:]
+        pending = 0
+
+    with zipfile.ZipFile(file_handle) as archive:
+        members = get_photo_members(archive)
+        for info in members:
+            filename = os.path.basename(info.filename.replace('\\', '/'))
+            # Members can't seek, so the member is read once to be hashed
+            # and then again only if it has to be stored.
+            with archive.open(info) as member:
+                sha256 = file_sha256(member)
+            with archive.open(info) as member:
+                content = File(member, name=filename)
+                # Members can't report their size themselves.
+                content.size = info.file_size
+                photo, job = create_photo(
+                    album, friendly_filename(filename), content, sha256)
+            if job is not None:
+                jobs.append(job)
+            count += 1
+            pending += 1
+            if pending >= BATCH_SIZE:
+                flush()
+            if progress:
+                progress(count, len(members), info.filename)
+    if pending:
+        flush()
+    return count
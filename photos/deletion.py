@@ -0,0 +1,80 @@
+"""
+Bulk deletion of albums and locations. Deleting an album one model instance
+at a time sends signals and deletes files for each of its photos and
+thumbnails, which is tens of thousands of queries and unlinks for a big
+album. Here the rows are deleted with a fixed number of set-based queries,
+however many photos there are, and the files are only recorded as
+DeletedFiles. The reap_files management command unlinks them afterwards.
+"""
+from django.db import transaction
+
+from photos.models import Album, DeletedFile, Location, Person, Photo, \
+    Thumbnail, ThumbnailJob, UploadChunk, UploadSession
+from photos.search import index_photos, unindex_photos
+from stream.utils import delete_actions
+from utils.db import insert_from_select, raw_delete
+
+
+def bury_files(queryset, field='file'):
+    """
+    Records the files in the given field of the rows of queryset as
+    DeletedFiles, in a single query.
+    """
+    insert_from_select(DeletedFile, ['name'], queryset.exclude(
+        **{field: ''}).order_by().values_list(field).distinct())
+
+
+def delete_albums(album_ids):
+    """
+    Deletes albums along with their photos, thumbnails and upload sessions,
+    and updates the photo counts of the people and locations they touched.
+    """
+    album_ids = [int(pk) for pk in album_ids]
+    albums = Album.objects.filter(pk__in=album_ids)
+    photos = Photo.objects.filter(album__in=album_ids)
+    sessions = UploadSession.objects.filter(album__in=album_ids)
+    with transaction.atomic():
+        photo_ids = list(photos.values_list('id', flat=True))
+        people = set(Photo.people.through.objects.filter(
+            photo__in=photos).values_list('person', flat=True))
+        locations = set(albums.exclude(location=None).values_list(
+            'location', flat=True))
+
+        bury_files(Thumbnail.objects.filter(photo__in=photos))
+        bury_files(photos)
+        bury_files(sessions.filter(completed__isnull=True))
+
+        delete_actions(Photo, photo_ids)
+        delete_actions(Album, album_ids)
+        unindex_photos(photos)
+        UploadSession.objects.filter(photo__in=photos).update(photo=None)
+        for model in (Person, Location):
+            model.objects.filter(cover_photo__in=photos).update(
+                cover_photo=None)
+        raw_delete(UploadChunk.objects.filter(session__in=sessions))
+        raw_delete(sessions)
+        for model in (Thumbnail, ThumbnailJob, Photo.people.through):
+            raw_delete(model.objects.filter(photo__in=photos))
+        albums.update(cover_photo=None)
+        raw_delete(photos)
+        raw_delete(albums)
+
+        for model, pks in ((Person, people), (Location, locations)):
+            for instance in model.objects.filter(pk__in=pks):
+                instance.recount()
+
+
+def delete_locations(location_ids):
+    """
+    Deletes locations, leaving their albums without a location.
+    """
+    location_ids = [int(pk) for pk in location_ids]
+    albums = Album.objects.filter(location__in=location_ids)
+    with transaction.atomic():
+        photo_ids = list(Photo.objects.filter(
+            album__in=albums).values_list('id', flat=True))
+        albums.update(location=None)
+        delete_actions(Location, location_ids)
+        raw_delete(Location.objects.filter(pk__in=location_ids))
+        # The location is part of the search documents of the photos.
+        index_photos(photo_ids)
@@ -0,0 +1,193 @@
+"""
+Photos that are uploaded more than once. Every photo stores the SHA-256
+digest of its file, so a copy of a photo that is already in the gallery is
+found with a single indexed lookup. When REUSE_DUPLICATE_FILES is set, the
+copy uses the stored file and the thumbnails of the original instead of
+storing and rendering them again. Shared files are only deleted once no
+photo or thumbnail uses them anymore (see utils.filestorage.signals).
+
+Photos that were resized or re-encoded have a different digest, so the
+thumbnail worker also stores the perceptual hash (dHash) of every photo.
+Near duplicates are photos whose hashes differ in only a few bits, and are
+found with a multi-index hash table: the hashes are split in to one more
+band than the number of bits they may differ in, so two near duplicates
+always have at least one band in common and only the photos that share a
+band are compared.
+"""
+from collections import defaultdict
+
+from django.conf import settings
+
+from photos.models import Photo, Thumbnail, ThumbnailJob
+from photos.utils import EXIF_FIELDS, read_exif
+from utils.filestorage.signals import file_is_shared
+from utils.filestorage.uploads import file_sha256, get_unique_upload_path
+
+HASH_BITS = 64
+HASH_MASK = (1 << HASH_BITS) - 1
+
+
+def get_storage():
+    return Photo._meta.get_field('file').storage
+
+
+def find_duplicate(sha256):
+    """
+    Returns the first photo whose file has the given digest, or None.
+    """
+    if not sha256:
+        return None
+    return Photo.objects.filter(sha256=sha256).order_by('pk').only(
+        'id', 'file', 'dhash', *EXIF_FIELDS).first()
+
+
+def copy_thumbnails(original, photo):
+    """
+    Gives photo the thumbnail files of original. Returns whether those were
+    all the configured sizes, otherwise the thumbnails still have to be
+    rendered.
+    """
+    thumbnails = [
+        Thumbnail(photo=photo, size=thumbnail.size, file=thumbnail.file.name)
+        for thumbnail in original.thumbnail_set.all()]
+    Thumbnail.objects.bulk_create(thumbnails)
+    sizes = set(thumbnail.size for thumbnail in thumbnails)
+    return sizes.issuperset(settings.THUMBNAIL_SIZES)
+
+
+def create_photo(album, name, content, sha256=None):
+    """
+    Creates a photo in the album and returns it along with the ThumbnailJob
+    to queue for it, which is None when the thumbnails of an identical photo
+    were reused. The caller saves the jobs and updates the photo counts so
+    that they can be done in bulk.
+    The content is either an uploaded file, which is hashed while it
+    streams in (see utils.filestorage.uploads), or the name of a file that is
+    already in storage. A stored file that turns out to be a copy is deleted.
+    The EXIF data is read from the header of the stored file.
+    """
+    storage = get_storage()
+    if isinstance(content, str):
+        if sha256 is None:
+            with storage.open(content) as file_handle:
+                sha256 = file_sha256(file_handle)
+    elif sha256 is None:
+        sha256 = getattr(content, 'sha256', None) or file_sha256(content)
+
+    original = None
+    if settings.REUSE_DUPLICATE_FILES:
+        original = find_duplicate(sha256)
+    photo = Photo(album=album, name=name, sha256=sha256)
+    if original is not None:
+        if isinstance(content, str) and content != original.file.name:
+            storage.delete(content)
+        # A copy has the same file, perceptual hash and EXIF data.
+        photo.file = original.file.name
+        for field in ('dhash', ) + EXIF_FIELDS:
+            setattr(photo, field, getattr(original, field))
+    else:
+        if isinstance(content, str):
+            photo.file = content
+        else:
+            # Store the file first, so the EXIF data can be read from it and
+            # saved along with the photo.
+            photo.file.save(content.name, content, save=False)
+        for field, value in read_exif(photo.file.path).items():
+            setattr(photo, field, value)
+    photo.save()
+    if original is not None and copy_thumbnails(original, photo):
+        return photo, None
+    return photo, ThumbnailJob(photo=photo)
+
+
+def unshare_file(photo):
+    """
+    Gives a photo its own copy of a file that it shares with other photos,
+    so the file can be changed (such as rotated) without changing them. The
+    photo loses its thumbnails, which the caller has to render again.
+    Returns whether the file was shared.
+    """
+    field = Photo._meta.get_field('file')
+    if not file_is_shared(photo, field, photo.file.name):
+        return False
+    storage = get_storage()
+    with storage.open(photo.file.name) as file_handle:
+        name = storage.save(
+            get_unique_upload_path(photo, photo.file.name), file_handle)
+    Photo.objects.filter(pk=photo.pk).update(file=name)
+    photo.file = name
+    # The thumbnail files are still used by the other photos, so only the
+    # rows are deleted.
+    photo.thumbnail_set.all().delete()
+    return True
+
+
+def get_band_masks(distance):
+    """
+    Returns the bit masks that split a 64 bit hash in to distance + 1 bands
+    of (nearly) equal width.
+    """
+    count = distance + 1
+    bounds = [HASH_BITS * band // count for band in range(count + 1)]
+    return [((1 << (end - start)) - 1) << start
+            for start, end in zip(bounds, bounds[1:])]
+
+
+def find_clusters(hashes, distance=None):
+    """
+    Groups photos whose perceptual hashes differ in at most distance bits
+    (by default NEAR_DUPLICATE_DISTANCE) and returns the groups with more
+    than one photo, as lists of photo IDs. Pass (photo ID, hash) pairs.
+    Photos are linked transitively, so a group can hold photos that are
+    further apart through the photos in between.
+    """
+    if distance is None:
+        distance = settings.NEAR_DUPLICATE_DISTANCE
+    masks = get_band_masks(distance)
+    tables = [defaultdict(list) for mask in masks]
+    # Photos with the same hash are only compared once.
+    photos = defaultdict(list)
+    parents = {}
+
+    def find(pk):
+        while parents[pk] != pk:
+            parents[pk] = parents[parents[pk]]
+            pk = parents[pk]
+        return pk
+
+    for pk, value in hashes:
+        value &= HASH_MASK
+        parents[pk] = pk
+        if value in photos:
+            parents[pk] = find(photos[value][0])
+            photos[value].append(pk)
+            continue
+        candidates = set()
+        for mask, table in zip(masks, tables):
+            bucket = table[value & mask]
+            candidates.update(bucket)
+            bucket.append(value)
+        for other in candidates:
+            if bin(value ^ other).count('1') <= distance:
+                parents[find(photos[other][0])] = find(pk)
+        photos[value].append(pk)
+
+    clusters = defaultdict(list)
+    for pk in parents:
+        clusters[find(pk)].append(pk)
+    return sorted(sorted(cluster) for cluster in clusters.values()
+                  if len(cluster) > 1)
+
+
+def find_near_duplicates(album=None, distance=None):
+    """
+    Returns the groups of near duplicate photos in an album, or in the whole
+    gallery, as lists of photo IDs (see find_clusters). Photos that haven't
+    been hashed by the thumbnail worker yet are left out.
+    """
+    photos = Photo.objects.filter(dhash__isnull=False)
+    if album is not None:
+        photos = photos.filter(album=album)
+    return find_clusters(
+        photos.order_by('pk').values_list('pk', 'dhash').iterator(),
+        distance)
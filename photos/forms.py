@@ -1,18 +1,96 @@
+import zipfile
+
 from django import forms
+from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 from django.forms.models import modelform_factory
 
-from photos.models import Album, Photo, Location, Person
+from photos.models import Album, Photo, Location, Person, ThumbnailJob, \
+    move_photo_counts, update_photo_counts
+from photos.archives import import_zip, is_zip
+from photos.duplicates import create_photo
+from photos.search import index_photos
 from photos.utils import file_allowed, friendly_filename
 
 
-AlbumForm = modelform_factory(
-    Album, fields=['name', 'month', 'year', 'location'])
 LocationRenameForm = modelform_factory(Location, fields=['name', ])
 PersonRenameForm = modelform_factory(Person, fields=['name', ])
-PhotoRenameForm = modelform_factory(Photo, fields=['name', ])
 PhotoTagForm = modelform_factory(Photo, fields=['people', ])
-PhotoMoveForm = modelform_factory(Photo, fields=['album', ])
+
+
+class AlbumForm(forms.ModelForm):
+    """
+    A form to create or edit an album. The counts of the old and the new
+    location are recalculated when the location of the album changes, and
+    the cover of its location is refreshed when it is renamed.
+    """
+
+    class Meta:
+        model = Album
+        fields = ['name', 'month', 'year', 'location']
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.old_location_id = self.instance.location_id
+        self.old_name = self.instance.name
+
+    def save(self, commit=True):
+        album = super().save(commit)
+        if album.location_id != self.old_location_id:
+            for location in Location.objects.filter(
+                    pk__in=[self.old_location_id, album.location_id]):
+                location.recount()
+        elif album.name != self.old_name:
+            # The cover of a location is the first photo of its first album
+            # by name.
+            update_photo_counts(0, locations=[album.location_id])
+        return album
+
+
+class PhotoRenameForm(forms.ModelForm):
+    """
+    A form to rename a photo. The covers are the first photos by name, so
+    the covers of its album, its location and the people tagged in it are
+    refreshed when the name changes.
+    """
+
+    class Meta:
+        model = Photo
+        fields = ['name', ]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.old_name = self.instance.name
+
+    def save(self, commit=True):
+        photo = super().save(commit)
+        if photo.name != self.old_name:
+            update_photo_counts(
+                0, albums=[photo.album_id],
+                locations=[photo.album.location_id],
+                people=photo.people.values_list('pk', flat=True))
+        return photo
+
+
+class PhotoMoveForm(forms.ModelForm):
+    """
+    A form to move a photo to another album, which also moves it between the
+    photo counts of the albums and their locations.
+    """
+
+    class Meta:
+        model = Photo
+        fields = ['album', ]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.old_album = self.instance.album
+
+    def save(self, commit=True):
+        photo = super().save(commit)
+        if photo.album_id != self.old_album.pk:
+            move_photo_counts(1, self.old_album, photo.album)
+        return photo
 
 
 class AlbumMergeForm(forms.Form):
@@ -35,7 +113,12 @@ class AlbumMergeForm(forms.Form):
         """
         # Move all the photos from this album to the new album
         new_album = self.cleaned_data['new_album']
-        self.instance.photo_set.all().update(album=new_album)
+        photo_ids = list(self.instance.photo_set.values_list('pk', flat=True))
+        count = self.instance.photo_set.all().update(album=new_album)
+        # A bulk update sends no signals, so update the counts and the search
+        # index ourselves
+        move_photo_counts(count, self.instance, new_album)
+        index_photos(photo_ids)
         # Delete this album
         self.instance.delete()
         # Return the new album
@@ -44,8 +127,8 @@ class AlbumMergeForm(forms.Form):
 
 class SearchForm(forms.Form):
     """
-    A form to search for photos. Can search by album, location, people, or a
-    custom query.
+    A form to search for photos. Can search by album, location, people,
+    camera, or a custom query, and sort by relevance or the date taken.
     """
 
     a = forms.ModelMultipleChoiceField(
@@ -54,7 +137,17 @@ class SearchForm(forms.Form):
         label=_('People'), queryset=Person.objects.all())
     l = forms.ModelMultipleChoiceField(
         label=_('Locations'), queryset=Location.objects.all())
+    c = forms.MultipleChoiceField(label=_('Cameras'))
     q = forms.CharField(label=_('Search'))
+    o = forms.ChoiceField(label=_('Sort by'), required=False, choices=(
+        ('', _('Best match')), ('taken', _('Date taken'))))
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The camera models come from the index on the column.
+        models = Photo.objects.filter(exif_model__isnull=False).order_by(
+            'exif_model').values_list('exif_model', flat=True).distinct()
+        self.fields['c'].choices = [(model, model) for model in models]
 
 
 class UploadForm(forms.Form):
@@ -81,26 +174,67 @@ class UploadForm(forms.Form):
         file_allowed function.
         """
         files_not_allowed = []
+        bad_archives = []
         for file_handle in self.files.getlist('photos'):
             if not file_allowed(file_handle.name):
                 files_not_allowed.append(file_handle.name)
+            elif is_zip(file_handle.name):
+                if not zipfile.is_zipfile(file_handle):
+                    bad_archives.append(file_handle.name)
+                file_handle.seek(0)
         if files_not_allowed:
             raise forms.ValidationError(
                 _('The following files are not allowed: %s')
                 % ', '.join(files_not_allowed))
+        if bad_archives:
+            raise forms.ValidationError(
+                _('The following files are not valid zip files: %s')
+                % ', '.join(bad_archives))
         return self.cleaned_data['photos']
 
     def save(self):
         """
-        Add each photo to the album (which must already be existing).
-        TODO: support for zip file uploading.
+        Add each photo to the album (which must already be existing). The
+        photos in zip files are added one by one (see import_zip). The
+        thumbnails are queued for the thumbnail worker rather than generated
+        here, so the upload returns as soon as the originals are stored.
         """
         self.instance = self.cleaned_data['album']
         self.photo_count = 0
+        # import_zip updates the counts of the photos in archives itself.
+        archive_count = 0
+        jobs = []
         for file_handle in self.files.getlist('photos'):
+            if is_zip(file_handle.name):
+                count = import_zip(self.instance, file_handle)
+                self.photo_count += count
+                archive_count += count
+                continue
             self.photo_count = self.photo_count + 1
             photo_name = friendly_filename(file_handle.name)
-            photo = Photo.objects.create(
-                album=self.instance, name=photo_name, file=file_handle)
-            photo.thumbnail('200x200-fit')
+            photo, job = create_photo(self.instance, photo_name, file_handle)
+            if job is not None:
+                jobs.append(job)
+        ThumbnailJob.objects.bulk_create(jobs)
+        update_photo_counts(
+            self.photo_count - archive_count, albums=[self.instance.pk],
+            locations=[self.instance.location_id])
         return self.instance
+
+
+class UploadSessionForm(forms.Form):
+    """
+    A form to start (or resume) uploading a file in chunks.
+    """
+
+    album = forms.ModelChoiceField(queryset=Album.objects.all())
+    filename = forms.CharField(max_length=200)
+    size = forms.IntegerField(min_value=1, max_value=settings.MAX_UPLOAD_SIZE)
+    key = forms.CharField(max_length=200)
+
+    def clean_filename(self):
+        filename = self.cleaned_data['filename']
+        if not file_allowed(filename):
+            raise forms.ValidationError(
+                _('The following files are not allowed: %s') % filename)
+        return filename
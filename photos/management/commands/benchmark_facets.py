@@ -0,0 +1,91 @@
+import random
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from photos.models import Album, Location, Person, Photo
+from photos.search import bump_version, get_facets, get_result_ids, \
+    index_photos
+
+WORDS = ('beach lake mountain sunset party birthday dog cat garden snow '
+         'city river forest wedding').split()
+
+
+class Rollback(Exception):
+    """Raised to roll back the temporary benchmark photos."""
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--query', action='append', dest='queries',
+                    help='A search query string (such as "q=beach&l=1") to '
+                         'benchmark on the existing photos. Can be given '
+                         'more than once. By default temporary photos are '
+                         'created and rolled back.'),
+        make_option('--photos', action='store', type='int', dest='photos',
+                    default=100000,
+                    help='Number of temporary photos.'),
+        make_option('--repeat', action='store', type='int', dest='repeat',
+                    default=5, help='Number of times each query is run.'),
+    )
+    help = ('Measures computing the facet counts (get_facets) of search '
+            'results, with and without the cache.')
+
+    def handle_noargs(self, **options):
+        try:
+            with transaction.atomic():
+                queries = options.get('queries')
+                if not queries:
+                    queries = self.create_photos(options.get('photos'))
+                for query in queries:
+                    self.benchmark(query, options.get('repeat'))
+                if not options.get('queries'):
+                    raise Rollback
+        except Rollback:
+            pass
+
+    def create_photos(self, count):
+        """
+        Creates photos with random names in random albums, locations and
+        years and tags them with random people, then returns queries with
+        large and small result sets.
+        """
+        random.seed(0)
+        locations = [Location.objects.create(name='Location %s' % index)
+                     for index in range(50)]
+        albums = [Album.objects.create(
+            name='Album %s' % index, location=random.choice(locations),
+            year=random.randint(1990, 2014)) for index in range(1000)]
+        people = [Person.objects.create(name='Person %s' % index)
+                  for index in range(200)]
+        start_pk = (Photo.objects.order_by('-pk').values_list(
+            'pk', flat=True).first() or 0) + 1
+        Photo.objects.bulk_create([
+            Photo(album=random.choice(albums), file='photos/benchmark.jpg',
+                  name='%s %s' % (random.choice(WORDS), random.choice(WORDS)))
+            for index in range(count)], batch_size=400)
+        photo_ids = list(Photo.objects.filter(pk__gte=start_pk).values_list(
+            'pk', flat=True))
+        Photo.people.through.objects.bulk_create([
+            Photo.people.through(photo_id=pk, person=person)
+            for pk in photo_ids for person in random.sample(
+                people, random.randint(0, 2))], batch_size=400)
+        index_photos(photo_ids)
+        return ['q=sunset', 'q=sunset+dog', 'l=%s' % locations[0].pk,
+                'p=%s&p=%s' % (people[0].pk, people[1].pk)]
+
+    def benchmark(self, query, repeat):
+        count = len(get_result_ids(query))
+        start = time.time()
+        for i in range(repeat):
+            bump_version()
+            get_facets(query)
+        uncached = (time.time() - start) / repeat
+        start = time.time()
+        for i in range(repeat):
+            get_facets(query)
+        cached = (time.time() - start) / repeat
+        self.stdout.write('%-20s %7s results %8.2fms %8.2fms cached' % (
+            query, count, uncached * 1000, cached * 1000))
@@ -0,0 +1,94 @@
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import transaction
+from django.test.client import RequestFactory
+
+from photos.models import Album, Photo
+from utils.paginate import encode_cursor, keyset_paginate, paginate
+
+
+class Rollback(Exception):
+    """Raised to roll back the temporary benchmark photos."""
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--album', action='store', type='int', dest='album',
+                    help='Benchmark the photos of this album. By default a '
+                         'temporary album is created and rolled back.'),
+        make_option('--photos', action='store', type='int', dest='photos',
+                    default=20000,
+                    help='Number of photos in the temporary album.'),
+        make_option('--page', action='store', type='int', dest='page',
+                    default=200, help='The deep page to compare with page 1.'),
+        make_option('--repeat', action='store', type='int', dest='repeat',
+                    default=20, help='Number of times each page is fetched.'),
+    )
+    help = ('Compares fetching the first and a deep page of an album with '
+            'offset pagination (paginate) and keyset pagination '
+            '(keyset_paginate).')
+
+    def handle_noargs(self, **options):
+        try:
+            with transaction.atomic():
+                if options.get('album'):
+                    album = Album.objects.get(pk=options.get('album'))
+                else:
+                    album = self.create_album(options.get('photos'))
+                self.benchmark(album, options.get('page'),
+                               options.get('repeat'))
+                if not options.get('album'):
+                    raise Rollback
+        except Rollback:
+            pass
+        except Album.DoesNotExist:
+            raise CommandError('The album does not exist.')
+
+    def create_album(self, count):
+        album = Album.objects.create(name='Benchmark')
+        Photo.objects.bulk_create([
+            Photo(album=album, name='Photo %06d' % index,
+                  file='photos/benchmark.jpg')
+            for index in range(count)], batch_size=500)
+        return album
+
+    def benchmark(self, album, page, repeat):
+        page_size = settings.PHOTOS_PER_PAGE
+        queryset = album.photo_set.all()
+        count = queryset.count()
+        if (page - 1) * page_size >= count:
+            raise CommandError('The album only has %s photos, which is not '
+                               'enough for page %s.' % (count, page))
+        factory = RequestFactory()
+
+        # The cursor for the deep page is the key of the last photo of the
+        # page before it, just like the "next" link of that page.
+        last = queryset.order_by('name', 'id')[(page - 1) * page_size - 1]
+        cursor = encode_cursor(
+            '>', (page - 1) * page_size + 1, [last.name, last.pk])
+
+        def offset_page(number):
+            request = factory.get('/', {'p': number})
+            paginator, object_list = paginate(request, queryset, page_size)
+            return paginator.count, list(object_list)
+
+        def keyset_page(cursor):
+            request = factory.get('/', {'c': cursor} if cursor else {})
+            paginator, object_list = keyset_paginate(
+                request, queryset, page_size, count=count)
+            return paginator.count, object_list
+
+        self.stdout.write('%s photos, %s per page' % (count, page_size))
+        for label, function, argument in (
+                ('offset page 1', offset_page, 1),
+                ('offset page %s' % page, offset_page, page),
+                ('keyset page 1', keyset_page, None),
+                ('keyset page %s' % page, keyset_page, cursor)):
+            start = time.time()
+            for i in range(repeat):
+                function(argument)
+            elapsed = (time.time() - start) / repeat
+            self.stdout.write('%-20s %8.2fms' % (label, elapsed * 1000))
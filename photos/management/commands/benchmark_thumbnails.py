@@ -0,0 +1,67 @@
+import io
+import multiprocessing
+import resource
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from photos.models import Photo
+from photos.utils import render_images
+
+
+def measure(task):
+    """
+    Render and encode every configured thumbnail size for one photo and
+    return the elapsed seconds and the peak RSS in kilobytes. This runs in a
+    fresh process for every measurement so the peak RSS belongs to that
+    photo alone.
+    """
+    path, draft = task
+    start = time.time()
+    for pimage in render_images(path, draft=draft).values():
+        pimage.save(io.BytesIO(), 'JPEG')
+    elapsed = time.time() - start
+    return elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Command(BaseCommand):
+    args = '<path path ...>'
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', action='store', type='int', dest='limit',
+                    default=10,
+                    help='Number of photos to benchmark when no paths are '
+                         'given.'),
+    )
+    help = ('Compares the time and peak memory of rendering thumbnails with '
+            'a full decode (before) and with reduced-resolution decoding '
+            '(after). Uses the given image files, or the most recent photos.')
+
+    def handle(self, *args, **options):
+        paths = list(args)
+        if not paths:
+            photos = Photo.objects.order_by('-pk')[:options.get('limit')]
+            paths = [photo.file.path for photo in photos]
+        if not paths:
+            raise CommandError('There are no photos to benchmark.')
+
+        self.stdout.write('%-40s %10s %10s %12s %12s' % (
+            'photo', 'before', 'after', 'before RSS', 'after RSS'))
+        totals = [0, 0]
+        for path in paths:
+            before = self.run(path, False)
+            after = self.run(path, True)
+            totals[0] += before[0]
+            totals[1] += after[0]
+            self.stdout.write('%-40s %9.3fs %9.3fs %10dKB %10dKB' % (
+                path[-40:], before[0], after[0], before[1], after[1]))
+        self.stdout.write('%-40s %9.3fs %9.3fs' % (
+            'average', totals[0] / len(paths), totals[1] / len(paths)))
+
+    def run(self, path, draft):
+        pool = multiprocessing.Pool(1, maxtasksperchild=1)
+        try:
+            return pool.apply(measure, [(path, draft)])
+        finally:
+            pool.close()
+            pool.join()
@@ -0,0 +1,30 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.utils import timezone
+
+from photos.models import UploadSession
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--hours', action='store', type='int', dest='hours',
+                    default=24,
+                    help='Age in hours after which an unfinished upload is '
+                         'abandoned.'),
+    )
+    help = ('Deletes chunked uploads that were never finished along with '
+            'their partial files, and forgets the chunks of finished ones.')
+
+    def handle_noargs(self, **options):
+        cutoff = timezone.now() - datetime.timedelta(hours=options['hours'])
+        sessions = UploadSession.objects.filter(created__lt=cutoff)
+        abandoned = 0
+        # Deleted one by one so the partial files are deleted too.
+        for session in sessions.filter(completed__isnull=True).iterator():
+            session.delete()
+            abandoned += 1
+        sessions.delete()
+        if int(options.get('verbosity')) > 0:
+            self.stdout.write('Deleted %s abandoned uploads.' % abandoned)
@@ -0,0 +1,74 @@
+import multiprocessing
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+
+from photos.models import Photo
+from photos.utils import EXIF_FIELDS, read_exif
+
+
+def read_job(job):
+    """
+    Read the EXIF data of a single photo. This runs inside the worker
+    processes so it only touches the filesystem, never the database. Fields
+    that the file has no value for are cleared.
+    """
+    photo_pk, path = job
+    values = dict.fromkeys(EXIF_FIELDS)
+    values.update(read_exif(path))
+    return photo_pk, values
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', action='store', type='int', dest='workers',
+                    default=None,
+                    help='Number of worker processes. Defaults to one per '
+                         'CPU; use 1 to read the files in this process.'),
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=500,
+                    help='Number of photos read and saved at a time.'),
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help='Read the EXIF data of every photo again, not only '
+                         'of the photos that were never read.'),
+    )
+    help = ('Reads the EXIF data (date taken, camera, exposure, GPS...) of '
+            'the photos that were added before it was read at upload.')
+
+    def handle_noargs(self, **options):
+        workers = options.get('workers') or multiprocessing.cpu_count()
+        pool = None
+        if workers > 1:
+            # The worker processes never use the database, so make sure they
+            # don't inherit our connection.
+            connection.close()
+            pool = multiprocessing.Pool(workers)
+        photos = Photo.objects.order_by('pk')
+        if not options.get('all'):
+            photos = photos.filter(exif_orientation__isnull=True)
+        count = 0
+        last_pk = 0
+        try:
+            while True:
+                batch = list(photos.filter(pk__gt=last_pk).values_list(
+                    'pk', 'file')[:options.get('batch_size')])
+                if not batch:
+                    break
+                last_pk = batch[-1][0]
+                storage = Photo._meta.get_field('file').storage
+                jobs = [(pk, storage.path(name)) for pk, name in batch]
+                results = pool.imap_unordered(read_job, jobs, 16) if pool \
+                    else map(read_job, jobs)
+                with transaction.atomic():
+                    for photo_pk, values in results:
+                        Photo.objects.filter(pk=photo_pk).update(**values)
+                count += len(batch)
+                if int(options.get('verbosity')) > 1:
+                    self.stdout.write('Read %s photos.' % count)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        if int(options.get('verbosity')) > 0:
+            self.stdout.write('Read the EXIF data of %s photos.' % count)
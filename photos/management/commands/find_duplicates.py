@@ -0,0 +1,40 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import CommandError, NoArgsCommand
+
+from photos.duplicates import find_near_duplicates
+from photos.models import Album, Photo
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--album', action='store', type='int', dest='album',
+                    default=None,
+                    help='Only look for duplicates in this album (by ID).'),
+        make_option('--distance', action='store', type='int',
+                    dest='distance',
+                    default=settings.NEAR_DUPLICATE_DISTANCE,
+                    help='Number of bits in which the perceptual hashes of '
+                         'near duplicates may differ.'),
+    )
+    help = ('Lists the groups of near duplicate photos, such as resized or '
+            're-encoded copies, in an album or in the whole gallery.')
+
+    def handle_noargs(self, **options):
+        album = None
+        if options.get('album'):
+            try:
+                album = Album.objects.get(pk=options['album'])
+            except Album.DoesNotExist:
+                raise CommandError('Album %s does not exist.'
+                                   % options['album'])
+        clusters = find_near_duplicates(album, options.get('distance'))
+        for cluster in clusters:
+            photos = Photo.objects.in_bulk(cluster)
+            self.stdout.write(', '.join(
+                '%s (%s)' % (photos[pk].name, pk)
+                for pk in cluster if pk in photos))
+        if int(options.get('verbosity')) > 0:
+            self.stdout.write('Found %s groups of near duplicates.'
+                              % len(clusters))
@@ -0,0 +1,65 @@
+import logging
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from django.db.models import Q
+
+from photos.models import Photo
+from photos.utils import image_dhash
+from utils.filestorage.uploads import file_sha256
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=100,
+                    help='Number of photos hashed per transaction.'),
+    )
+    help = ('Computes the SHA-256 digest and the perceptual hash of the '
+            'photos that were added before photos were hashed, so their '
+            'copies and near duplicates can be found.')
+
+    def handle_noargs(self, **options):
+        batch_size = options.get('batch_size')
+        count = 0
+        failed = 0
+        missing = Q(sha256__isnull=True) | Q(dhash__isnull=True)
+        last_pk = 0
+        while True:
+            photos = list(Photo.objects.filter(
+                missing, pk__gt=last_pk).order_by('pk').only(
+                'id', 'file', 'sha256', 'dhash')[:batch_size])
+            if not photos:
+                break
+            with transaction.atomic():
+                for photo in photos:
+                    try:
+                        hashes = self.get_hashes(photo)
+                    except (IOError, OSError) as e:
+                        # The photo keeps its NULL hashes, and the batches
+                        # move on past it by ID, so it is only retried by
+                        # the next run.
+                        logging.error('Hashing photo %s failed: %s',
+                                      photo.pk, e)
+                        failed += 1
+                        continue
+                    Photo.objects.filter(pk=photo.pk).update(**hashes)
+                    count += 1
+            last_pk = photos[-1].pk
+        if int(options.get('verbosity')) > 0:
+            self.stdout.write('Hashed %s photos, %s failed.' % (
+                count, failed))
+
+    def get_hashes(self, photo):
+        """
+        Returns the hashes that the photo is missing. Raises IOError or
+        OSError when its file is missing or can't be decoded.
+        """
+        hashes = {}
+        if photo.sha256 is None:
+            with photo.file.storage.open(photo.file.name) as file_handle:
+                hashes['sha256'] = file_sha256(file_handle)
+        if photo.dhash is None:
+            hashes['dhash'] = image_dhash(photo.file.path)
+        return hashes
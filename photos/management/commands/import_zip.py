@@ -0,0 +1,35 @@
+import zipfile
+
+from django.core.management.base import BaseCommand, CommandError
+
+from photos.archives import import_zip
+from photos.models import Album
+
+
+class Command(BaseCommand):
+    args = '<album_id> <zip_file>'
+    help = ('Adds the photos in a zip archive to an album without extracting '
+            'it. Run process_thumbnails to generate the thumbnails.')
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('Usage: import_zip %s' % self.args)
+        try:
+            album = Album.objects.get(pk=args[0])
+        except (Album.DoesNotExist, ValueError):
+            raise CommandError('The album does not exist.')
+        verbosity = int(options.get('verbosity'))
+
+        def progress(done, total, name):
+            if verbosity > 1:
+                self.stdout.write('[%s/%s] %s' % (done, total, name))
+            elif verbosity > 0 and (done % 100 == 0 or done == total):
+                self.stdout.write('Imported %s of %s photos.' % (done, total))
+
+        try:
+            with open(args[1], 'rb') as file_handle:
+                count = import_zip(album, file_handle, progress)
+        except (IOError, zipfile.BadZipFile) as e:
+            raise CommandError('Unable to read %s: %s' % (args[1], e))
+        if verbosity > 0:
+            self.stdout.write('Added %s photos to "%s".' % (count, album))
@@ -0,0 +1,127 @@
+import datetime
+import logging
+import multiprocessing
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from photos.models import MAX_THUMBNAIL_ATTEMPTS, Photo, Thumbnail, \
+    ThumbnailJob
+from photos.utils import render_photo
+
+# A job that was started this long ago without finishing is assumed to belong
+# to a worker that died, and is handed out again.
+STALE_AFTER = datetime.timedelta(minutes=10)
+
+
+def render_job(job):
+    """
+    Generate every configured thumbnail size and the perceptual hash for a
+    single job. This runs inside the worker processes so it only touches the
+    filesystem, never the database. Returns the photo id along with either
+    the generated paths and the hash or the error message.
+    """
+    photo_pk, file_name, version = job
+    photo = Photo(pk=photo_pk, file=file_name)
+    try:
+        return photo_pk, render_photo(photo.file, version), None
+    except Exception as e:
+        return photo_pk, None, str(e)
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', action='store', type='int', dest='workers',
+                    default=settings.THUMBNAIL_WORKERS,
+                    help='Number of worker processes. Defaults to one per '
+                         'CPU; use 1 to process jobs in this process.'),
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=50,
+                    help='Number of jobs claimed from the queue at a time.'),
+        make_option('--interval', action='store', type='float',
+                    dest='interval', default=5,
+                    help='Seconds to wait before checking an empty queue '
+                         'again.'),
+        make_option('--once', action='store_true', dest='once',
+                    default=False,
+                    help='Exit once the queue is empty instead of waiting '
+                         'for new jobs.'),
+    )
+    help = 'Generates the thumbnails queued by uploads and page views.'
+
+    def handle_noargs(self, **options):
+        self.verbosity = int(options.get('verbosity'))
+        workers = options.get('workers') or multiprocessing.cpu_count()
+        pool = None
+        if workers > 1:
+            # The worker processes never use the database, so make sure they
+            # don't inherit our connection.
+            connection.close()
+            pool = multiprocessing.Pool(workers)
+        try:
+            while True:
+                jobs = self.claim_jobs(options.get('batch_size'))
+                if jobs:
+                    self.process_jobs(jobs, pool)
+                elif options.get('once'):
+                    break
+                else:
+                    time.sleep(options.get('interval'))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def claim_jobs(self, batch_size):
+        """
+        Mark a batch of queued jobs as started and return them. Jobs that
+        another worker claimed in the meantime are skipped.
+        """
+        now = timezone.now()
+        available = Q(started__isnull=True) | Q(started__lt=now - STALE_AFTER)
+        queryset = ThumbnailJob.objects.filter(
+            available, attempts__lt=MAX_THUMBNAIL_ATTEMPTS)
+        job_ids = list(queryset.values_list('id', flat=True)[:batch_size])
+        if not job_ids:
+            return []
+        queryset.filter(id__in=job_ids).update(started=now)
+        return list(ThumbnailJob.objects.filter(
+            id__in=job_ids, started=now).select_related('photo'))
+
+    def process_jobs(self, jobs, pool):
+        """
+        Render the thumbnails for the given jobs (in parallel when there is a
+        pool) and record the results.
+        """
+        jobs_by_photo = dict((job.photo_id, job) for job in jobs)
+        tasks = [(job.photo_id, job.photo.file.name, job.photo.version)
+                 for job in jobs]
+        results = pool.imap_unordered(render_job, tasks) if pool else \
+            map(render_job, tasks)
+        for photo_pk, result, error in results:
+            job = jobs_by_photo[photo_pk]
+            if error:
+                logging.error('Thumbnails for photo %s failed: %s',
+                              photo_pk, error)
+                ThumbnailJob.objects.filter(pk=job.pk).update(
+                    started=None, attempts=job.attempts + 1)
+                continue
+            with transaction.atomic():
+                # The job is deleted along with its photo, so if it is gone
+                # there is nothing left to attach the thumbnails to.
+                if not ThumbnailJob.objects.filter(pk=job.pk).exists():
+                    continue
+                paths, dhash = result
+                for size, path in paths.items():
+                    Thumbnail.objects.update_or_create(
+                        photo=job.photo, size=size, defaults={'file': path})
+                Photo.objects.filter(pk=photo_pk).update(dhash=dhash)
+                job.delete()
+            if self.verbosity > 1:
+                self.stdout.write('Generated thumbnails for photo %s.'
+                                  % photo_pk)
@@ -0,0 +1,58 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from photos.models import DeletedFile, Photo, Thumbnail
+from utils.db import raw_delete
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=500,
+                    help='Number of files unlinked at a time.'),
+        make_option('--interval', action='store', type='float',
+                    dest='interval', default=60,
+                    help='Seconds to wait before checking for deleted files '
+                         'again.'),
+        make_option('--once', action='store_true', dest='once',
+                    default=False,
+                    help='Exit once every deleted file is unlinked instead '
+                         'of waiting for more.'),
+    )
+    help = ('Unlinks the files of albums that were deleted in bulk, unless '
+            'a photo or thumbnail still uses them.')
+
+    def handle_noargs(self, **options):
+        self.verbosity = int(options.get('verbosity'))
+        while True:
+            if not self.reap(options.get('batch_size')):
+                if options.get('once'):
+                    break
+                time.sleep(options.get('interval'))
+
+    def reap(self, batch_size):
+        """
+        Unlinks a batch of deleted files and returns how many there were.
+        A file can still be used by a duplicate photo in another album (see
+        photos.duplicates), so those are only forgotten.
+        """
+        deleted = list(DeletedFile.objects.values_list(
+            'id', 'name')[:batch_size])
+        if not deleted:
+            return 0
+        names = set(name for pk, name in deleted)
+        used = set(Photo.objects.filter(file__in=names).values_list(
+            'file', flat=True))
+        used.update(Thumbnail.objects.filter(file__in=names).values_list(
+            'file', flat=True))
+        # Thumbnails and uploads are kept in the same storage as photos.
+        storage = Photo._meta.get_field('file').storage
+        for name in names - used:
+            storage.delete(name)
+        raw_delete(DeletedFile.objects.filter(
+            pk__in=[pk for pk, name in deleted]))
+        if self.verbosity > 1:
+            self.stdout.write('Unlinked %s files.' % len(names - used))
+        return len(deleted)
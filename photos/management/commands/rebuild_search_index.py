@@ -0,0 +1,16 @@
+from django.core.management.base import NoArgsCommand
+
+from photos.models import Photo
+from photos.search import rebuild_index, use_fts
+
+
+class Command(NoArgsCommand):
+    help = ('Rebuilds the search documents of every photo in case the search '
+            'index has drifted.')
+
+    def handle_noargs(self, **options):
+        rebuild_index()
+        if int(options.get('verbosity')) > 0:
+            self.stdout.write('Indexed %s photos in the %s.' % (
+                Photo.objects.count(),
+                'FTS5 table' if use_fts() else 'search term table'))
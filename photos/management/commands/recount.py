@@ -0,0 +1,26 @@
+from django.core.management.base import NoArgsCommand
+
+from photos.models import Album, Location, Person
+
+
+class Command(NoArgsCommand):
+    help = ('Rebuilds the photo counts, album counts and cover photos of '
+            'albums, people and locations in case they have drifted.')
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity'))
+        for model in (Album, Person, Location):
+            fixed = 0
+            for instance in model.objects.all().iterator():
+                counters = (instance.photo_count, instance.cover_photo_id,
+                            getattr(instance, 'album_count', None))
+                instance.recount()
+                if counters != (instance.photo_count, instance.cover_photo_id,
+                                getattr(instance, 'album_count', None)):
+                    fixed += 1
+                    if verbosity > 1:
+                        self.stdout.write('Fixed %s "%s".' % (
+                            model._meta.verbose_name, instance))
+            if verbosity > 0:
+                self.stdout.write('Fixed %s %s.' % (
+                    fixed, model._meta.verbose_name_plural))
@@ -1,12 +1,15 @@
 import datetime
 
-from django.db import models
+from django.conf import settings
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 from utils.filestorage.uploads import get_unique_upload_path
-from utils.filestorage.signals import delete_files_on_delete, \
-    delete_files_on_change
+from utils.filestorage.signals import delete_changed_files, \
+    delete_files_on_change, delete_files_on_delete, remember_files_on_init
 from photos.utils import generate_thumbnail
+from stream.models import StreamModel
 
 MONTH_CHOICES = ((mon, datetime.date(2000, mon, 1).strftime('%B')) for mon in
                  range(1, 13))
@@ -15,10 +18,98 @@ YEAR_CHOICES = ((year, year) for year in
                 range(1950, (datetime.datetime.now().year + 1)))
 
 
-class Location(models.Model):
+def get_thumbnail_attr(size):
+    """
+    Returns the name of the attribute that caches the thumbnail file with the
+    given size on a Photo instance.
+    """
+    return '_thumbnail_%s' % size.replace('-', '_')
+
+
+class CoverQuerySet(models.QuerySet):
+    """
+    A queryset for models that are listed with a cover photo and a photo
+    count, which are stored on the rows themselves. with_covers() adds the
+    path of the cover thumbnail so a whole page of the list is fetched in a
+    single query.
+    """
+
+    def with_covers(self, size='200x200-fit'):
+        """
+        Annotates each row with cover_thumbnail, the path of the thumbnail
+        of its cover photo with the given size.
+        """
+        tables = {
+            'table': self.model._meta.db_table,
+            'thumbnail': Thumbnail._meta.db_table,
+        }
+        return self.extra(
+            select={'cover_thumbnail': (
+                'SELECT t.file FROM %(thumbnail)s t WHERE t.size = %%s '
+                'AND t.photo_id = %(table)s.cover_photo_id' % tables)},
+            select_params=[size])
+
+
+class CoverModel(StreamModel):
+    """
+    An abstract model for the collections of photos that are listed with a
+    cover photo and a photo count. Both are denormalized on the row and kept
+    current by update_photo_counts(), and can be rebuilt with the recount
+    management command.
+    """
+
+    photo_count = models.PositiveIntegerField(
+        _('photo count'), default=0, editable=False)
+    cover_photo = models.ForeignKey(
+        'Photo', null=True, blank=True, editable=False, related_name='+',
+        verbose_name=_('cover photo'), on_delete=models.SET_NULL)
+
+    objects = CoverQuerySet.as_manager()
+
+    # The lookup from Photo to the collection, and the order of its photos in
+    # which the first one is the cover photo. Subclasses set the lookup.
+    photo_lookup = None
+    photo_ordering = ('name', 'id')
+
+    class Meta:
+        abstract = True
+
+    def get_photos(self):
+        """
+        Returns the photos of this collection, in the order that the first
+        one is the cover photo.
+        """
+        return Photo.objects.filter(**{self.photo_lookup: self.pk}).order_by(
+            *self.photo_ordering)
+
+    def recount(self):
+        """
+        Recalculates the counters of this instance from scratch and saves
+        them if they changed.
+        """
+        photos = self.get_photos()
+        counters = {
+            'photo_count': photos.count(),
+            'cover_photo': photos.values_list('pk', flat=True).first()
+        }
+        if self.photo_count != counters['photo_count'] or \
+                self.cover_photo_id != counters['cover_photo']:
+            self.__class__.objects.filter(pk=self.pk).update(**counters)
+            self.photo_count = counters['photo_count']
+            self.cover_photo_id = counters['cover_photo']
+
+
+class Location(CoverModel):
     """A location is a physical location that can be applied to an album."""
 
     name = models.CharField(_('name'), max_length=200)
+    album_count = models.PositiveIntegerField(
+        _('album count'), default=0, editable=False)
+
+    # The photos from all the albums of this location, so the cover photo is
+    # the first photo of the first album.
+    photo_lookup = 'album__location'
+    photo_ordering = ('album__name', 'album__id', 'name', 'id')
 
     class Meta:
         ordering = ['name', ]
@@ -32,21 +123,21 @@ class Location(models.Model):
     def __str__(self):
         return self.name
 
-    @property
-    def cover_photo(self):
-        """
-        Returns the cover photo for this person, which for now is just the
-        first photo from the first album based on whatever ordering is the
-        default.
-        """
-        return self.album_set.first().photo_set.first()
+    def recount(self):
+        album_count = Album.objects.filter(location=self.pk).count()
+        if self.album_count != album_count:
+            Location.objects.filter(pk=self.pk).update(album_count=album_count)
+            self.album_count = album_count
+        super().recount()
 
 
-class Person(models.Model):
+class Person(CoverModel):
     """A person is an actual person that can be tagged in photos."""
 
     name = models.CharField(_('name'), max_length=200)
 
+    photo_lookup = 'people'
+
     class Meta:
         ordering = ['name', ]
         verbose_name = _('person')
@@ -59,16 +150,8 @@ class Person(models.Model):
     def __str__(self):
         return self.name
 
-    @property
-    def cover_photo(self):
-        """
-        Returns the cover photo for this person, which for now is just the
-        first photo based on whatever ordering is the default.
-        """
-        return self.photo_set.first()
 
-
-class Album(models.Model):
+class Album(CoverModel):
     """
     An album is a collection of photos. It belongs to a location and can also
     have a month and a year associated with it.
@@ -84,6 +167,8 @@ class Album(models.Model):
         Location, null=True, blank=True,
         verbose_name=_('location'), on_delete=models.SET_NULL)
 
+    photo_lookup = 'album'
+
     class Meta:
         ordering = ['name', ]
         verbose_name = _('album')
@@ -96,14 +181,6 @@ class Album(models.Model):
     def __str__(self):
         return self.name
 
-    @property
-    def cover_photo(self):
-        """
-        Returns the cover photo for this album, which for now is just the
-        first photo based on whatever ordering is the default.
-        """
-        return self.photo_set.first()
-
     def get_date_display(self):
         """
         Returns a pretty display of the month and year in one of the formats:
@@ -119,27 +196,96 @@ class Album(models.Model):
         return ' '.join(output)
 
 
-class Photo(models.Model):
+def update_photo_counts(delta, albums=(), people=(), locations=()):
+    """
+    Adds delta to the photo count of the given albums, people and locations
+    (all given as IDs) and refreshes their cover photos. Only the affected
+    rows are touched: the counts are incremented in the database and each
+    cover photo is a single indexed lookup.
+    """
+    for model, pks in ((Album, albums), (Person, people),
+                       (Location, locations)):
+        pks = set(pk for pk in pks if pk)
+        if not pks:
+            continue
+        if delta:
+            model.objects.filter(pk__in=pks).update(
+                photo_count=models.F('photo_count') + delta)
+        for pk in pks:
+            cover_photo = model(pk=pk).get_photos().values_list(
+                'pk', flat=True).first()
+            model.objects.filter(pk=pk).update(cover_photo=cover_photo)
+
+
+def move_photo_counts(count, old_album, new_album):
+    """
+    Updates the photo counts after count photos were moved from old_album to
+    new_album. Locations are refreshed even when both albums share one, since
+    the move can change which photo is the cover.
+    """
+    if old_album.location_id == new_album.location_id:
+        update_photo_counts(0, locations=[old_album.location_id])
+    else:
+        update_photo_counts(-count, locations=[old_album.location_id])
+        update_photo_counts(count, locations=[new_album.location_id])
+    update_photo_counts(-count, albums=[old_album.pk])
+    update_photo_counts(count, albums=[new_album.pk])
+
+
+class Photo(StreamModel):
     """
     A photo is just that - a single photo. It can belong to only one album.
     """
 
-    name = models.CharField(_('name'), max_length=200, null=True, blank=True)
-    file = models.ImageField(_('file'), upload_to=get_unique_upload_path)
+    name = models.CharField(_('name'), max_length=200, blank=True,
+                            default='')
+    file = models.ImageField(
+        _('file'), upload_to=get_unique_upload_path, db_index=True)
+    sha256 = models.CharField(
+        _('SHA-256'), max_length=64, null=True, blank=True, editable=False,
+        db_index=True)
+    dhash = models.BigIntegerField(
+        _('perceptual hash'), null=True, blank=True, editable=False)
+    # Incremented whenever the file is changed (such as rotated), so the
+    # thumbnails get new file names and URLs.
+    version = models.PositiveIntegerField(
+        _('version'), default=0, editable=False)
 
     album = models.ForeignKey(Album, verbose_name=_('album'))
     people = models.ManyToManyField(
         Person, blank=True, verbose_name=_('people'))
 
-    # exif_make = models.CharField(max_length=100, null=True, blank=True)
-    # exif_model = models.CharField(max_length=100, null=True, blank=True)
-    # exif_iso = models.PositiveSmallIntegerField(null=True, blank=True)
-    # exif_focal = models.PositiveSmallIntegerField(null=True, blank=True)
-    # exif_exposure = models.CharField(max_length=100, null=True, blank=True)
-    # exif_fnumber = models.PositiveSmallIntegerField(null=True, blank=True)
+    # Read from the EXIF data of the file by photos.utils.read_exif.
+    exif_taken = models.DateTimeField(
+        _('date taken'), null=True, blank=True, editable=False, db_index=True)
+    exif_make = models.CharField(
+        _('camera make'), max_length=100, null=True, blank=True,
+        editable=False)
+    exif_model = models.CharField(
+        _('camera model'), max_length=100, null=True, blank=True,
+        editable=False, db_index=True)
+    exif_lens = models.CharField(
+        _('lens'), max_length=100, null=True, blank=True, editable=False)
+    exif_iso = models.PositiveIntegerField(
+        _('ISO'), null=True, blank=True, editable=False)
+    exif_focal = models.FloatField(
+        _('focal length'), null=True, blank=True, editable=False)
+    exif_exposure = models.CharField(
+        _('exposure'), max_length=20, null=True, blank=True, editable=False)
+    exif_fnumber = models.FloatField(
+        _('f-number'), null=True, blank=True, editable=False)
+    exif_latitude = models.FloatField(
+        _('latitude'), null=True, blank=True, editable=False)
+    exif_longitude = models.FloatField(
+        _('longitude'), null=True, blank=True, editable=False)
+    # Null until the EXIF data has been read.
+    exif_orientation = models.PositiveSmallIntegerField(
+        _('orientation'), null=True, blank=True, editable=False)
 
     class Meta:
-        ordering = ['name', ]
+        ordering = ['name', 'id', ]
+        index_together = [['album', 'name', 'id'],
+                          ['album', 'exif_taken', 'id'], ]
         verbose_name = _('photo')
         verbose_name_plural = _('photos')
 
@@ -152,15 +298,20 @@ class Photo(models.Model):
 
     def thumbnail(self, size):
         """
-        Generate and return a thumbnail with the given size. Only do this once
-        in this instance to save on hits to the Thumnail model.
+        Return the thumbnail file with the given size, or None if it has not
+        been generated yet. Missing thumbnails are queued for the thumbnail
+        worker instead of being generated while the page renders. Only do this
+        once in this instance to save on hits to the Thumbnail model.
         """
-        prop_name = '_thumbnail_%s' % size.replace('-', '_')
+        prop_name = get_thumbnail_attr(size)
         if not hasattr(self, prop_name):
+            thumbnail = self.thumbnail_set.filter(size=size).first()
+            if thumbnail is None:
+                ThumbnailJob.objects.get_or_create(photo=self)
             setattr(
                 self,
                 prop_name,
-                self.thumbnail_set.get_or_create(size=size)[0].file)
+                thumbnail.file if thumbnail else None)
         return getattr(self, prop_name)
 
     @property
@@ -185,7 +336,7 @@ class Thumbnail(models.Model):
     """
 
     size = models.CharField(_('size'), max_length=20, db_index=True)
-    file = models.ImageField(_('file'))
+    file = models.ImageField(_('file'), db_index=True)
     photo = models.ForeignKey(Photo, verbose_name=_('photo'))
 
     class Meta:
@@ -203,24 +354,261 @@ class Thumbnail(models.Model):
         have one generated. The new one will overwrite the existing one (while
         keeping the same filename).
         """
-        self.file = generate_thumbnail(self.photo.file, self.size)
+        self.file = generate_thumbnail(
+            self.photo.file, self.size, self.photo.version)
 
     def save(self, force_insert=False, force_update=False, using=None,
              update_fields=None):
         """
-        If we have a photo and a size, generate a thumbnail regardless of
-        whether we already have one generated. Maybe in the future this could
-        check to make sure the thumbnail already exists, but that's
-        not needed now.
+        If we have a photo and a size but no file yet, generate the thumbnail.
+        The thumbnail worker generates the files itself and only saves the
+        resulting paths, so those are left alone. Call generate() directly to
+        force a new thumbnail.
         """
-        if self.photo and self.size:
+        if self.photo and self.size and not self.file:
             self.generate()
         super().save(force_insert, force_update, using, update_fields)
 
+
+# The thumbnail worker gives up on a job after it has failed this many times.
+MAX_THUMBNAIL_ATTEMPTS = 3
+
+
+class ThumbnailJob(models.Model):
+    """
+    A thumbnail job is a queued request to generate all the thumbnails of a
+    photo. Jobs are processed by the process_thumbnails management command so
+    that uploads and page views never have to wait on image processing.
+    """
+
+    photo = models.OneToOneField(Photo, verbose_name=_('photo'))
+    created = models.DateTimeField(
+        _('created'), default=timezone.now, db_index=True)
+    started = models.DateTimeField(_('started'), null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(_('attempts'), default=0)
+
+    class Meta:
+        ordering = ['created', ]
+        verbose_name = _('thumbnail job')
+        verbose_name_plural = _('thumbnail jobs')
+
+    def __str__(self):
+        return str(self.photo)
+
+
+class UploadSession(models.Model):
+    """
+    An upload session is a file that is being uploaded in chunks (see
+    photos.uploads). The chunks are written straight in to the file at its
+    final path and the photo is created as soon as the last one arrives.
+    The key is chosen by the browser so it can find the session again to
+    resume the upload.
+    """
+
+    key = models.CharField(_('key'), max_length=200)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name=_('user'))
+    album = models.ForeignKey(Album, verbose_name=_('album'))
+    filename = models.CharField(_('filename'), max_length=200)
+    file = models.CharField(_('file'), max_length=100)
+    size = models.BigIntegerField(_('size'))
+    chunk_size = models.PositiveIntegerField(_('chunk size'))
+    created = models.DateTimeField(
+        _('created'), default=timezone.now, db_index=True)
+    completed = models.DateTimeField(_('completed'), null=True, blank=True)
+    photo = models.ForeignKey(
+        Photo, null=True, blank=True, verbose_name=_('photo'),
+        on_delete=models.SET_NULL)
+
+    class Meta:
+        ordering = ['created', ]
+        index_together = [['user', 'key'], ]
+        verbose_name = _('upload session')
+        verbose_name_plural = _('upload sessions')
+
+    def __str__(self):
+        return self.filename
+
+    @property
+    def chunk_count(self):
+        return max((self.size + self.chunk_size - 1) // self.chunk_size, 1)
+
+
+class UploadChunk(models.Model):
+    """
+    A chunk of an upload session that has been received and written.
+    """
+
+    session = models.ForeignKey(UploadSession, verbose_name=_('session'))
+    index = models.PositiveIntegerField(_('index'))
+    checksum = models.CharField(_('checksum'), max_length=64)
+
+    class Meta:
+        ordering = ['session', 'index', ]
+        unique_together = ('session', 'index', )
+        verbose_name = _('upload chunk')
+        verbose_name_plural = _('upload chunks')
+
+    def __str__(self):
+        return '%s (%s)' % (self.session, self.index)
+
+
+class DeletedFile(models.Model):
+    """
+    A file whose rows were deleted in bulk (see photos.deletion). The files
+    are unlinked later, in batches, by the reap_files management command,
+    which only sees them once the deletion has committed.
+    """
+
+    name = models.CharField(_('name'), max_length=100)
+
+    class Meta:
+        ordering = ['id', ]
+        verbose_name = _('deleted file')
+        verbose_name_plural = _('deleted files')
+
+    def __str__(self):
+        return self.name
+
+
+class SearchTerm(models.Model):
+    """
+    A word in the search document of a photo. This is the search index on
+    databases without SQLite's FTS5 (see photos.search).
+    """
+
+    word = models.CharField(_('word'), max_length=50)
+    weight = models.PositiveSmallIntegerField(_('weight'))
+    photo = models.ForeignKey(Photo, verbose_name=_('photo'))
+
+    class Meta:
+        index_together = [['word', 'photo'], ]
+        verbose_name = _('search term')
+        verbose_name_plural = _('search terms')
+
+    def __str__(self):
+        return self.word
+
+
+def prefetch_thumbnails(photos, size):
+    """
+    Resolves the thumbnails with the given size for a whole list of photos in
+    a single query and caches them on each photo, so templates calling
+    photo.thumbnail() don't query or queue anything per photo. Photos that
+    don't have the thumbnail yet are queued for the thumbnail worker in bulk.
+    Returns the photos as a list.
+    """
+    photos = list(photos)
+    thumbnails = dict(
+        (thumb.photo_id, thumb) for thumb in
+        Thumbnail.objects.filter(photo__in=photos, size=size))
+    missing = []
+    for photo in photos:
+        thumbnail = thumbnails.get(photo.pk)
+        setattr(photo, get_thumbnail_attr(size),
+                thumbnail.file if thumbnail else None)
+        if thumbnail is None:
+            missing.append(photo)
+    if missing:
+        queued = set(ThumbnailJob.objects.filter(
+            photo__in=missing).values_list('photo_id', flat=True))
+        try:
+            with transaction.atomic():
+                ThumbnailJob.objects.bulk_create([
+                    ThumbnailJob(photo=photo) for photo in missing
+                    if photo.pk not in queued])
+        except IntegrityError:
+            # Another request queued some of these photos in the meantime.
+            pass
+    return photos
+
+
+def update_counts_on_tag(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Keeps the photo counts of people current when photos are tagged or
+    untagged. Clearing the tags doesn't say which ones were removed, and
+    removing them passes the pks as given, tagged or not, so the tags that
+    really go are looked up right before they are removed.
+    """
+    if action in ('pre_clear', 'pre_remove'):
+        related = instance.photo_set if reverse else instance.people
+        if action == 'pre_remove':
+            related = related.filter(pk__in=pk_set)
+        instance._removed_pks = list(related.values_list('pk', flat=True))
+        return
+    if action in ('post_clear', 'post_remove'):
+        pk_set = instance.__dict__.pop('_removed_pks', None)
+        delta = -1
+    elif action == 'post_add':
+        delta = 1
+    else:
+        return
+    if not pk_set:
+        return
+    if reverse:
+        update_photo_counts(delta * len(pk_set), people=[instance.pk])
+    else:
+        update_photo_counts(delta, people=pk_set)
+
+
+def remember_counts_on_delete(sender, instance, **kwargs):
+    """
+    Remembers the people and the location of a photo that is being deleted,
+    since they can't be looked up anymore once it's gone.
+    """
+    instance._counted_people = list(
+        instance.people.values_list('pk', flat=True))
+    instance._counted_location = Album.objects.filter(
+        pk=instance.album_id).values_list('location', flat=True).first()
+
+
+def update_counts_on_delete(sender, instance, **kwargs):
+    """
+    Removes a deleted photo from the photo counts of its album, people and
+    location.
+    """
+    update_photo_counts(
+        -1, albums=[instance.album_id],
+        people=getattr(instance, '_counted_people', []),
+        locations=[getattr(instance, '_counted_location', None)])
+
+
+def update_location_on_album_delete(sender, instance, **kwargs):
+    """
+    Recounts the location of a deleted album.
+    """
+    location = Location.objects.filter(pk=instance.location_id).first()
+    if location:
+        location.recount()
+
+
+def delete_file_on_session_delete(sender, instance, **kwargs):
+    """
+    Deletes the partial file of an upload session that never completed.
+    """
+    if instance.completed is None:
+        Photo._meta.get_field('file').storage.delete(instance.file)
+
+
+# Keep the photo counts and cover photos current.
+models.signals.m2m_changed.connect(
+    update_counts_on_tag, sender=Photo.people.through)
+models.signals.pre_delete.connect(remember_counts_on_delete, sender=Photo)
+models.signals.post_delete.connect(update_counts_on_delete, sender=Photo)
+models.signals.post_delete.connect(
+    update_location_on_album_delete, sender=Album)
+
+# Delete the partial files of abandoned uploads.
+models.signals.pre_delete.connect(
+    delete_file_on_session_delete, sender=UploadSession)
+
 # Delete photo files when Photo instance is deleted.
-models.signals.pre_delete.connect(delete_files_on_delete, sender=Photo)
+models.signals.post_delete.connect(delete_files_on_delete, sender=Photo)
+models.signals.post_init.connect(remember_files_on_init, sender=Photo)
 models.signals.pre_save.connect(delete_files_on_change, sender=Photo)
+models.signals.post_save.connect(delete_changed_files, sender=Photo)
 
 # Delete thumbnail files when Thumbnail is deleted.
-models.signals.pre_delete.connect(delete_files_on_delete, sender=Thumbnail)
+models.signals.post_delete.connect(delete_files_on_delete, sender=Thumbnail)
+models.signals.post_init.connect(remember_files_on_init, sender=Thumbnail)
 models.signals.pre_save.connect(delete_files_on_change, sender=Thumbnail)
+models.signals.post_save.connect(delete_changed_files, sender=Thumbnail)
@@ -0,0 +1,436 @@
+"""
+Full text search over photos. Each photo has a search document made of its
+name, its album name, its location name and the names of the people tagged
+in it, which is kept up to date by the signal handlers at the bottom of this
+module (connected in photos.apps).
+
+On SQLite the documents live in an FTS5 table and results are ranked with
+bm25. Other databases use the SearchTerm table, an inverted index of the
+words in each document, and rank by the weight of the matching words.
+"""
+import hashlib
+import re
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from itertools import chain
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, models, transaction
+from django.http import QueryDict
+from django.utils.http import urlencode
+
+from photos.models import Album, Location, Person, Photo, SearchTerm
+from utils.db import raw_delete
+
+FTS_TABLE = 'photos_photo_fts'
+
+# Cached result sets are keyed on this counter, which is bumped whenever a
+# search document changes, so every cached result set expires at once.
+VERSION_KEY = 'photos:search:version'
+
+# The columns of a search document along with their weight when ranking.
+FIELDS = (('name', 3), ('album', 2), ('location', 1), ('people', 2))
+
+# Number of photos indexed per query, which keeps the IN clauses well under
+# the SQLite limit on query parameters.
+BATCH_SIZE = 500
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def use_fts():
+    """
+    Returns True if the database is SQLite and it was built with FTS5.
+    """
+    if connection.vendor != 'sqlite':
+        return False
+    if not hasattr(connection, '_photos_fts'):
+        cursor = connection.cursor()
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        connection._photos_fts = bool(cursor.fetchone()[0])
+    return connection._photos_fts
+
+
+def get_words(text):
+    """
+    Splits text in to lowercase words without accents, the same way FTS5
+    tokenizes it.
+    """
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return WORD_RE.findall(text.lower())
+
+
+def get_documents(photo_ids):
+    """
+    Returns the search documents of the given photos as a dictionary of photo
+    IDs to dictionaries with a value for each of FIELDS. Deleted photos are
+    left out. Uses two queries whatever the number of photos.
+    """
+    documents = {}
+    rows = Photo.objects.filter(pk__in=photo_ids).values_list(
+        'id', 'name', 'album__name', 'album__location__name')
+    for pk, name, album, location in rows:
+        documents[pk] = {'name': name or '', 'album': album or '',
+                         'location': location or '', 'people': []}
+    tags = Photo.people.through.objects.filter(
+        photo__in=photo_ids).values_list('photo_id', 'person__name')
+    for pk, person in tags:
+        if pk in documents:
+            documents[pk]['people'].append(person)
+    for document in documents.values():
+        document['people'] = ' '.join(sorted(document['people']))
+    return documents
+
+
+def index_photos(photo_ids):
+    """
+    Rebuilds the search documents of the given photos, removing the ones of
+    photos that no longer exist, and expires the cached search results.
+    """
+    photo_ids = sorted(set(photo_ids))
+    with transaction.atomic():
+        for start in range(0, len(photo_ids), BATCH_SIZE):
+            batch = photo_ids[start:start + BATCH_SIZE]
+            documents = get_documents(batch)
+            if use_fts():
+                write_fts_documents(batch, documents)
+            else:
+                write_search_terms(batch, documents)
+    if photo_ids:
+        bump_version()
+
+
+def write_fts_documents(photo_ids, documents):
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM %s WHERE rowid IN (%s)' % (
+        FTS_TABLE, ', '.join(['%s'] * len(photo_ids))), photo_ids)
+    cursor.executemany(
+        'INSERT INTO %s (rowid, %s) VALUES (%s)' % (
+            FTS_TABLE, ', '.join(field for field, weight in FIELDS),
+            ', '.join(['%s'] * (len(FIELDS) + 1))),
+        [[pk] + [document[field] for field, weight in FIELDS]
+         for pk, document in documents.items()])
+
+
+def write_search_terms(photo_ids, documents):
+    SearchTerm.objects.filter(photo__in=photo_ids).delete()
+    terms = []
+    for pk, document in documents.items():
+        weights = {}
+        for field, weight in FIELDS:
+            for word in get_words(document[field]):
+                word = word[:SearchTerm._meta.get_field('word').max_length]
+                weights[word] = weights.get(word, 0) + weight
+        terms.extend(SearchTerm(photo_id=pk, word=word, weight=weight)
+                     for word, weight in weights.items())
+    SearchTerm.objects.bulk_create(terms, batch_size=BATCH_SIZE)
+
+
+def unindex_photos(photos):
+    """
+    Removes the search documents of a queryset of photos that is about to be
+    deleted in bulk, in a single query, and expires the cached search
+    results.
+    """
+    if use_fts():
+        sql, params = photos.order_by().values_list('id').query.get_compiler(
+            photos.db).as_sql()
+        connection.cursor().execute('DELETE FROM %s WHERE rowid IN (%s)' % (
+            FTS_TABLE, sql), params)
+    else:
+        raw_delete(SearchTerm.objects.filter(photo__in=photos))
+    bump_version()
+
+
+def rebuild_index():
+    """
+    Rebuilds the search documents of every photo in one transaction.
+    """
+    with transaction.atomic():
+        if use_fts():
+            connection.cursor().execute('DELETE FROM %s' % FTS_TABLE)
+        else:
+            SearchTerm.objects.all().delete()
+        index_photos(Photo.objects.values_list('id', flat=True))
+
+
+def search_photos(queryset, text):
+    """
+    Filters a photo queryset down to the photos matching every word of text
+    (each word also matches longer words it's the start of) and orders them
+    by relevance, then by name. The relevance is available as the
+    "search_rank" attribute of each photo, where lower is better.
+    """
+    words = get_words(text)
+    if not words:
+        return queryset.none()
+    photo_id = '%s.%s' % (connection.ops.quote_name(Photo._meta.db_table),
+                          connection.ops.quote_name(Photo._meta.pk.column))
+    if use_fts():
+        # Quoting each word stops FTS5 from treating any of it as syntax.
+        match = ' '.join('"%s"*' % word for word in words)
+        rank = 'bm25(%s, %s)' % (FTS_TABLE, ', '.join(
+            '%d.0' % weight for field, weight in FIELDS))
+        queryset = queryset.extra(
+            select={'search_rank': rank},
+            tables=[FTS_TABLE],
+            where=['%s.rowid = %s' % (FTS_TABLE, photo_id),
+                   '%s MATCH %%s' % FTS_TABLE],
+            params=[match])
+    else:
+        table = SearchTerm._meta.db_table
+        for word in words:
+            queryset = queryset.filter(pk__in=SearchTerm.objects.filter(
+                word__startswith=word).values('photo'))
+        rank = ('SELECT -SUM(weight) FROM %s WHERE %s.photo_id = %s AND (%s)'
+                % (table, table, photo_id, ' OR '.join(
+                    ["%s.word LIKE %%s ESCAPE '\\'" % table] * len(words))))
+        # Words can contain underscores, which LIKE takes as wildcards.
+        queryset = queryset.extra(
+            select={'search_rank': rank},
+            select_params=[re.sub(r'([\\%_])', r'\\\1', word) + '%'
+                           for word in words])
+    return queryset.order_by('search_rank', 'name', 'id')
+
+
+def normalize_query(query):
+    """
+    Returns the canonical form of a search query string, so queries that
+    differ only in the order of their parameters, duplicate or invalid IDs,
+    case, accents or punctuation share their cached results.
+    """
+    query_dict = QueryDict(query)
+    normalized = []
+    for key in ('a', 'l', 'p', 'y'):
+        pks = set(int(pk) for pk in query_dict.getlist(key) if pk.isdigit())
+        normalized.extend((key, pk) for pk in sorted(pks))
+    cameras = set(camera.strip() for camera in query_dict.getlist('c'))
+    normalized.extend(('c', camera) for camera in sorted(cameras) if camera)
+    words = get_words(query_dict.get('q'))
+    if words:
+        normalized.append(('q', ' '.join(words)))
+    if query_dict.get('o') == 'taken':
+        normalized.append(('o', 'taken'))
+    return urlencode(normalized)
+
+
+def filter_photos(query):
+    """
+    Returns the photos matching a search query string, which can contain
+    albums (a), people (p), locations (l), years (y), camera models (c) and
+    text (q).
+    """
+    query_dict = QueryDict(query)
+    queryset = Photo.objects.all()
+    q = query_dict.get('q')
+    if q:
+        queryset = search_photos(queryset, q)
+    a = query_dict.getlist('a')
+    if a:
+        queryset = queryset.filter(album__in=a)
+    p = query_dict.getlist('p')
+    if p:
+        # A subquery rather than a join, so photos tagged with several of
+        # the people aren't repeated and get_facets can join the people.
+        queryset = queryset.filter(pk__in=Photo.people.through.objects.filter(
+            person__in=p).values('photo'))
+    l = query_dict.getlist('l')
+    if l:
+        queryset = queryset.filter(album__location__in=l)
+    y = query_dict.getlist('y')
+    if y:
+        queryset = queryset.filter(album__year__in=y)
+    c = query_dict.getlist('c')
+    if c:
+        queryset = queryset.filter(exif_model__in=c)
+    return queryset
+
+
+def get_ordered_ids(queryset, order):
+    """
+    Returns the IDs of the photos in a queryset, in the given order: '' for
+    the order of the queryset (relevance when searching text, otherwise the
+    name) and 'taken' for the date the photos were taken. Photos without a
+    date come last in the order of their names. They are queried separately
+    because databases don't agree on where NULLs go, and this way both
+    queries can use the indexes on the date and the name.
+    """
+    if order != 'taken':
+        return queryset.values_list('id', flat=True)
+    return chain(
+        queryset.filter(exif_taken__isnull=False).order_by(
+            'exif_taken', 'id').values_list('id', flat=True),
+        queryset.filter(exif_taken__isnull=True).order_by(
+            'name', 'id').values_list('id', flat=True))
+
+
+def get_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # Start from the time rather than 1 so a counter that was evicted
+        # can't come back to the version of stale result sets.
+        version = int(time.time())
+        cache.add(VERSION_KEY, version, None)
+    return version
+
+
+def bump_version():
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        get_version()
+
+
+def get_cache_key(prefix, query):
+    return 'photos:search:%s:%s:%s' % (
+        prefix, get_version(), hashlib.md5(query.encode('utf-8')).hexdigest())
+
+
+def get_result_ids(query):
+    """
+    Returns the IDs of the photos matching a search query string in order,
+    without duplicates (tagging several of the searched people in a photo
+    would otherwise repeat it). The IDs are cached as a compact array under
+    the normalized query, so paging through the results and the photo pages
+    inside them doesn't run the search again.
+    """
+    query = normalize_query(query)
+    key = get_cache_key('results', query)
+    data = cache.get(key)
+    if data is None:
+        photo_ids = get_ordered_ids(
+            filter_photos(query), QueryDict(query).get('o', ''))
+        photo_ids = array('l', OrderedDict.fromkeys(photo_ids))
+        data = photo_ids.tobytes()
+        cache.set(key, data, settings.SEARCH_CACHE_TIMEOUT)
+    photo_ids = array('l')
+    photo_ids.frombytes(data)
+    return photo_ids
+
+
+def get_facets(query):
+    """
+    Counts the photos matching a search query string per album (a), person
+    (p), location (l), year (y) and camera model (c). Returns a dictionary
+    of those keys to lists of (value, name, count) tuples, most photos first.
+    The album, location and year counts come from a single aggregate over
+    the results grouped by album, since an album has one location and one
+    year, the people counts from a single aggregate over their tags and the
+    camera counts from one over the indexed camera model. The facets are
+    cached along with the results.
+    """
+    query = normalize_query(query)
+    key = get_cache_key('facets', query)
+    facets = cache.get(key)
+    if facets is not None:
+        return facets
+
+    photos = filter_photos(query).order_by()
+    facets = {'a': [], 'p': [], 'l': {}, 'y': {}}
+    rows = photos.values_list(
+        'album', 'album__name', 'album__location', 'album__location__name',
+        'album__year').annotate(count=models.Count('id'))
+    for album, album_name, location, location_name, year, count in rows:
+        facets['a'].append((album, album_name, count))
+        for facet, value, name in (('l', location, location_name),
+                                   ('y', year, str(year))):
+            if value is not None:
+                total = facets[facet].get(value, (value, name, 0))[2]
+                facets[facet][value] = (value, name, total + count)
+    facets['l'] = list(facets['l'].values())
+    facets['y'] = list(facets['y'].values())
+    facets['p'] = list(photos.filter(people__isnull=False).values_list(
+        'people', 'people__name').annotate(count=models.Count('id')))
+    facets['c'] = [(model, model, count) for model, count in photos.filter(
+        exif_model__isnull=False).values_list('exif_model').annotate(
+        count=models.Count('id'))]
+
+    for values in facets.values():
+        values.sort(key=lambda value: (-value[2], value[1]))
+    cache.set(key, facets, settings.SEARCH_CACHE_TIMEOUT)
+    return facets
+
+
+def create_fts_table(sender, app_config=None, **kwargs):
+    """
+    Creates the FTS5 table after syncdb/migrate, since Django doesn't know
+    about virtual tables. New tables start out empty, so the photos that
+    already exist are indexed.
+    """
+    if app_config is None or app_config.label != 'photos' or not use_fts():
+        return
+    if FTS_TABLE in connection.introspection.table_names():
+        return
+    connection.cursor().execute(
+        "CREATE VIRTUAL TABLE %s USING fts5(%s, prefix='2 3', "
+        "tokenize='unicode61 remove_diacritics 2')" % (
+            FTS_TABLE, ', '.join(field for field, weight in FIELDS)))
+    rebuild_index()
+
+
+def update_search_on_save(sender, instance, created, raw=False, **kwargs):
+    """
+    Reindexes the photos whose documents include the saved photo, album,
+    person or location. New albums, people and locations have no photos yet.
+    """
+    if raw:
+        return
+    if sender is Photo:
+        index_photos([instance.pk])
+    elif not created:
+        index_photos(instance.get_photos().values_list('id', flat=True))
+
+
+def update_search_on_tag(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Reindexes photos when people are tagged or untagged.
+    """
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            index_photos([instance.pk])
+        return
+    if action == 'pre_clear':
+        instance._search_cleared_pks = list(
+            instance.photo_set.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        index_photos(instance.__dict__.pop('_search_cleared_pks', []))
+    elif action in ('post_add', 'post_remove'):
+        index_photos(pk_set or [])
+
+
+def remember_photos_on_delete(sender, instance, **kwargs):
+    """
+    Remembers the photos of a person or location that is being deleted, so
+    they can be reindexed once it's gone.
+    """
+    instance._search_photo_pks = list(
+        instance.get_photos().values_list('id', flat=True))
+
+
+def update_search_on_delete(sender, instance, **kwargs):
+    """
+    Reindexes the photos of a deleted person or location, or drops the
+    document of a deleted photo.
+    """
+    if sender is Photo:
+        index_photos([instance.pk])
+    else:
+        index_photos(getattr(instance, '_search_photo_pks', []))
+
+
+def connect_signals():
+    models.signals.post_migrate.connect(create_fts_table)
+    for model in (Photo, Album, Person, Location):
+        models.signals.post_save.connect(update_search_on_save, sender=model)
+    models.signals.m2m_changed.connect(
+        update_search_on_tag, sender=Photo.people.through)
+    for model in (Person, Location):
+        models.signals.pre_delete.connect(
+            remember_photos_on_delete, sender=model)
+    for model in (Photo, Person, Location):
+        models.signals.post_delete.connect(
+            update_search_on_delete, sender=model)
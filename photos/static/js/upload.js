@@ -0,0 +1,147 @@
+// Uploads the photos chosen in the upload form in chunks (see
+// photos/uploads.py). Several chunks are sent at once, each with its SHA-256
+// checksum, and failed chunks are retried. A file that was interrupted is
+// resumed when it is chosen again, since the server remembers which of its
+// chunks arrived. Browsers without fetch and Web Crypto submit the form.
+$(function() {
+
+    var PARALLEL_CHUNKS = 3;
+    var RETRIES = 5;
+
+    var form = $("form[data-upload-sessions]");
+    if (!form.length || !window.fetch || !window.crypto || !window.crypto.subtle) {
+        return;
+    }
+
+    function getCookie(name) {
+        var match = document.cookie.match("(^|;)\\s*" + name + "=([^;]*)");
+        return match ? decodeURIComponent(match[2]) : null;
+    }
+
+    function request(url, options) {
+        options.credentials = "same-origin";
+        options.headers = options.headers || {};
+        options.headers["X-CSRFToken"] = getCookie("csrftoken");
+        options.headers["X-Requested-With"] = "XMLHttpRequest";
+        return fetch(url, options).then(function(response) {
+            return response.json().then(function(data) {
+                if (!response.ok) {
+                    throw data;
+                }
+                return data;
+            });
+        });
+    }
+
+    function readChunk(file, session, index) {
+        var start = index * session.chunk_size;
+        var blob = file.slice(start, start + session.chunk_size);
+        return new Promise(function(resolve, reject) {
+            var reader = new FileReader();
+            reader.onload = function() { resolve(reader.result); };
+            reader.onerror = function() { reject(reader.error); };
+            reader.readAsArrayBuffer(blob);
+        });
+    }
+
+    function toHex(buffer) {
+        return Array.prototype.map.call(new Uint8Array(buffer), function(b) {
+            return ("0" + b.toString(16)).slice(-2);
+        }).join("");
+    }
+
+    function sendChunk(file, session, index, attempt) {
+        return readChunk(file, session, index).then(function(data) {
+            return crypto.subtle.digest("SHA-256", data).then(function(digest) {
+                return request(session.url + "chunks/" + index + "/", {
+                    method: "POST",
+                    body: data,
+                    headers: {
+                        "Content-Type": "application/octet-stream",
+                        "X-Checksum": toHex(digest)
+                    }
+                });
+            });
+        }).catch(function(error) {
+            if (attempt >= RETRIES) {
+                throw error;
+            }
+            // Wait a little longer after every failure before retrying.
+            return new Promise(function(resolve) {
+                setTimeout(resolve, 1000 * Math.pow(2, attempt));
+            }).then(function() {
+                return sendChunk(file, session, index, attempt + 1);
+            });
+        });
+    }
+
+    function uploadFile(file, album, progress) {
+        var data = new FormData();
+        data.append("album", album);
+        data.append("filename", file.name);
+        data.append("size", file.size);
+        data.append("key", [file.name, file.size, file.lastModified].join(":"));
+        return request(form.data("upload-sessions"), {
+            method: "POST",
+            body: data
+        }).then(function(session) {
+            var missing = [];
+            for (var index = 0; index < session.chunk_count; index++) {
+                if (session.received.indexOf(index) == -1) {
+                    missing.push(index);
+                }
+            }
+            var done = session.chunk_count - missing.length;
+            progress(done, session.chunk_count);
+            function worker() {
+                if (!missing.length) {
+                    return Promise.resolve();
+                }
+                return sendChunk(file, session, missing.shift(), 0).then(function() {
+                    progress(++done, session.chunk_count);
+                    return worker();
+                });
+            }
+            var workers = [];
+            for (var i = 0; i < PARALLEL_CHUNKS; i++) {
+                workers.push(worker());
+            }
+            return Promise.all(workers).then(function() {
+                return session;
+            });
+        });
+    }
+
+    form.submit(function(event) {
+        var files = form.find("input[type='file']")[0].files;
+        var album = form.find("select[name='album']").val();
+        if (!files.length || !album) {
+            // Let the form show what is missing.
+            return;
+        }
+        event.preventDefault();
+        var status = form.find(".upload-status");
+        form.find("input[type='submit']").prop("disabled", true);
+
+        var index = 0;
+        function next(session) {
+            if (index >= files.length) {
+                window.location = session ? session.album : window.location;
+                return;
+            }
+            var file = files[index++];
+            return uploadFile(file, album, function(done, total) {
+                status.text(file.name + " (" + index + "/" + files.length +
+                    "): " + Math.round(100 * done / total) + "%");
+            }).then(next);
+        }
+        Promise.resolve(next()).catch(function(error) {
+            form.find("input[type='submit']").prop("disabled", false);
+            status.text("");
+            console.log(error);
+            alert("The upload was interrupted. Choose the same photos and " +
+                "upload again to resume.");
+        });
+    });
+
+});
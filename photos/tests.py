@@ -1,10 +1,80 @@
+import datetime
+import hashlib
+import io
 import json
+import os
+import shutil
+import struct
+import tempfile
+import zipfile
+from random import Random
+from unittest import mock
 
-from django.test import TestCase, Client
+from PIL import Image as PILImage, ImageDraw
+from PIL.TiffImagePlugin import IFDRational
+
+from django.test import TestCase, TransactionTestCase, Client
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
+from django.utils import timezone
+
+from stream.models import Action
+from stream.utils import send_action
+from utils.db import on_commit
+from utils.jpeg import find_orientation
+
+from .duplicates import HASH_MASK, find_clusters, find_near_duplicates
+from .forms import AlbumMergeForm
+from .models import MAX_THUMBNAIL_ATTEMPTS, Album, DeletedFile, Location, \
+    Person, Photo, SearchTerm, Thumbnail, ThumbnailJob, UploadSession, \
+    update_photo_counts
+from .search import get_facets, get_result_ids, normalize_query, \
+    rebuild_index, search_photos, use_fts
+from .utils import DRAFT_OVERSAMPLE, ROTATE_CLOCKWISE, combine_orientations, \
+    get_size_profiles, open_image, read_exif, render_thumbnails
+
+
+def make_image(name='photo.jpg', size=(640, 480), color='red'):
+    """
+    Returns an uploadable JPEG file of the given size.
+    """
+    output = io.BytesIO()
+    PILImage.new('RGB', size, color).save(output, 'JPEG')
+    return SimpleUploadedFile(name, output.getvalue(), 'image/jpeg')
+
+
+class MediaTestCase(TestCase):
+    """
+    A test case that stores uploaded files in a temporary MEDIA_ROOT.
+    """
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.media_override = override_settings(
+            MEDIA_ROOT=self.media_root,
+            CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+        self.media_override.enable()
+        self.user = User.objects.create_superuser(
+            'jacob', 'jacob@example.com', 'secret')
+        self.client = Client()
+        self.client.login(username='jacob', password='secret')
+
+    def tearDown(self):
+        self.media_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def run_commit_hooks(self):
+        """
+        Runs the functions waiting for the transaction to commit, which never
+        happens inside a TestCase.
+        """
+        connection.run_and_clear_commit_hooks()
 
-from .models import Location
 
 class SuperusreViews(TestCase):
 
@@ -157,3 +227,1401 @@ class SuperusreViews(TestCase):
         # delete album
         result = self.ajax_post(reverse('album_delete', args=[1, ]), {'submit': True})
         self.assertTrue('url' in result)
+
+
+class ThumbnailQueue(MediaTestCase):
+
+    def test_upload_queues_thumbnails(self):
+        """
+        Test the following thumbnail workflow:
+        - Upload photos, which only queues their thumbnails.
+        - The album shows placeholders until the thumbnails exist.
+        - Run the thumbnail worker.
+        - The status view and the album now return the thumbnails.
+        """
+        album = Album.objects.create(name='test album')
+        response = self.client.post(reverse('upload'), {
+            'album': album.pk,
+            'photos': [make_image('one.jpg'), make_image('two.jpg')]
+        })
+        self.assertRedirects(response, album.get_absolute_url())
+        photos = album.photo_set.all()
+        self.assertEqual(photos.count(), 2)
+        self.assertEqual(ThumbnailJob.objects.count(), 2)
+        for photo in photos:
+            self.assertFalse(photo.thumbnail_set.exists())
+
+        # placeholders until the worker has run
+        response = self.client.get(album.get_absolute_url())
+        self.assertContains(response, 'data-thumbnail=', count=2)
+
+        call_command('process_thumbnails', once=True, workers=1)
+        self.assertEqual(ThumbnailJob.objects.count(), 0)
+        for photo in photos:
+            self.assertEqual(photo.thumbnail_set.count(), 2)
+
+        # status polling returns the generated thumbnails
+        response = self.client.get(reverse('thumbnail_status'), {
+            'id': [photo.pk for photo in photos], 'size': '200x200-fit'})
+        result = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(result['pending'], [])
+        self.assertEqual(len(result['ready']), 2)
+
+        response = self.client.get(album.get_absolute_url())
+        self.assertNotContains(response, 'data-thumbnail=')
+
+    def test_failed_status(self):
+        """
+        Test that the status polling reports thumbnails that failed for good
+        as failed instead of pending.
+        """
+        album = Album.objects.create(name='test album')
+        photos = [Photo.objects.create(album=album, name=str(index),
+                                       file=make_image())
+                  for index in range(2)]
+        ThumbnailJob.objects.create(photo=photos[0], attempts=1)
+        ThumbnailJob.objects.create(
+            photo=photos[1], attempts=MAX_THUMBNAIL_ATTEMPTS)
+        response = self.client.get(reverse('thumbnail_status'), {
+            'id': [photo.pk for photo in photos], 'size': '200x200-fit'})
+        result = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(result['pending'], [photos[0].pk])
+        self.assertEqual(result['failed'], [photos[1].pk])
+
+    def test_render_thumbnails(self):
+        """
+        Test that every configured size is rendered from one decode with the
+        right dimensions.
+        """
+        album = Album.objects.create(name='test album')
+        photo = Photo.objects.create(
+            album=album, name='wide', file=make_image(size=(1600, 900)))
+        paths = render_thumbnails(photo.file)
+        self.assertEqual(sorted(paths), ['200x200-fit', '800x600-thumb'])
+        dimensions = dict(
+            (size, PILImage.open(photo.file.storage.path(path)).size)
+            for size, path in paths.items())
+        self.assertEqual(dimensions['800x600-thumb'], (800, 450))
+        self.assertEqual(dimensions['200x200-fit'], (200, 200))
+
+    def test_draft(self):
+        """
+        Test that a big JPEG is decoded at a reduced size that still leaves
+        DRAFT_OVERSAMPLE times the pixels of the largest thumbnail, and that
+        the thumbnails have the exact dimensions.
+        """
+        album = Album.objects.create(name='test album')
+        photo = Photo.objects.create(
+            album=album, name='big', file=make_image(size=(6400, 3600)))
+        path = photo.file.storage.path(photo.file.name)
+        pimage = open_image(path, get_size_profiles())
+        self.assertLess(pimage.size[0], 6400)
+        self.assertGreaterEqual(pimage.size[0], 800 * DRAFT_OVERSAMPLE)
+        self.assertGreaterEqual(pimage.size[1], 450 * DRAFT_OVERSAMPLE)
+        self.assertEqual(open_image(path, [], draft=False).size, (6400, 3600))
+
+        paths = render_thumbnails(photo.file)
+        dimensions = dict(
+            (size, PILImage.open(photo.file.storage.path(path)).size)
+            for size, path in paths.items())
+        self.assertEqual(dimensions['800x600-thumb'], (800, 450))
+        self.assertEqual(dimensions['200x200-fit'], (200, 200))
+
+    def test_album_thumbnail_queries(self):
+        """
+        Test that the album page resolves the thumbnails of all its photos in
+        a constant number of queries, whether or not they are generated.
+        """
+        album = Album.objects.create(name='test album')
+
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(album.get_absolute_url())
+            return len(queries)
+
+        Photo.objects.create(album=album, name='one', file=make_image())
+        missing_queries = count_queries()
+        call_command('process_thumbnails', once=True, workers=1)
+        ready_queries = count_queries()
+        for name in ('two', 'three', 'four'):
+            Photo.objects.create(album=album, name=name, file=make_image())
+        self.assertEqual(count_queries(), missing_queries)
+        call_command('process_thumbnails', once=True, workers=1)
+        self.assertEqual(count_queries(), ready_queries)
+
+
+class ListQueries(MediaTestCase):
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def add_album(self, name, location, person):
+        album = Album.objects.create(name=name, location=location)
+        for photo_name in ('b', 'a'):
+            photo = Photo.objects.create(
+                album=album, name=photo_name, file=make_image())
+            photo.people.add(person)
+            ThumbnailJob.objects.create(photo=photo)
+        return album
+
+    def test_list_queries(self):
+        """
+        Test that the album, location and person lists (and the albums of a
+        location) render with covers and counts in a constant number of
+        queries.
+        """
+        location = Location.objects.create(name='location')
+        person = Person.objects.create(name='person')
+        self.add_album('first', location, person)
+        call_command('process_thumbnails', once=True, workers=1)
+        urls = [reverse('albums'), reverse('locations'), reverse('people'),
+                location.get_absolute_url()]
+        queries = [self.count_queries(url) for url in urls]
+
+        for name in ('second', 'third'):
+            self.add_album(name, Location.objects.create(name=name), person)
+            Person.objects.create(name=name)
+        call_command('process_thumbnails', once=True, workers=1)
+        self.assertEqual([self.count_queries(url) for url in urls], queries)
+
+    def test_with_covers(self):
+        """
+        Test that with_covers annotates the thumbnail of the cover photo.
+        """
+        location = Location.objects.create(name='location')
+        person = Person.objects.create(name='person')
+        album = self.add_album('album', location, person)
+        call_command('process_thumbnails', once=True, workers=1)
+        call_command('recount', verbosity=0)
+        cover = album.photo_set.get(name='a')
+        thumbnail = cover.thumbnail_set.get(size='200x200-fit')
+
+        album = Album.objects.with_covers().get(pk=album.pk)
+        self.assertEqual(album.cover_photo_id, cover.pk)
+        self.assertEqual(album.cover_thumbnail, thumbnail.file.name)
+        self.assertEqual(album.photo_count, 2)
+
+        person = Person.objects.with_covers().get(pk=person.pk)
+        self.assertEqual(person.cover_photo_id, cover.pk)
+        self.assertEqual(person.photo_count, 2)
+
+        location = Location.objects.with_covers().get(pk=location.pk)
+        self.assertEqual(location.cover_thumbnail, thumbnail.file.name)
+        self.assertEqual(location.album_count, 1)
+
+
+class Counters(MediaTestCase):
+
+    def ajax_post(self, url, form_data):
+        response = self.client.post(
+            url, form_data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        return json.loads(response.content.decode("utf-8"))
+
+    def assertCounters(self, instance, photo_count, cover_photo):
+        instance = instance.__class__.objects.get(pk=instance.pk)
+        self.assertEqual(instance.photo_count, photo_count)
+        self.assertEqual(instance.cover_photo, cover_photo)
+
+    def test_counters(self):
+        """
+        Test that the photo counts and cover photos follow these changes:
+        - Upload photos.
+        - Tag a photo.
+        - Move a photo to another album.
+        - Delete a photo.
+        - Merge the albums.
+        - Recount after the counters drifted.
+        """
+        location = Location.objects.create(name='location')
+        person = Person.objects.create(name='person')
+        self.ajax_post(reverse('album_create'), {
+            'name': 'first', 'location': location.pk})
+        self.ajax_post(reverse('album_create'), {'name': 'second'})
+        first = Album.objects.get(name='first')
+        second = Album.objects.get(name='second')
+        self.assertEqual(Location.objects.get(pk=location.pk).album_count, 1)
+
+        # upload
+        self.client.post(reverse('upload'), {
+            'album': first.pk,
+            'photos': [make_image('b.jpg'), make_image('a.jpg'),
+                       make_image('c.jpg')]
+        })
+        a, b, c = first.photo_set.order_by('name')
+        self.assertCounters(first, 3, a)
+        self.assertCounters(location, 3, a)
+
+        # tag
+        self.ajax_post(reverse('photo_tag', args=[b.pk]),
+                       {'people': [person.pk]})
+        self.assertCounters(person, 1, b)
+
+        # move
+        self.ajax_post(reverse('photo_move', args=[a.pk]),
+                       {'album': second.pk})
+        self.assertCounters(first, 2, b)
+        self.assertCounters(second, 1, a)
+        self.assertCounters(location, 2, b)
+
+        # delete
+        self.ajax_post(reverse('photo_delete', args=[b.pk]), {'submit': True})
+        self.assertCounters(first, 1, c)
+        self.assertCounters(person, 0, None)
+        self.assertCounters(location, 1, c)
+
+        # merge
+        self.ajax_post(reverse('album_merge', args=[first.pk]),
+                       {'new_album': second.pk})
+        self.assertCounters(second, 2, a)
+        self.assertCounters(location, 0, None)
+        self.assertEqual(Location.objects.get(pk=location.pk).album_count, 0)
+
+        # recount
+        Album.objects.update(photo_count=10, cover_photo=None)
+        call_command('recount', verbosity=0)
+        self.assertCounters(second, 2, a)
+
+    def test_rename(self):
+        """
+        Test that renaming a photo or an album refreshes the covers, which
+        are the first photos by name.
+        """
+        location = Location.objects.create(name='location')
+        person = Person.objects.create(name='person')
+        self.ajax_post(reverse('album_create'), {
+            'name': 'b', 'location': location.pk})
+        self.ajax_post(reverse('album_create'), {
+            'name': 'c', 'location': location.pk})
+        first, second = Album.objects.order_by('name')
+        for album in (first, second):
+            self.client.post(reverse('upload'), {
+                'album': album.pk,
+                'photos': [make_image('a.jpg'), make_image('b.jpg')]
+            })
+        a, b = first.photo_set.order_by('name')
+        a.people.add(person)
+        b.people.add(person)
+        self.assertCounters(first, 2, a)
+        self.assertCounters(person, 2, a)
+        self.assertCounters(location, 4, a)
+
+        self.ajax_post(reverse('photo_rename', args=[a.pk]), {'name': 'z'})
+        self.assertCounters(first, 2, b)
+        self.assertCounters(person, 2, b)
+        self.assertCounters(location, 4, b)
+
+        self.ajax_post(reverse('album_edit', args=[first.pk]), {
+            'name': 'd', 'location': location.pk})
+        self.assertCounters(location, 4, second.photo_set.get(name='a'))
+
+    def test_untag(self):
+        """
+        Test that only the people a photo is really tagged with are counted
+        down when they are removed from it, from either side.
+        """
+        tagged = Person.objects.create(name='tagged')
+        untagged = Person.objects.create(name='untagged')
+        album = Album.objects.create(name='album')
+        self.client.post(reverse('upload'), {
+            'album': album.pk,
+            'photos': [make_image('a.jpg'), make_image('b.jpg')]
+        })
+        a, b = album.photo_set.order_by('name')
+        a.people.add(tagged)
+        self.assertCounters(tagged, 1, a)
+
+        a.people.remove(tagged, untagged)
+        self.assertCounters(tagged, 0, None)
+        self.assertCounters(untagged, 0, None)
+
+        b.people.add(tagged)
+        tagged.photo_set.remove(a, b)
+        self.assertCounters(tagged, 0, None)
+
+
+class PhotoNavigation(MediaTestCase):
+
+    def test_neighbours(self):
+        """
+        Test that the photo page finds its neighbours and position by
+        (name, id), including photos that share a name or have none.
+        """
+        album = Album.objects.create(name='album')
+        photos = [Photo.objects.create(album=album, name=name,
+                                       file=make_image())
+                  for name in ('c', 'b', 'a', 'b')]
+        photos.append(Photo.objects.create(album=album, file=make_image()))
+        update_photo_counts(len(photos), albums=[album.pk])
+        ordered = sorted(photos, key=lambda photo: (photo.name, photo.pk))
+        for index, photo in enumerate(ordered):
+            paginator = self.client.get(
+                photo.get_absolute_url()).context['paginator']
+            self.assertEqual(paginator['index'], index + 1)
+            self.assertEqual(paginator['count'], len(photos))
+            self.assertEqual(paginator['has_previous'], index > 0)
+            self.assertEqual(paginator['has_next'], index < len(photos) - 1)
+            if index > 0:
+                self.assertEqual(paginator['previous_url'],
+                                 ordered[index - 1].get_absolute_url())
+            if index < len(photos) - 1:
+                self.assertEqual(paginator['next_url'],
+                                 ordered[index + 1].get_absolute_url())
+
+    @override_settings(PHOTOS_PER_PAGE=2)
+    def test_keyset_pages(self):
+        """
+        Test that the album pages can be walked forwards and backwards with
+        the keyset cursors.
+        """
+        album = Album.objects.create(name='album')
+        for name in ('e', 'd', 'c', 'b', 'a'):
+            Photo.objects.create(album=album, name=name, file=make_image())
+        update_photo_counts(5, albums=[album.pk])
+
+        def get_page(url):
+            response = self.client.get(url)
+            paginator = response.context['paginator']
+            names = [photo.name for photo in response.context['photo_list']]
+            return paginator, names
+
+        pages = []
+        paginator, names = get_page(album.get_absolute_url())
+        self.assertIsNone(paginator.previous_url)
+        while True:
+            pages.append((names, paginator.this_page.start_index(),
+                          paginator.this_page.end_index()))
+            if not paginator.next_url:
+                break
+            paginator, names = get_page(paginator.next_url)
+        self.assertEqual(pages, [(['a', 'b'], 1, 2), (['c', 'd'], 3, 4),
+                                 (['e'], 5, 5)])
+        self.assertEqual(paginator.count, 5)
+
+        paginator, names = get_page(paginator.previous_url)
+        self.assertEqual(names, ['c', 'd'])
+        self.assertEqual(paginator.this_page.start_index(), 3)
+        paginator, names = get_page(paginator.previous_url)
+        self.assertEqual(names, ['a', 'b'])
+        self.assertIsNone(paginator.previous_url)
+
+
+class AlbumDownload(MediaTestCase):
+
+    def get_archive(self, album):
+        response = self.client.get(reverse('album_download', args=[album.pk]))
+        content = b''.join(response.streaming_content)
+        self.assertEqual(int(response['Content-Length']), len(content))
+        archive = zipfile.ZipFile(io.BytesIO(content))
+        self.assertIsNone(archive.testzip())
+        return archive
+
+    def test_download(self):
+        """
+        Test that the album is streamed as a valid zip archive of the
+        original files, with the length known up front.
+        """
+        album = Album.objects.create(name='album')
+        photos = [Photo.objects.create(album=album, name=name,
+                                       file=make_image(name + '.jpg'))
+                  for name in ('one', 'two')]
+        archive = self.get_archive(album)
+        self.assertEqual(
+            sorted(archive.namelist()),
+            sorted(photo.file.name.split('/')[-1] for photo in photos))
+        for photo in photos:
+            with open(photo.file.path, 'rb') as file_handle:
+                self.assertEqual(
+                    archive.read(photo.file.name.split('/')[-1]),
+                    file_handle.read())
+
+    def test_download_zip64(self):
+        """
+        Test the zip64 records by pretending that the photos are too big for
+        a regular zip archive.
+        """
+        album = Album.objects.create(name='album')
+        for name in ('one', 'two', 'three'):
+            Photo.objects.create(album=album, name=name,
+                                 file=make_image(name + '.jpg'))
+        with mock.patch('utils.zipstream.ZIP64_LIMIT', 100):
+            archive = self.get_archive(album)
+        self.assertEqual(len(archive.namelist()), 3)
+
+
+class PhotoDownload(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        album = Album.objects.create(name='album')
+        self.photo = Photo.objects.create(album=album, name='photo',
+                                          file=make_image())
+        self.url = reverse('photo_download', args=[self.photo.pk])
+        with open(self.photo.file.path, 'rb') as file_handle:
+            self.data = file_handle.read()
+
+    def test_download(self):
+        """
+        Test whole, partial and conditional downloads.
+        """
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.data)
+        self.assertEqual(int(response['Content-Length']), len(self.data))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        etag = response['ETag']
+
+        # resuming a download
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content),
+                         self.data[100:])
+        self.assertEqual(response['Content-Range'], 'bytes 100-%d/%d' % (
+            len(self.data) - 1, len(self.data)))
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-10',
+                                   HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content),
+                         self.data[-10:])
+
+        # the file changed since the first part was downloaded
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-',
+                                   HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.data)
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=%d-' % len(
+            self.data))
+        self.assertEqual(response.status_code, 416)
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(
+            self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_offload(self):
+        """
+        Test that the web server is told to send the file when
+        SENDFILE_BACKEND is set.
+        """
+        with self.settings(SENDFILE_BACKEND='x-accel-redirect',
+                           SENDFILE_URL='/protected/media/'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'],
+                         '/protected/media/' + self.photo.file.name)
+        self.assertEqual(response.content, b'')
+        with self.settings(SENDFILE_BACKEND='x-sendfile'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Sendfile'], self.photo.file.path)
+
+
+class Search(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.location = Location.objects.create(name='Zürich')
+        self.album = Album.objects.create(name='Summer holiday',
+                                          location=self.location)
+        self.person = Person.objects.create(name='Jacob')
+        self.beach = Photo.objects.create(album=self.album, name='Beach',
+                                          file=make_image())
+        self.lake = Photo.objects.create(album=self.album, name='Lake',
+                                         file=make_image())
+
+    def search(self, text):
+        return [photo.name for photo in
+                search_photos(Photo.objects.all(), text)]
+
+    def check_index(self):
+        """
+        Test searching every part of the search documents and keeping them
+        in sync.
+        """
+        self.assertEqual(self.search('beach'), ['Beach'])
+        self.assertEqual(self.search('bea'), ['Beach'])
+        self.assertEqual(self.search('holiday'), ['Beach', 'Lake'])
+        self.assertEqual(self.search('zurich'), ['Beach', 'Lake'])
+        self.assertEqual(self.search('summer lake'), ['Lake'])
+        self.assertEqual(self.search('"*'), [])
+
+        self.lake.people.add(self.person)
+        self.assertEqual(self.search('jacob'), ['Lake'])
+        self.person.photo_set.add(self.beach)
+        self.assertEqual(self.search('jacob'), ['Beach', 'Lake'])
+        self.person.photo_set.clear()
+        self.assertEqual(self.search('jacob'), [])
+
+        # a photo named after the search ranks above the album's photos
+        Photo.objects.create(album=self.album, name='Holiday',
+                             file=make_image())
+        self.assertEqual(self.search('holiday'), ['Holiday', 'Beach', 'Lake'])
+
+        self.lake.name = 'Mountain'
+        self.lake.save()
+        self.assertEqual(self.search('lake'), [])
+        self.location.name = 'Bern'
+        self.location.save()
+        self.assertEqual(self.search('zurich'), [])
+        self.assertEqual(len(self.search('bern')), 3)
+
+        other_album = Album.objects.create(name='Winter')
+        form = AlbumMergeForm({'new_album': other_album.pk},
+                              instance=self.album)
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertEqual(self.search('summer'), [])
+        self.assertEqual(len(self.search('winter')), 3)
+
+        self.beach.delete()
+        self.assertEqual(self.search('beach'), [])
+
+    def test_fts(self):
+        self.assertTrue(use_fts())
+        self.check_index()
+
+    def test_search_terms(self):
+        with mock.patch('photos.search.use_fts', return_value=False):
+            rebuild_index()
+            self.check_index()
+        self.assertFalse(SearchTerm.objects.filter(photo=self.beach).exists())
+
+    def test_search_terms_wildcards(self):
+        """
+        Test that underscores in the words aren't wildcards when ranking.
+        """
+        with mock.patch('photos.search.use_fts', return_value=False):
+            Photo.objects.create(album=self.album, name='a_b',
+                                 file=make_image())
+            Photo.objects.create(album=self.album, name='a_b axb',
+                                 file=make_image())
+            ranks = set(photo.search_rank for photo in
+                        search_photos(Photo.objects.all(), 'a_b'))
+        self.assertEqual(len(ranks), 1)
+
+    def test_results(self):
+        """
+        Test that the results and the photo pages reached from them follow
+        the ranking.
+        """
+        Photo.objects.create(album=self.album, name='Holiday',
+                             file=make_image())
+        query = 'q=holiday'
+        response = self.client.get(reverse('results', args=[query]))
+        ordered = response.context['photo_list']
+        self.assertEqual([photo.name for photo in ordered],
+                         ['Holiday', 'Beach', 'Lake'])
+        paginator = self.client.get(reverse('photo', kwargs={
+            'pk': ordered[0].pk, 'query': query})).context['paginator']
+        self.assertEqual(paginator['index'], 1)
+        self.assertEqual(paginator['count'], 3)
+        self.assertEqual(paginator['next_url'], reverse('photo', kwargs={
+            'pk': ordered[1].pk, 'query': query}))
+
+    def test_result_cache(self):
+        """
+        Test that equivalent queries share one deduplicated, cached result
+        set that expires when the photos change.
+        """
+        other = Person.objects.create(name='Adrian')
+        self.beach.people.add(self.person, other)
+        self.assertEqual(normalize_query('q=Holiday!!&p=%s&p=%s&p=x&p=%s' % (
+            other.pk, self.person.pk, other.pk)),
+            'p=%s&p=%s&q=holiday' % tuple(sorted([other.pk, self.person.pk])))
+
+        query = 'p=%s&p=%s' % (self.person.pk, other.pk)
+        self.assertEqual(list(get_result_ids(query)), [self.beach.pk])
+        with self.assertNumQueries(0):
+            get_result_ids('p=%s&p=%s&p=' % (other.pk, self.person.pk))
+
+        self.lake.people.add(other)
+        self.assertEqual(list(get_result_ids(query)),
+                         [self.beach.pk, self.lake.pk])
+
+        response = self.client.post(reverse('search'), {
+            'q': 'Summer  Holiday', 'csrfmiddlewaretoken': 'token'})
+        self.assertRedirects(response, reverse('results', args=[
+            'q=summer+holiday']))
+        response = self.client.get(response['Location'])
+        self.assertEqual(len(response.context['photo_list']), 2)
+
+    def test_facets(self):
+        """
+        Test the facet counts of search results and narrowing by them.
+        """
+        self.album.year = 2014
+        self.album.save()
+        other_album = Album.objects.create(name='Summer camp', year=2013)
+        Photo.objects.create(album=other_album, name='Tent',
+                             file=make_image())
+        other = Person.objects.create(name='Adrian')
+        self.beach.people.add(self.person, other)
+        self.lake.people.add(self.person)
+
+        facets = get_facets('q=summer')
+        self.assertEqual(facets['a'], [(self.album.pk, 'Summer holiday', 2),
+                                       (other_album.pk, 'Summer camp', 1)])
+        self.assertEqual(facets['l'], [(self.location.pk, 'Zürich', 2)])
+        self.assertEqual(facets['y'], [(2014, '2014', 2), (2013, '2013', 1)])
+        self.assertEqual(facets['p'], [(self.person.pk, 'Jacob', 2),
+                                       (other.pk, 'Adrian', 1)])
+
+        # people facets count everyone tagged in the photos of a person
+        facets = get_facets('p=%s' % other.pk)
+        self.assertEqual(facets['p'], [(other.pk, 'Adrian', 1),
+                                       (self.person.pk, 'Jacob', 1)])
+
+        response = self.client.get(reverse('results', args=['q=summer']))
+        years = response.context['facet_list'][3]
+        self.assertEqual(years['values'][1]['url'], reverse(
+            'results', args=['y=2013&q=summer']))
+        response = self.client.get(years['values'][1]['url'])
+        self.assertEqual([photo.name for photo in
+                          response.context['photo_list']], ['Tent'])
+
+
+class ZipUpload(MediaTestCase):
+
+    def make_zip(self, names):
+        output = io.BytesIO()
+        with zipfile.ZipFile(output, 'w') as archive:
+            for name in names:
+                if name.endswith('.jpg'):
+                    archive.writestr(name, make_image(name).read())
+                else:
+                    archive.writestr(name, b'not a photo')
+        return output.getvalue()
+
+    def test_upload(self):
+        """
+        Test that the photos in an uploaded zip file are added to the album
+        and their thumbnails queued, skipping everything else.
+        """
+        album = Album.objects.create(name='album')
+        data = self.make_zip([
+            'one.jpg', 'folder/two.jpg', 'folder/', 'notes.txt',
+            'nested.zip', '__MACOSX/folder/._two.jpg', '.hidden.jpg'])
+        response = self.client.post(reverse('upload'), {
+            'album': album.pk,
+            'photos': [SimpleUploadedFile('photos.zip', data),
+                       make_image('three.jpg')]
+        })
+        self.assertRedirects(response, album.get_absolute_url())
+        self.assertEqual(
+            sorted(album.photo_set.values_list('name', flat=True)),
+            ['one', 'three', 'two'])
+        self.assertEqual(ThumbnailJob.objects.count(), 3)
+        self.assertEqual(Album.objects.get(pk=album.pk).photo_count, 3)
+        photo = album.photo_set.get(name='two')
+        with open(photo.file.path, 'rb') as file_handle:
+            self.assertEqual(PILImage.open(file_handle).size, (640, 480))
+
+        response = self.client.post(reverse('upload'), {
+            'album': album.pk,
+            'photos': [SimpleUploadedFile('broken.zip', b'not a zip')]
+        })
+        self.assertFormError(response, 'form', 'photos', [
+            'The following files are not valid zip files: broken.zip'])
+
+    def test_command(self):
+        album = Album.objects.create(name='album')
+        path = os.path.join(self.media_root, 'photos.zip')
+        with open(path, 'wb') as file_handle:
+            file_handle.write(self.make_zip(['one.jpg', 'two.jpg']))
+        output = io.StringIO()
+        call_command('import_zip', str(album.pk), path, verbosity=2,
+                     stdout=output)
+        self.assertEqual(output.getvalue().splitlines(), [
+            '[1/2] one.jpg', '[2/2] two.jpg', 'Added 2 photos to "album".'])
+        self.assertEqual(Album.objects.get(pk=album.pk).photo_count, 2)
+
+
+@override_settings(UPLOAD_CHUNK_SIZE=500)
+class ChunkedUpload(MediaTestCase):
+
+    def send_chunk(self, session, index, data, checksum=None):
+        if checksum is None:
+            checksum = hashlib.sha256(data).hexdigest()
+        return self.client.post(
+            reverse('upload_chunk', args=[session['id'], index]), data,
+            content_type='application/octet-stream', HTTP_X_CHECKSUM=checksum)
+
+    def test_upload(self):
+        """
+        Test uploading a photo in chunks out of order, with a failed chunk
+        and a resumed session.
+        """
+        album = Album.objects.create(name='album')
+        data = make_image(size=(200, 200)).read()
+        chunks = [data[start:start + 500]
+                  for start in range(0, len(data), 500)]
+        self.assertGreater(len(chunks), 2)
+        start = {'album': album.pk, 'filename': 'My_Photo.jpg',
+                 'size': len(data), 'key': 'my-photo'}
+
+        session = json.loads(self.client.post(reverse(
+            'upload_session_create'), start).content.decode('utf-8'))
+        self.assertEqual(session['chunk_count'], len(chunks))
+        self.assertEqual(session['received'], [])
+
+        response = self.send_chunk(session, 1, chunks[1], checksum='0' * 64)
+        self.assertEqual(response.status_code, 400)
+        response = self.send_chunk(session, 1, chunks[1][:-1])
+        self.assertEqual(response.status_code, 400)
+        response = self.send_chunk(session, 1, chunks[1] + b'0')
+        self.assertEqual(response.status_code, 413)
+        for index in reversed(range(1, len(chunks))):
+            self.assertEqual(
+                self.send_chunk(session, index, chunks[index]).status_code,
+                200)
+        self.send_chunk(session, 1, chunks[1])
+        self.assertFalse(album.photo_set.exists())
+
+        # resuming returns the same session and the chunks it already has
+        resumed = json.loads(self.client.post(reverse(
+            'upload_session_create'), start).content.decode('utf-8'))
+        self.assertEqual(resumed['id'], session['id'])
+        self.assertEqual(sorted(resumed['received']),
+                         list(range(1, len(chunks))))
+
+        result = json.loads(self.send_chunk(
+            session, 0, chunks[0]).content.decode('utf-8'))
+        self.assertTrue(result['complete'])
+        photo = album.photo_set.get()
+        self.assertEqual(result['photo'], photo.get_absolute_url())
+        self.assertEqual(photo.name, 'My Photo')
+        with open(photo.file.path, 'rb') as file_handle:
+            self.assertEqual(file_handle.read(), data)
+        self.assertTrue(ThumbnailJob.objects.filter(photo=photo).exists())
+        self.assertEqual(Album.objects.get(pk=album.pk).photo_count, 1)
+        self.assertEqual(str(Action.objects.get().target), 'album')
+
+        response = self.client.post(reverse('upload_session_create'),
+                                    dict(start, filename='notes.txt'))
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(reverse('upload_session_create'),
+                                    dict(start, size=10 ** 12))
+        self.assertEqual(response.status_code, 400)
+
+    def test_retry_finish(self):
+        """
+        Test that an upload whose photo can't be created isn't left
+        completed, so resending a chunk finishes it.
+        """
+        album = Album.objects.create(name='album')
+        data = make_image(size=(200, 200)).read()
+        session = json.loads(self.client.post(reverse(
+            'upload_session_create'), {
+                'album': album.pk, 'filename': 'photo.jpg',
+                'size': len(data), 'key': 'photo'}).content.decode('utf-8'))
+        chunks = [data[start:start + 500]
+                  for start in range(0, len(data), 500)]
+        for index in range(1, len(chunks)):
+            self.send_chunk(session, index, chunks[index])
+        with mock.patch('photos.uploads.create_photo', side_effect=IOError):
+            self.assertRaises(IOError, self.send_chunk, session, 0, chunks[0])
+        self.assertIsNone(UploadSession.objects.get().completed)
+        self.assertFalse(album.photo_set.exists())
+
+        result = json.loads(self.send_chunk(
+            session, 0, chunks[0]).content.decode('utf-8'))
+        self.assertTrue(result['complete'])
+        self.assertEqual(UploadSession.objects.get().photo,
+                         album.photo_set.get())
+
+    def test_clean_uploads(self):
+        album = Album.objects.create(name='album')
+        self.client.post(reverse('upload_session_create'), {
+            'album': album.pk, 'filename': 'photo.jpg', 'size': 5000,
+            'key': 'photo'})
+        session = UploadSession.objects.get()
+        path = Photo._meta.get_field('file').storage.path(session.file)
+        self.assertEqual(os.path.getsize(path), 5000)
+        call_command('clean_uploads', hours=0, verbosity=0)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertFalse(os.path.exists(path))
+
+
+class Duplicates(MediaTestCase):
+
+    def upload(self, album, *files):
+        self.client.post(reverse('upload'), {
+            'album': album.pk, 'photos': list(files)})
+
+    def test_reuse(self):
+        """
+        Test that a copy of a photo shares the file and thumbnails of the
+        original, and that the file is only deleted with its last photo.
+        """
+        album = Album.objects.create(name='album')
+        self.upload(album, make_image('original.jpg'))
+        original = album.photo_set.get()
+        self.assertEqual(len(original.sha256), 64)
+        call_command('process_thumbnails', once=True, workers=1)
+
+        self.upload(album, make_image('copy.jpg'),
+                    make_image('other.jpg', color='blue'))
+        copy = album.photo_set.get(name='copy')
+        other = album.photo_set.get(name='other')
+        self.assertEqual(copy.sha256, original.sha256)
+        self.assertEqual(copy.file.name, original.file.name)
+        self.assertNotEqual(other.file.name, original.file.name)
+        self.assertEqual(
+            sorted(copy.thumbnail_set.values_list('file', flat=True)),
+            sorted(original.thumbnail_set.values_list('file', flat=True)))
+        self.assertEqual(
+            list(ThumbnailJob.objects.values_list('photo', flat=True)),
+            [other.pk])
+        self.assertEqual(Album.objects.get(pk=album.pk).photo_count, 3)
+
+        path = original.file.path
+        thumbnail_paths = [thumbnail.file.path
+                           for thumbnail in original.thumbnail_set.all()]
+        original.delete()
+        self.run_commit_hooks()
+        self.assertTrue(os.path.exists(path))
+        for thumbnail_path in thumbnail_paths:
+            self.assertTrue(os.path.exists(thumbnail_path))
+        copy.delete()
+        self.assertTrue(os.path.exists(path))
+        self.run_commit_hooks()
+        self.assertFalse(os.path.exists(path))
+        for thumbnail_path in thumbnail_paths:
+            self.assertFalse(os.path.exists(thumbnail_path))
+
+    def test_delete_sharers(self):
+        """
+        Test that deleting every photo that shares a file at once deletes
+        the file.
+        """
+        album = Album.objects.create(name='album')
+        self.upload(album, make_image('original.jpg'))
+        self.upload(album, make_image('copy.jpg'))
+        name = album.photo_set.first().file.name
+        path = album.photo_set.first().file.path
+        self.assertEqual(album.photo_set.filter(file=name).count(), 2)
+        album.photo_set.all().delete()
+        self.run_commit_hooks()
+        self.assertFalse(os.path.exists(path))
+
+    def test_rotate_copy(self):
+        album = Album.objects.create(name='album')
+        self.upload(album, make_image('original.jpg', size=(60, 40)),
+                    make_image('copy.jpg', size=(60, 40)))
+        original, copy = album.photo_set.order_by('pk')
+        self.assertEqual(copy.file.name, original.file.name)
+        self.client.post(reverse('photo_rotate', args=[copy.pk]), {'x': 1},
+                         HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        copy = Photo.objects.get(pk=copy.pk)
+        self.assertNotEqual(copy.file.name, original.file.name)
+        self.assertNotEqual(copy.sha256, original.sha256)
+        with open(original.file.path, 'rb') as file_handle:
+            self.assertEqual(hashlib.sha256(file_handle.read()).hexdigest(),
+                             original.sha256)
+
+    @override_settings(REUSE_DUPLICATE_FILES=False)
+    def test_no_reuse(self):
+        album = Album.objects.create(name='album')
+        self.upload(album, make_image('original.jpg'), make_image('copy.jpg'))
+        original, copy = album.photo_set.order_by('pk')
+        self.assertEqual(copy.sha256, original.sha256)
+        self.assertNotEqual(copy.file.name, original.file.name)
+
+    def test_hash_photos(self):
+        album = Album.objects.create(name='album')
+        photo = Photo.objects.create(
+            album=album, name='photo', file=make_image())
+        broken = Photo.objects.create(
+            album=album, name='broken', file=SimpleUploadedFile(
+                'broken.jpg', b'not an image'))
+        missing = Photo.objects.create(
+            album=album, name='missing', file='photos/missing.jpg')
+        last = Photo.objects.create(
+            album=album, name='last', file=make_image(color='blue'))
+        with mock.patch('logging.error') as log_error:
+            call_command('hash_photos', verbosity=0, batch_size=2)
+        self.assertEqual(log_error.call_count, 2)
+        with open(photo.file.path, 'rb') as file_handle:
+            self.assertEqual(Photo.objects.get(pk=photo.pk).sha256,
+                             hashlib.sha256(file_handle.read()).hexdigest())
+        self.assertIsNone(Photo.objects.get(pk=broken.pk).dhash)
+        self.assertIsNone(Photo.objects.get(pk=missing.pk).sha256)
+        self.assertIsNotNone(Photo.objects.get(pk=last.pk).dhash)
+
+
+def make_pattern(size=(640, 480), quality=90):
+    """
+    Returns an uploadable JPEG of a pattern that still looks the same when it
+    is resized.
+    """
+    pimage = PILImage.new('RGB', (64, 48), 'white')
+    draw = ImageDraw.Draw(pimage)
+    for index in range(6):
+        draw.rectangle([index * 10, index * 4, index * 10 + 12, 47],
+                       fill=(index * 40, 100, 255 - index * 40))
+    output = io.BytesIO()
+    pimage.resize(size, PILImage.BILINEAR).save(output, 'JPEG',
+                                                quality=quality)
+    return SimpleUploadedFile('pattern.jpg', output.getvalue(), 'image/jpeg')
+
+
+class NearDuplicates(MediaTestCase):
+
+    def test_find_clusters(self):
+        """
+        Test that the multi-index hash table finds the same pairs as comparing
+        every pair of hashes.
+        """
+        random = Random(7)
+        centers = [random.getrandbits(64) for index in range(20)]
+        hashes = []
+        for pk in range(1, 201):
+            value = random.choice(centers)
+            for bit in random.sample(range(64), random.randint(0, 3)):
+                value ^= 1 << bit
+            hashes.append((pk, value - (1 << 64) if value >> 63 else value))
+        expected = {}
+        for pk, value in hashes:
+            expected[pk] = set(
+                other_pk for other_pk, other in hashes
+                if bin((value ^ other) & HASH_MASK).count('1') <= 3)
+        for cluster in find_clusters(hashes, 3):
+            for pk in cluster:
+                self.assertTrue(expected[pk] <= set(cluster))
+        clustered = set(pk for cluster in find_clusters(hashes, 3)
+                        for pk in cluster)
+        self.assertEqual(clustered, set(
+            pk for pk, neighbours in expected.items() if len(neighbours) > 1))
+        self.assertEqual(find_clusters([(1, 0), (2, 0b111)], 2), [])
+        self.assertEqual(find_clusters([(1, 0), (2, 0b11), (3, 0b1111)], 2),
+                         [[1, 2, 3]])
+
+    def test_duplicates(self):
+        """
+        Test that resized and re-encoded copies of a photo are found once the
+        thumbnail worker has hashed them.
+        """
+        album = Album.objects.create(name='album')
+        other_album = Album.objects.create(name='other album')
+        original = Photo.objects.create(
+            album=album, name='original', file=make_pattern())
+        resized = Photo.objects.create(
+            album=album, name='resized',
+            file=make_pattern(size=(320, 240), quality=60))
+        Photo.objects.create(album=album, name='other', file=make_image())
+        copy = Photo.objects.create(
+            album=other_album, name='copy', file=make_pattern(size=(800, 600)))
+        for photo in Photo.objects.all():
+            ThumbnailJob.objects.create(photo=photo)
+        call_command('process_thumbnails', once=True, workers=1)
+        self.assertFalse(Photo.objects.filter(dhash__isnull=True).exists())
+
+        self.assertEqual(find_near_duplicates(album),
+                         [[original.pk, resized.pk]])
+        self.assertEqual(find_near_duplicates(),
+                         [[original.pk, resized.pk, copy.pk]])
+
+        response = self.client.get(reverse('album_duplicates',
+                                           args=[album.pk]))
+        self.assertEqual(
+            [[photo.pk for photo in photo_list]
+             for photo_list in response.context['cluster_list']],
+            [[original.pk, resized.pk]])
+        self.assertContains(response, original.file_200x200.url)
+
+        output = io.StringIO()
+        call_command('find_duplicates', stdout=output)
+        self.assertIn('original (%s), resized (%s), copy (%s)' % (
+            original.pk, resized.pk, copy.pk), output.getvalue())
+
+        # backfill the hashes of photos from before they were hashed
+        Photo.objects.update(dhash=None)
+        call_command('hash_photos', verbosity=0)
+        self.assertEqual(find_near_duplicates(album),
+                         [[original.pk, resized.pk]])
+
+
+def make_exif_image(name='photo.jpg', taken='2014:07:01 12:30:00',
+                    model='Canon EOS 5D'):
+    """
+    Returns an uploadable JPEG file with EXIF data.
+    """
+    exif = PILImage.Exif()
+    exif[271] = 'Canon'
+    exif[272] = model
+    exif[274] = 6
+    exif[36867] = taken
+    exif[34855] = 400
+    exif[33434] = IFDRational(1, 250)
+    exif[33437] = IFDRational(28, 10)
+    exif[37386] = IFDRational(50, 1)
+    exif[34853] = {
+        1: 'N', 2: (IFDRational(47), IFDRational(22), IFDRational(30)),
+        3: 'W', 4: (IFDRational(8), IFDRational(30), IFDRational(0))}
+    output = io.BytesIO()
+    PILImage.new('RGB', (64, 48), 'red').save(
+        output, 'JPEG', exif=exif.tobytes())
+    return SimpleUploadedFile(name, output.getvalue(), 'image/jpeg')
+
+
+class Exif(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.album = Album.objects.create(name='album')
+
+    def upload(self, *files):
+        self.client.post(reverse('upload'), {
+            'album': self.album.pk, 'photos': list(files)})
+
+    def test_upload(self):
+        self.upload(make_exif_image(), make_image('plain.jpg'))
+        photo = self.album.photo_set.get(name='photo')
+        self.assertEqual(
+            timezone.localtime(photo.exif_taken).replace(tzinfo=None),
+            datetime.datetime(2014, 7, 1, 12, 30))
+        self.assertEqual((photo.exif_make, photo.exif_model),
+                         ('Canon', 'Canon EOS 5D'))
+        self.assertEqual(photo.exif_iso, 400)
+        self.assertEqual(photo.exif_exposure, '1/250')
+        self.assertEqual(photo.exif_fnumber, 2.8)
+        self.assertEqual(photo.exif_focal, 50)
+        self.assertEqual(photo.exif_orientation, 6)
+        self.assertAlmostEqual(photo.exif_latitude, 47.375)
+        self.assertAlmostEqual(photo.exif_longitude, -8.5)
+        response = self.client.get(photo.get_absolute_url())
+        self.assertContains(response, '<span>ISO 400</span>')
+
+        plain = self.album.photo_set.get(name='plain')
+        self.assertEqual(plain.exif_orientation, 1)
+        self.assertIsNone(plain.exif_taken)
+
+    def test_dst_change(self):
+        """
+        Test that times skipped or repeated when the clocks change are read
+        as standard time instead of failing the upload.
+        """
+        self.upload(make_exif_image('gap.jpg', taken='2014:03:09 02:30:00'),
+                    make_exif_image('overlap.jpg',
+                                    taken='2014:11:02 01:30:00'))
+        self.assertEqual(self.album.photo_set.get(name='gap').exif_taken,
+                         datetime.datetime(2014, 3, 9, 7, 30,
+                                           tzinfo=timezone.utc))
+        self.assertEqual(self.album.photo_set.get(name='overlap').exif_taken,
+                         datetime.datetime(2014, 11, 2, 6, 30,
+                                           tzinfo=timezone.utc))
+
+    def test_extract_exif(self):
+        photo = Photo.objects.create(
+            album=self.album, name='photo', file=make_exif_image())
+        self.assertIsNone(photo.exif_orientation)
+        call_command('extract_exif', workers=1, verbosity=0)
+        photo = Photo.objects.get(pk=photo.pk)
+        self.assertEqual(photo.exif_model, 'Canon EOS 5D')
+        self.assertEqual(photo.exif_orientation, 6)
+
+    def test_search(self):
+        """
+        Test sorting search results by the date taken and filtering them by
+        camera.
+        """
+        self.upload(
+            make_exif_image('b.jpg', taken='2014:07:03 10:00:00'),
+            make_exif_image('c.jpg', taken='2014:07:01 10:00:00',
+                            model='DMC-FZ1000 v1.0'),
+            make_image('a.jpg'))
+
+        def names(query):
+            return [Photo.objects.get(pk=pk).name
+                    for pk in get_result_ids(query)]
+
+        self.assertEqual(names('a=%s' % self.album.pk), ['a', 'b', 'c'])
+        self.assertEqual(names('a=%s&o=taken' % self.album.pk),
+                         ['c', 'b', 'a'])
+        self.assertEqual(names('c=Canon+EOS+5D'), ['b'])
+        self.assertEqual(get_facets('a=%s' % self.album.pk)['c'], [
+            ('Canon EOS 5D', 'Canon EOS 5D', 1),
+            ('DMC-FZ1000 v1.0', 'DMC-FZ1000 v1.0', 1)])
+
+        response = self.client.get(self.album.get_absolute_url())
+        url = reverse('results', args=['a=%s&o=taken' % self.album.pk])
+        self.assertContains(response, url)
+        response = self.client.get(url)
+        cameras = response.context['facet_list'][-1]
+        response = self.client.get(cameras['values'][1]['url'])
+        self.assertEqual([photo.name for photo in
+                          response.context['photo_list']], ['c'])
+
+
+@override_settings(JPEGTRAN=None)
+class Rotate(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.album = Album.objects.create(name='album')
+
+    def rotate(self, photo):
+        response = self.client.post(
+            reverse('photo_rotate', args=[photo.pk]), {'x': 1},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_orientations(self):
+        self.assertEqual(combine_orientations(1, ROTATE_CLOCKWISE), 6)
+        self.assertEqual(combine_orientations(6, ROTATE_CLOCKWISE), 3)
+        self.assertEqual(combine_orientations(8, ROTATE_CLOCKWISE), 1)
+        # mirrored orientations stay mirrored
+        self.assertEqual(combine_orientations(2, ROTATE_CLOCKWISE), 7)
+        orientation = 5
+        for turn in range(4):
+            orientation = combine_orientations(orientation, ROTATE_CLOCKWISE)
+        self.assertEqual(orientation, 5)
+
+    def test_rotate_jpeg(self):
+        """
+        Test that rotating a JPEG only changes its orientation and renders
+        its thumbnails again under new names.
+        """
+        photo = Photo.objects.create(
+            album=self.album, name='photo', file=make_image(size=(60, 40)))
+        with open(photo.file.path, 'rb') as file_handle:
+            original = file_handle.read()
+        photo.thumbnail('800x600-thumb')
+        call_command('process_thumbnails', once=True, workers=1)
+        old_thumbnail = photo.thumbnail_set.get(size='800x600-thumb')
+        old_path = old_thumbnail.file.path
+
+        result = self.rotate(photo)
+        photo = Photo.objects.get(pk=photo.pk)
+        self.assertEqual(photo.version, 1)
+        self.assertEqual(photo.exif_orientation, 6)
+        thumbnail = photo.thumbnail_set.get(size='800x600-thumb')
+        self.assertEqual(result['thumbnail'], thumbnail.file.url)
+        self.assertIn('-800x600-thumb-v1.jpg', thumbnail.file.name)
+        self.run_commit_hooks()
+        self.assertFalse(os.path.exists(old_path))
+        self.assertEqual(PILImage.open(thumbnail.file.path).size, (40, 60))
+        self.assertEqual(photo.thumbnail_set.count(), 2)
+        # the image data is untouched, only an orientation was added
+        with open(photo.file.path, 'rb') as file_handle:
+            rotated = file_handle.read()
+        self.assertEqual(rotated[rotated.index(b'\xff\xda'):],
+                         original[original.index(b'\xff\xda'):])
+
+        # the orientation tag is rewritten in place from now on
+        self.rotate(photo)
+        photo = Photo.objects.get(pk=photo.pk)
+        self.assertEqual(photo.exif_orientation, 3)
+        with open(photo.file.path, 'rb') as file_handle:
+            self.assertEqual(len(file_handle.read()), len(rotated))
+        thumbnail = photo.thumbnail_set.get(size='800x600-thumb')
+        self.assertIn('-v2.jpg', thumbnail.file.name)
+        self.assertEqual(PILImage.open(thumbnail.file.path).size, (60, 40))
+        self.assertEqual(read_exif(photo.file.path)['exif_orientation'], 3)
+
+    def test_rotate_broken_exif(self):
+        """
+        Test that EXIF data pointing past the end of its segment is taken to
+        have no orientation, so the image is rotated by decoding it.
+        """
+        for tiff in (b'MM\x00\x2a' + struct.pack('>L', 1000),
+                     b'MM\x00\x2a' + struct.pack('>LH', 8, 5),
+                     b'MM\x00'):
+            data = b'Exif\x00\x00' + tiff
+            segment = b'\xff\xe1' + struct.pack('>H', len(data) + 2) + data
+            jpeg = make_image(size=(60, 40)).read()
+            photo = Photo.objects.create(
+                album=self.album, name='photo', file=SimpleUploadedFile(
+                    'photo.jpg', jpeg[:2] + segment + jpeg[2:]))
+            with open(photo.file.path, 'rb') as file_handle:
+                self.assertIsNone(find_orientation(file_handle))
+            self.rotate(photo)
+            photo = Photo.objects.get(pk=photo.pk)
+            self.assertEqual(PILImage.open(photo.file.path).size, (40, 60))
+
+    def test_rotate_png(self):
+        output = io.BytesIO()
+        PILImage.new('RGB', (60, 40), 'red').save(output, 'PNG')
+        photo = Photo.objects.create(
+            album=self.album, name='photo',
+            file=SimpleUploadedFile('photo.png', output.getvalue()))
+        self.rotate(photo)
+        photo = Photo.objects.get(pk=photo.pk)
+        self.assertEqual(PILImage.open(photo.file.path).size, (40, 60))
+        self.assertEqual(photo.exif_orientation, 1)
+
+
+class FileChanges(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.album = Album.objects.create(name='album')
+        Photo.objects.create(album=self.album, name='photo', file=make_image())
+
+    def test_save_without_select(self):
+        """
+        Test that saving a photo or thumbnail doesn't load it again to
+        compare files.
+        """
+        photo = Photo.objects.get()
+        photo.name = 'renamed'
+        with CaptureQueriesContext(connection) as queries:
+            photo.save()
+        # the search index is updated after the photo
+        self.assertIn('UPDATE', queries[0]['sql'])
+
+        photo.thumbnail('800x600-thumb')
+        call_command('process_thumbnails', once=True, workers=1)
+        thumbnail = photo.thumbnail_set.get(size='800x600-thumb')
+        with CaptureQueriesContext(connection) as queries:
+            thumbnail.save()
+        self.assertEqual(len(queries), 1)
+
+    def test_delete_after_commit(self):
+        """
+        Test that a replaced file is deleted once the save commits, and not
+        at all if it is rolled back.
+        """
+        photo = Photo.objects.get()
+        old_path = photo.file.path
+        try:
+            with transaction.atomic():
+                photo.file = make_image('other.jpg')
+                photo.save()
+                raise ValueError
+        except ValueError:
+            pass
+        self.run_commit_hooks()
+        self.assertTrue(os.path.exists(old_path))
+
+        photo = Photo.objects.get()
+        photo.file = make_image('other.jpg')
+        photo.save()
+        self.assertTrue(os.path.exists(old_path))
+        self.run_commit_hooks()
+        self.assertFalse(os.path.exists(old_path))
+        self.assertTrue(os.path.exists(photo.file.path))
+
+
+class CommitHooks(TransactionTestCase):
+
+    def test_commit(self):
+        """
+        Test that hooks run when the outermost atomic block commits, and that
+        the hooks of rolled back blocks are dropped.
+        """
+        calls = []
+        with transaction.atomic():
+            on_commit(lambda: calls.append('outer'))
+            try:
+                with transaction.atomic():
+                    on_commit(lambda: calls.append('rolled back'))
+                    raise ValueError
+            except ValueError:
+                pass
+            with transaction.atomic():
+                on_commit(lambda: calls.append('inner'))
+            self.assertEqual(calls, [])
+        self.assertEqual(calls, ['outer', 'inner'])
+
+        try:
+            with transaction.atomic():
+                on_commit(lambda: calls.append('rolled back'))
+                raise ValueError
+        except ValueError:
+            pass
+        on_commit(lambda: calls.append('autocommit'))
+        self.assertEqual(calls, ['outer', 'inner', 'autocommit'])
+
+
+class BulkDelete(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.location = Location.objects.create(name='location')
+        self.album = Album.objects.create(
+            name='album', location=self.location)
+        self.person = Person.objects.create(name='person')
+
+    def add_photos(self, count):
+        for index in range(count):
+            photo = Photo.objects.create(
+                album=self.album, name='photo %s' % index,
+                file=make_image(color=(index, 0, 0)))
+            photo.people.add(self.person)
+            photo.thumbnail('200x200-fit')
+            send_action(self.user, 'tagged', action_object=photo)
+        call_command('process_thumbnails', once=True, workers=1)
+
+    def delete_album(self):
+        self.client.post(
+            reverse('album_delete', args=[self.album.pk]), {'submit': True},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+    def test_delete_album(self):
+        """
+        Test that deleting an album deletes its rows and leaves the files to
+        the reaper, except for files that another album shares.
+        """
+        self.add_photos(2)
+        shared = Photo.objects.first()
+        other = Album.objects.create(name='other')
+        Photo.objects.create(album=other, name='copy', file=shared.file.name)
+        paths = [photo.file.path for photo in Photo.objects.filter(
+            album=self.album)] + [
+            thumbnail.file.path for thumbnail in Thumbnail.objects.all()]
+        send_action(self.user, 'added photos to', target=self.album)
+
+        self.delete_album()
+        self.assertFalse(Album.objects.filter(pk=self.album.pk).exists())
+        self.assertEqual(Photo.objects.get().album, other)
+        self.assertFalse(Thumbnail.objects.exists())
+        self.assertFalse(Action.objects.exists())
+        if use_fts():
+            cursor = connection.cursor()
+            cursor.execute('SELECT rowid FROM photos_photo_fts')
+            indexed = [row[0] for row in cursor.fetchall()]
+        else:
+            indexed = SearchTerm.objects.values_list('photo', flat=True)
+        self.assertEqual(set(indexed), set([Photo.objects.get().pk]))
+        person = Person.objects.get()
+        self.assertEqual(person.photo_count, 0)
+        self.assertIsNone(person.cover_photo)
+        self.assertEqual(Location.objects.get().photo_count, 0)
+        self.assertEqual(Location.objects.get().album_count, 0)
+        self.assertEqual(DeletedFile.objects.count(), len(paths))
+        for path in paths:
+            self.assertTrue(os.path.exists(path))
+
+        call_command('reap_files', once=True)
+        self.assertFalse(DeletedFile.objects.exists())
+        for path in paths:
+            self.assertEqual(os.path.exists(path), path == shared.file.path)
+
+    def test_delete_album_queries(self):
+        """
+        Test that deleting an album takes the same number of queries however
+        many photos it has.
+        """
+        self.add_photos(1)
+        with CaptureQueriesContext(connection) as queries:
+            self.delete_album()
+        self.album = Album.objects.create(
+            name='album', location=self.location)
+        self.add_photos(5)
+        with self.assertNumQueries(len(queries)):
+            self.delete_album()
+
+    def test_delete_location(self):
+        self.add_photos(1)
+        send_action(self.user, 'renamed', target=self.location)
+        self.client.post(
+            reverse('location_delete', args=[self.location.pk]),
+            {'submit': True}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertFalse(Location.objects.exists())
+        self.assertIsNone(Album.objects.get().location)
+        self.assertEqual(Photo.objects.count(), 1)
+        self.assertEqual(Action.objects.count(), 1)
@@ -0,0 +1,144 @@
+"""
+Chunked, resumable uploads. The browser starts an upload session for each
+file and then sends the chunks of the file, several at a time and in any
+order, each with its SHA-256 checksum. Every chunk is written straight in to
+the file at its final path in storage, so nothing is buffered or assembled
+afterwards, and the photo is created as soon as the last chunk arrives. If
+the connection drops, the browser asks which chunks the session has and only
+sends the missing ones.
+"""
+import hashlib
+from functools import partial
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from photos.archives import import_zip, is_zip
+from photos.duplicates import create_photo
+from photos.models import Photo, UploadChunk, UploadSession, \
+    update_photo_counts
+from photos.utils import friendly_filename
+from utils.db import on_commit
+from utils.filestorage.uploads import get_unique_upload_path
+
+
+class ChunkError(Exception):
+    """Raised when a chunk doesn't belong in its upload session."""
+
+
+def get_storage():
+    return Photo._meta.get_field('file').storage
+
+
+def start_upload(user, album, filename, size, key):
+    """
+    Returns the unfinished upload session with the given key for this file,
+    or starts a new one. A new session reserves a unique path for the photo
+    and creates the file at its full size, so chunks can be written to it in
+    any order. The user is locked while looking for the session, so that two
+    requests starting the same upload at once share one session.
+    """
+    with transaction.atomic():
+        get_user_model().objects.select_for_update().get(pk=user.pk)
+        session = UploadSession.objects.filter(
+            user=user, key=key, album=album, filename=filename, size=size,
+            completed__isnull=True).first()
+        if session is not None:
+            return session
+        storage = get_storage()
+        name = storage.save(
+            get_unique_upload_path(Photo, filename), ContentFile(b''))
+        with open(storage.path(name), 'r+b') as file_handle:
+            file_handle.truncate(size)
+        return UploadSession.objects.create(
+            user=user, key=key, album=album, filename=filename, file=name,
+            size=size, chunk_size=settings.UPLOAD_CHUNK_SIZE)
+
+
+def get_status(session):
+    """
+    Returns what the browser needs to know to continue an upload session.
+    """
+    status = {
+        'id': session.pk,
+        'chunk_size': session.chunk_size,
+        'chunk_count': session.chunk_count,
+        'received': list(session.uploadchunk_set.values_list(
+            'index', flat=True)),
+        'complete': session.completed is not None,
+        'album': session.album.get_absolute_url(),
+    }
+    if session.photo_id:
+        status['photo'] = session.photo.get_absolute_url()
+    return status
+
+
+def write_chunk(session, index, data, checksum):
+    """
+    Checks a chunk against its checksum and writes it to its place in the
+    file. Chunks that were already received are accepted again, so retries
+    are harmless. Finishes the upload when this was the last chunk missing.
+    Returns the number of photos added to the album by finishing it.
+    """
+    if session.completed is not None:
+        return 0
+    if index >= session.chunk_count:
+        raise ChunkError('There are only %s chunks.' % session.chunk_count)
+    offset = index * session.chunk_size
+    if len(data) != min(session.chunk_size, session.size - offset):
+        raise ChunkError('Chunk %s has the wrong size.' % index)
+    if hashlib.sha256(data).hexdigest() != checksum.lower():
+        raise ChunkError('Chunk %s does not match its checksum.' % index)
+
+    with open(get_storage().path(session.file), 'r+b') as file_handle:
+        file_handle.seek(offset)
+        file_handle.write(data)
+    try:
+        with transaction.atomic():
+            UploadChunk.objects.create(
+                session=session, index=index, checksum=checksum.lower())
+    except IntegrityError:
+        # The chunk was sent twice.
+        pass
+    if session.uploadchunk_set.count() == session.chunk_count:
+        return finish_upload(session)
+    return 0
+
+
+def finish_upload(session):
+    """
+    Adds the uploaded file to the album, either as a photo or, for zip
+    files, as the photos inside it. The chunks arrive in any order, so the
+    file is hashed here in a single pass once it is complete. Several chunks
+    can arrive last at the same time, so the session is claimed first and
+    only finished once. The claim is rolled back if the photos can't be
+    added, so the upload can be finished again by resending a chunk.
+    Returns the number of photos added.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        claimed = UploadSession.objects.filter(
+            pk=session.pk, completed__isnull=True).update(completed=now)
+        if not claimed:
+            return 0
+        album = session.album
+        storage = get_storage()
+        if is_zip(session.filename):
+            with storage.open(session.file) as file_handle:
+                count = import_zip(album, file_handle)
+            on_commit(partial(storage.delete, session.file))
+        else:
+            photo, job = create_photo(
+                album, friendly_filename(session.filename), session.file)
+            UploadSession.objects.filter(pk=session.pk).update(photo=photo)
+            if job is not None:
+                job.save()
+            update_photo_counts(
+                1, albums=[album.pk], locations=[album.location_id])
+            session.photo = photo
+            count = 1
+    session.completed = now
+    return count
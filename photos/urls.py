@@ -1,13 +1,21 @@
 from django.conf.urls import patterns, url
 
 from photos import views
-from photos.views import album, photo, person, location
+from photos.views import album, chunks, photo, person, location
 
 urlpatterns = patterns(
     '',
     url(r'^upload/$', views.upload, name='upload'),
+    url(r'^upload/sessions/$', chunks.create, name='upload_session_create'),
+    url(r'^upload/sessions/(?P<pk>\d+)/$', chunks.detail,
+        name='upload_session'),
+    url(r'^upload/sessions/(?P<pk>\d+)/chunks/(?P<index>\d+)/$',
+        chunks.chunk, name='upload_chunk'),
     url(r'^search/$', views.search, name='search'),
-    url(r'^search/(?P<query>[\w=&]+)/$', views.results, name='results'),
+    url(r'^search/(?P<query>[\w=&+%.-]+)/$', views.results, name='results'),
+    url(r'^duplicates/$', views.duplicates, name='duplicates'),
+    url(r'^thumbnails/status.ajax/$', views.thumbnail_status,
+        name='thumbnail_status'),
 
     url(r'^albums/$', album.list, name='albums'),
     url(r'^albums/create.ajax/$', album.create, name='album_create'),
@@ -19,6 +27,8 @@ urlpatterns = patterns(
         name='album_merge'),
     url(r'^albums/(?P<pk>\d+)/download/$', album.download,
         name='album_download'),
+    url(r'^albums/(?P<pk>\d+)/duplicates/$', views.duplicates,
+        name='album_duplicates'),
 
     url(r'^locations/$', location.list, name='locations'),
     url(r'^locations/create.ajax/$', location.create,
@@ -58,6 +68,6 @@ urlpatterns = patterns(
         photo.detail, name='photo'),
     url(r'^people/(?P<person_pk>\d+)/photos/(?P<pk>\d+)/$', photo.detail,
         name='photo'),
-    url(r'^search/(?P<query>[\w=&]+)/photos/(?P<pk>\d+)/$', photo.detail,
+    url(r'^search/(?P<query>[\w=&+%.-]+)/photos/(?P<pk>\d+)/$', photo.detail,
         name='photo'),
 )
@@ -1,10 +1,56 @@
+import datetime
+import math
 import re
 import os
 
+import pytz
 from PIL import Image as PILImage, ImageOps as PILImageOps
-from PIL.ExifTags import TAGS as PIL_TAGS
+from PIL.ExifTags import GPSTAGS as PIL_GPSTAGS, TAGS as PIL_TAGS
 
 from django.conf import settings
+from django.utils import timezone
+
+from utils.jpeg import jpegtran, set_orientation
+
+# JPEGs are decoded at a reduced resolution that is still at least this many
+# times bigger than the thumbnails, so the final resample keeps its quality.
+DRAFT_OVERSAMPLE = 2
+
+# The Photo fields that read_exif fills in. A photo that has been read has an
+# orientation even if its file has no EXIF data.
+EXIF_FIELDS = (
+    'exif_taken', 'exif_make', 'exif_model', 'exif_lens', 'exif_iso',
+    'exif_focal', 'exif_exposure', 'exif_fnumber', 'exif_latitude',
+    'exif_longitude', 'exif_orientation')
+
+EXIF_ORIENTATION = 274
+
+# The transform that shows an image upright for each EXIF orientation, as a
+# matrix (a, b, c, d) that maps the pixel (x, y) to (ax + by, cx + dy), and by
+# name (rotations are clockwise).
+ORIENTATIONS = {
+    1: (1, 0, 0, 1), 2: (-1, 0, 0, 1), 3: (-1, 0, 0, -1), 4: (1, 0, 0, -1),
+    5: (0, 1, 1, 0), 6: (0, -1, 1, 0), 7: (0, -1, -1, 0), 8: (0, 1, -1, 0)}
+ORIENTATION_TRANSFORMS = {
+    1: None, 2: 'flip_horizontal', 3: 'rotate_180', 4: 'flip_vertical',
+    5: 'transpose', 6: 'rotate_90', 7: 'transverse', 8: 'rotate_270'}
+ROTATE_CLOCKWISE = 6
+
+# PIL's transpose methods for those transforms (its rotations are
+# counterclockwise).
+PIL_TRANSPOSE = {
+    'flip_horizontal': PILImage.FLIP_LEFT_RIGHT,
+    'flip_vertical': PILImage.FLIP_TOP_BOTTOM,
+    'rotate_90': PILImage.ROTATE_270,
+    'rotate_180': PILImage.ROTATE_180,
+    'rotate_270': PILImage.ROTATE_90,
+    'transpose': PILImage.TRANSPOSE,
+    'transverse': PILImage.TRANSVERSE,
+}
+
+# Photos are shrunk to this many rows of pixels (and one more column) to
+# compute their perceptual hash, which then has DHASH_SIZE ** 2 bits.
+DHASH_SIZE = 8
 
 
 def split_extension(filename):
@@ -83,16 +129,21 @@ def parse_size(size):
     return size_ints, method
 
 
-def get_thumbnail_path(filename, key):
+def get_thumbnail_path(filename, key, version=0):
     """
     Gets the upload path for a thumbnail file.
     An example path for an image in the 'photos' application looks like this:
         photos/bc31d8ba49c149598f83cf6c64eed500.jpg
         photos/thumbnails/bc31d8ba49c149598f83cf6c64eed500-800x600-thumb.jpg
         photos/thumbnails/bc31d8ba49c149598f83cf6c64eed500-200x150-fit.jpg
+    Once the photo has been changed (such as rotated), the version of the
+    photo is added so browsers don't show their cached thumbnails:
+        photos/thumbnails/bc31d8ba49c149598f83cf6c64eed500-200x150-fit-v2.jpg
     """
     filename, extension = os.path.splitext(filename)
     path, filename = os.path.split(filename)
+    if version:
+        key = '%s-v%s' % (key, version)
     new_filename = '%s-%s%s' % (filename, key, extension)
     # Create the full thumbnail path if necessary.
     os.makedirs(os.path.join(
@@ -100,32 +151,390 @@ def get_thumbnail_path(filename, key):
     return os.path.join(path, 'thumbnails', new_filename)
 
 
-def generate_thumbnail(image_field, size):
+def get_size_profiles(sizes=None):
     """
-    Generate a thumbnail image for the given image_field. Size is required and
-    should be passed as a string like '800x600-fit'. The file is always
-    generated regardless of whether it exists. This function will use the
-    same storage as the image_field that is passed in.
+    Returns the registry of thumbnail size profiles for the given sizes, which
+    default to the THUMBNAIL_SIZES setting. Each profile is a tuple like
+    ('800x600-thumb', [800, 600], 'thumb') and the profiles are sorted from
+    the largest to the smallest, which is the order they are rendered in.
+    """
+    if sizes is None:
+        sizes = settings.THUMBNAIL_SIZES
+    profiles = []
+    for size in sizes:
+        size_ints, method = parse_size(size)
+        profiles.append((size, size_ints, method))
+    profiles.sort(key=lambda profile: profile[1][0] * profile[1][1],
+                  reverse=True)
+    return profiles
+
+
+def get_scale(image_size, size_ints, method):
+    """
+    Returns the factor by which the given method scales an image of the given
+    dimensions. The 'fit' method has to cover the whole size while the 'thumb'
+    method only has to fit within it.
+    """
+    ratios = (size_ints[0] / image_size[0], size_ints[1] / image_size[1])
+    if method == 'fit':
+        return max(ratios)
+    return min(ratios)
+
+
+def get_thumbnail_dimensions(image_size, size_ints, method):
+    """
+    Returns the (approximate) dimensions of the thumbnail that the given
+    method produces from an image of the given dimensions.
+    """
+    if method == 'fit':
+        return tuple(size_ints)
+    ratio = min(get_scale(image_size, size_ints, method), 1)
+    return (max(int(image_size[0] * ratio), 1),
+            max(int(image_size[1] * ratio), 1))
+
+
+def get_orientation(pimage):
+    """
+    Returns the EXIF orientation of a PIL image, 1 (upright) if it has none.
+    """
+    try:
+        exif = pimage._getexif() if hasattr(pimage, '_getexif') else None
+    except Exception:
+        return 1
+    orientation = (exif or {}).get(EXIF_ORIENTATION)
+    return orientation if orientation in ORIENTATIONS else 1
+
+
+def combine_orientations(orientation, then):
+    """
+    Returns the orientation of an image with the given orientation once it
+    is shown transformed like the orientation then, so rotating a photo with
+    orientation 6 a quarter turn clockwise (orientation 6) gives orientation
+    3.
+    """
+    a, b, c, d = ORIENTATIONS[orientation]
+    e, f, g, h = ORIENTATIONS[then]
+    matrix = (e * a + f * c, e * b + f * d, g * a + h * c, g * b + h * d)
+    for key, value in ORIENTATIONS.items():
+        if value == matrix:
+            return key
+
+
+def apply_orientation(pimage, orientation):
+    """
+    Returns the PIL image transformed to show upright according to the given
+    EXIF orientation.
+    """
+    transform = ORIENTATION_TRANSFORMS[orientation]
+    if transform is None:
+        return pimage
+    return pimage.transpose(PIL_TRANSPOSE[transform])
+
+
+def open_image(path, profiles, draft=True):
+    """
+    Opens and decodes the image at the given path at the lowest resolution
+    that is still at least DRAFT_OVERSAMPLE times the size needed by the given
+    size profiles, so the final resample keeps its quality. JPEGs are decoded
+    at a reduced scale by the decoder itself with draft(), and any image that
+    is still too big is shrunk with a fast reduce() when Pillow supports it.
+    The image is returned upright according to its EXIF orientation.
+    Pass draft=False to always decode the full resolution.
+    """
+    pimage = PILImage.open(path)
+    orientation = get_orientation(pimage)
+    if not draft or not profiles:
+        pimage.load()
+        return apply_orientation(pimage, orientation)
+    size = pimage.size
+    if orientation in (5, 6, 7, 8):
+        # The sizes are for the upright image, which is turned on its side.
+        size = size[::-1]
+    scale = max(get_scale(size, size_ints, method)
+                for size_name, size_ints, method in profiles) * \
+        DRAFT_OVERSAMPLE
+    if scale >= 1:
+        pimage.load()
+        return apply_orientation(pimage, orientation)
+    needed = (int(math.ceil(pimage.size[0] * scale)),
+              int(math.ceil(pimage.size[1] * scale)))
+    if pimage.format == 'JPEG':
+        pimage.draft(pimage.mode, needed)
+    pimage.load()
+    factor = min(pimage.size[0] // needed[0], pimage.size[1] // needed[1])
+    if factor > 1 and pimage.mode in ('L', 'RGB', 'RGBA') and \
+            hasattr(pimage, 'reduce'):
+        pimage = pimage.reduce(factor)
+    return apply_orientation(pimage, orientation)
+
+
+def resize_image(pimage, size_ints, method):
+    """
+    Returns a resized copy of the given PIL image. The 'fit' method crops the
+    image to fill the size exactly and the 'thumb' method keeps the aspect
+    ratio and fits the image within the size.
     """
-    size_ints, method = parse_size(size)
-    thumbnail_path = get_thumbnail_path(image_field.name, size)
-    pimage = PILImage.open(image_field.path)
     if method == 'fit':
-        pimage = PILImageOps.fit(
-            pimage,
-            size_ints,
-            method=PILImage.ANTIALIAS)
-    elif method == 'thumb':
-        pimage.thumbnail(size_ints, PILImage.ANTIALIAS)
-    pimage.save(image_field.storage.path(thumbnail_path))
-    return thumbnail_path
+        return PILImageOps.fit(pimage, size_ints, method=PILImage.ANTIALIAS)
+    pimage = pimage.copy()
+    pimage.thumbnail(size_ints, PILImage.ANTIALIAS)
+    return pimage
+
+
+def render_images(path, sizes=None, draft=True):
+    """
+    Renders the image at the given path in every size profile (by default all
+    the configured sizes) while decoding it only once, and returns a
+    dictionary mapping each size to its PIL image. The sizes are rendered from
+    the largest to the smallest and each one is derived from the smallest
+    image rendered so far that is still big enough, rather than from the
+    original.
+    """
+    profiles = get_size_profiles(sizes)
+    pimage = open_image(path, profiles, draft=draft)
+    # Images that keep the aspect ratio of the original can be used as the
+    # source for the smaller sizes.
+    sources = [pimage]
+    images = {}
+    for size, size_ints, method in profiles:
+        needed = get_thumbnail_dimensions(pimage.size, size_ints, method)
+        candidates = [source for source in sources
+                      if source.size[0] >= needed[0] and
+                      source.size[1] >= needed[1]] or [pimage]
+        source = min(candidates,
+                     key=lambda image: image.size[0] * image.size[1])
+        images[size] = resize_image(source, size_ints, method)
+        if method == 'thumb':
+            sources.append(images[size])
+    return images
+
+
+def save_thumbnails(image_field, images, version=0):
+    """
+    Saves the images returned by render_images as the thumbnails of the given
+    image_field (with the given version of the photo), in the same storage,
+    and returns a dictionary mapping each size to the path of its thumbnail.
+    """
+    paths = {}
+    for size, pimage in images.items():
+        paths[size] = get_thumbnail_path(image_field.name, size, version)
+        pimage.save(image_field.storage.path(paths[size]))
+    return paths
+
+
+def render_thumbnails(image_field, sizes=None, version=0):
+    """
+    Generate the thumbnails for the given image_field in every size profile
+    (by default all the configured sizes) using render_images, so the original
+    is only decoded once. The files are always generated regardless of
+    whether they exist, using the same storage as the image_field. Returns a
+    dictionary mapping each size to the path of its thumbnail.
+    """
+    return save_thumbnails(
+        image_field, render_images(image_field.path, sizes), version)
+
+
+def render_photo(image_field, version=0):
+    """
+    Generate every configured thumbnail of the given image_field like
+    render_thumbnails, and compute the perceptual hash of the photo from the
+    smallest thumbnail that shows the whole photo, so the original is still
+    only decoded once. Returns the paths of the thumbnails and the hash.
+    """
+    images = render_images(image_field.path)
+    methods = dict((size, method)
+                   for size, size_ints, method in get_size_profiles())
+    sources = [pimage for size, pimage in images.items()
+               if methods[size] == 'thumb'] or list(images.values())
+    source = min(sources, key=lambda image: image.size[0] * image.size[1])
+    return save_thumbnails(image_field, images, version), get_dhash(source)
+
+
+def get_dhash(pimage):
+    """
+    Returns the difference hash (dHash) of a PIL image. The image is shrunk to
+    9x8 grayscale pixels and each of the 64 bits says whether a pixel is
+    brighter than its right neighbour, so resized and re-encoded versions of
+    a photo get the same or a very similar hash. The hash is returned as a
+    signed 64 bit integer so it fits in a BigIntegerField.
+    """
+    width = DHASH_SIZE + 1
+    pixels = list(pimage.convert('L').resize(
+        (width, DHASH_SIZE), PILImage.ANTIALIAS).getdata())
+    value = 0
+    for row in range(DHASH_SIZE):
+        for col in range(DHASH_SIZE):
+            offset = row * width + col
+            value = (value << 1) | (pixels[offset] > pixels[offset + 1])
+    if value >= 1 << 63:
+        value -= 1 << 64
+    return value
+
+
+def image_dhash(path):
+    """
+    Returns the difference hash of the image at the given path, which is
+    decoded at the lowest resolution that open_image allows.
+    """
+    profiles = get_size_profiles(
+        ['%sx%s-thumb' % (DHASH_SIZE + 1, DHASH_SIZE)])
+    return get_dhash(open_image(path, profiles))
+
+
+def generate_thumbnail(image_field, size, version=0):
+    """
+    Generate a thumbnail image for the given image_field. Size is required and
+    should be passed as a string like '800x600-fit'. Use render_thumbnails to
+    generate several sizes at once.
+    """
+    return render_thumbnails(image_field, [size], version)[size]
 
 
 def rotate_image(image_field):
     """
-    Rotate (clockwise) the file associated with the given image_field.
+    Rotate (clockwise) the file associated with the given image_field without
+    losing quality, and return its new EXIF orientation.
+    - JPEGs are transformed with jpegtran, which also applies their current
+      orientation so they end up upright with orientation 1.
+    - Without jpegtran, or when it can't transform an image perfectly, only
+      the orientation tag of the JPEG is changed.
+    - Other images (and JPEGs whose EXIF data has no orientation tag) are
+      decoded, rotated and saved again.
     """
-    pimage = PILImage.open(image_field.path)
-    pimage = pimage.rotate(270)
-    pimage.save(image_field.path)
-    return True
+    path = image_field.path
+    pimage = PILImage.open(path)
+    orientation = get_orientation(pimage)
+    rotated = combine_orientations(orientation, ROTATE_CLOCKWISE)
+    if pimage.format == 'JPEG':
+        transform = ORIENTATION_TRANSFORMS[rotated]
+        if transform is None or jpegtran(path, transform):
+            if orientation != 1:
+                set_orientation(path, 1)
+            return 1
+        if set_orientation(path, rotated):
+            return rotated
+    image_format = pimage.format
+    pimage.load()
+    pimage = apply_orientation(pimage, rotated)
+    if image_format == 'JPEG':
+        pimage.save(path, image_format, quality=95)
+    else:
+        pimage.save(path, image_format)
+    return 1
+
+
+def exif_number(value):
+    """
+    Converts an EXIF rational, given either as a (numerator, denominator)
+    tuple or as a number, to a float. Returns None for a zero denominator.
+    """
+    if isinstance(value, tuple):
+        if len(value) != 2 or not value[1]:
+            return None
+        return value[0] / value[1]
+    value = float(value)
+    return None if math.isnan(value) or math.isinf(value) else value
+
+
+def exif_text(value, max_length):
+    """
+    Cleans up an EXIF string, which is often padded with spaces or NULs.
+    """
+    if isinstance(value, bytes):
+        value = value.decode('latin-1')
+    value = str(value).strip('\x00 ')
+    return value[:max_length] or None
+
+
+def exif_coordinate(value, ref):
+    """
+    Converts an EXIF GPS coordinate (degrees, minutes and seconds) to
+    decimal degrees, negative for the south and the west.
+    """
+    degrees, minutes, seconds = [exif_number(part) for part in value]
+    coordinate = degrees + minutes / 60 + seconds / 3600
+    if ref in ('S', 'W', b'S', b'W'):
+        coordinate = -coordinate
+    return coordinate
+
+
+def read_exif(path):
+    """
+    Reads the EXIF data of the image at the given path and returns it as a
+    dictionary of the EXIF_FIELDS of a Photo. Only the header of the file is
+    parsed: PIL doesn't decode the image until its pixels are needed. Values
+    that are missing or can't be parsed are left out, except the orientation
+    which defaults to 1 (the normal orientation).
+    """
+    values = {'exif_orientation': 1}
+    try:
+        pimage = PILImage.open(path)
+        raw = pimage._getexif() if hasattr(pimage, '_getexif') else None
+    except Exception:
+        # Broken EXIF data is common and shouldn't stop a photo from being
+        # added.
+        return values
+    if not raw:
+        return values
+    tags = dict((PIL_TAGS.get(tag, tag), value) for tag, value in raw.items())
+
+    def read(field, tag, convert):
+        if tag not in tags:
+            return
+        try:
+            value = convert(tags[tag])
+        except (TypeError, ValueError, ZeroDivisionError, IndexError):
+            return
+        if value is not None:
+            values[field] = value
+
+    def parse_date(value):
+        taken = datetime.datetime.strptime(
+            exif_text(value, 19), '%Y:%m:%d %H:%M:%S')
+        if settings.USE_TZ:
+            tz = timezone.get_default_timezone()
+            try:
+                taken = timezone.make_aware(taken, tz)
+            except pytz.InvalidTimeError:
+                # Cameras don't say whether DST was on, so times that are
+                # skipped or repeated when the clocks change are read as
+                # standard time.
+                taken = tz.localize(taken, is_dst=False)
+        return taken
+
+    def parse_exposure(value):
+        seconds = exif_number(value)
+        if seconds is None or seconds <= 0:
+            return None
+        if seconds < 1:
+            return '1/%d' % round(1 / seconds)
+        return '%g' % seconds
+
+    def parse_orientation(value):
+        return value if value in range(1, 9) else None
+
+    read('exif_taken', 'DateTimeOriginal', parse_date)
+    if 'exif_taken' not in values:
+        read('exif_taken', 'DateTime', parse_date)
+    read('exif_make', 'Make', lambda value: exif_text(value, 100))
+    read('exif_model', 'Model', lambda value: exif_text(value, 100))
+    read('exif_lens', 'LensModel', lambda value: exif_text(value, 100))
+    read('exif_iso', 'ISOSpeedRatings',
+         lambda value: int(value[0] if isinstance(value, tuple) else value))
+    read('exif_focal', 'FocalLength', exif_number)
+    read('exif_exposure', 'ExposureTime', parse_exposure)
+    read('exif_fnumber', 'FNumber', exif_number)
+    read('exif_orientation', 'Orientation', parse_orientation)
+
+    gps = tags.get('GPSInfo')
+    if isinstance(gps, dict):
+        gps = dict((PIL_GPSTAGS.get(tag, tag), value)
+                   for tag, value in gps.items())
+        try:
+            values['exif_latitude'] = exif_coordinate(
+                gps['GPSLatitude'], gps.get('GPSLatitudeRef'))
+            values['exif_longitude'] = exif_coordinate(
+                gps['GPSLongitude'], gps.get('GPSLongitudeRef'))
+        except (KeyError, TypeError, ValueError, ZeroDivisionError):
+            values.pop('exif_latitude', None)
+    return values
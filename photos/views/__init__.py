@@ -1,15 +1,25 @@
+from django.utils.translation import ugettext as _
 from django.conf import settings
 from django.contrib.auth.decorators import permission_required, login_required
 from django.core.urlresolvers import reverse
-from django.db.models import Q
-from django.http import QueryDict
-from django.shortcuts import redirect, render
+from django.http import JsonResponse, QueryDict
+from django.shortcuts import get_object_or_404, redirect, render
 
+from photos.duplicates import find_near_duplicates
 from photos.forms import UploadForm, SearchForm
-from photos.models import Photo
+from photos.models import MAX_THUMBNAIL_ATTEMPTS, Album, Photo, Thumbnail, \
+    ThumbnailJob, prefetch_thumbnails
+from photos.search import filter_photos, get_facets, get_result_ids, \
+    normalize_query
 from stream.utils import send_action
 from utils.paginate import paginate
 
+# Number of values shown for each facet of the search results.
+FACET_SIZE = 10
+
+# Number of groups of near duplicate photos shown per page.
+DUPLICATES_PER_PAGE = 20
+
 
 def get_photo_queryset(album=None, query=None, person=None):
     if album:
@@ -17,22 +27,7 @@ def get_photo_queryset(album=None, query=None, person=None):
     if person:
         return person.photo_set.all()
     if query:
-        query_dict = QueryDict(query)
-        queryset = Photo.objects.all()
-        q = query_dict.get('q')
-        if q:
-            queryset = queryset.filter(
-                Q(name__icontains=q) | Q(album__name__icontains=q))
-        a = query_dict.getlist('a')
-        if a:
-            queryset = queryset.filter(album__in=a)
-        p = query_dict.getlist('p')
-        if p:
-            queryset = queryset.filter(people__in=p)
-        l = query_dict.getlist('l')
-        if l:
-            queryset = queryset.filter(album__location__in=l)
-        return queryset
+        return filter_photos(query)
 
 
 @permission_required('photos.add_photo')
@@ -41,35 +36,112 @@ def upload(request):
     if form.is_valid():
         album = form.save()
         send_action(
-            request.user,
-            'added %s photos to the album' % form.photo_count,
-            target=album)
+            request.user, 'added %(count)s photos to the album',
+            target=album, count=form.photo_count)
         return redirect(album.get_absolute_url())
     context = {'form': form}
     return render(request, 'photos/upload.html', context)
 
 
+def get_facet_list(query):
+    """
+    Returns the facets of a search for the template, with a URL for each
+    value that shows only the results with that value.
+    """
+    query_dict = QueryDict(query).copy()
+    facet_list = []
+    facets = get_facets(query)
+    for key, title in (('a', _('Albums')), ('p', _('People')),
+                       ('l', _('Locations')), ('y', _('Years')),
+                       ('c', _('Cameras'))):
+        values = []
+        for value, name, count in facets[key][:FACET_SIZE]:
+            query_dict.setlist(key, [value])
+            values.append({
+                'name': name,
+                'count': count,
+                'url': reverse('results', kwargs={
+                    'query': normalize_query(query_dict.urlencode())}),
+            })
+        query_dict.setlist(key, QueryDict(query).getlist(key))
+        if values:
+            facet_list.append({'title': title, 'values': values})
+    return facet_list
+
+
 @login_required
 def results(request, query):
-    queryset = get_photo_queryset(query=query)
-    paginator, queryset = paginate(request, queryset, settings.PHOTOS_PER_PAGE)
+    paginator, photo_ids = paginate(
+        request, get_result_ids(query), settings.PHOTOS_PER_PAGE)
+    photos = Photo.objects.in_bulk(photo_ids.tolist())
+    photo_list = prefetch_thumbnails(
+        [photos[pk] for pk in photo_ids if pk in photos], '200x200-fit')
     context = {
         'query': query,
         'paginator': paginator,
-        'photo_list': queryset,
+        'photo_list': photo_list,
+        'facet_list': get_facet_list(query),
         'back_link': {'url': reverse('search'), 'title': 'Search'}
     }
     return render(request, 'photos/search_results.html', context)
 
 
+@login_required
+def duplicates(request, pk=None):
+    """
+    Lists the groups of near duplicate photos in an album, or in the whole
+    gallery when no album is given.
+    """
+    album = get_object_or_404(Album, pk=pk) if pk else None
+    paginator, clusters = paginate(
+        request, find_near_duplicates(album), DUPLICATES_PER_PAGE)
+    photos = Photo.objects.in_bulk(
+        [photo_pk for cluster in clusters for photo_pk in cluster])
+    prefetch_thumbnails(photos.values(), '200x200-fit')
+    if album:
+        back_link = {'url': album.get_absolute_url(), 'title': album.name}
+    else:
+        back_link = {'url': reverse('albums'), 'title': _('Albums')}
+    context = {
+        'album': album,
+        'paginator': paginator,
+        'cluster_list': [[photos[photo_pk] for photo_pk in cluster
+                          if photo_pk in photos] for cluster in clusters],
+        'back_link': back_link
+    }
+    return render(request, 'photos/duplicates.html', context)
+
+
 @login_required
 def search(request):
     form = SearchForm(request.POST or None)
     if request.POST:
-        post_copy = request.POST.copy()
-        if 'csrfmiddlewaretoken' in post_copy:
-            del post_copy['csrfmiddlewaretoken']
-        return redirect(reverse('results',
-                                kwargs={'query': post_copy.urlencode()}))
+        query = normalize_query(request.POST.urlencode())
+        if not query:
+            return redirect(reverse('search'))
+        return redirect(reverse('results', kwargs={'query': query}))
     context = {'form': form}
     return render(request, 'photos/search.html', context)
+
+
+@login_required
+def thumbnail_status(request):
+    """
+    Returns the URLs of the requested thumbnails that have been generated so
+    pages showing placeholders can poll for them, and the photos whose
+    thumbnails failed for good so the pages stop polling for those. Expects
+    one or more "id" parameters with photo IDs and a "size" parameter.
+    """
+    size = request.GET.get('size', '200x200-fit')
+    photo_ids = [int(pk) for pk in request.GET.getlist('id') if pk.isdigit()]
+    thumbnails = Thumbnail.objects.filter(photo__in=photo_ids, size=size)
+    ready = dict((thumb.photo_id, thumb.file.url) for thumb in thumbnails)
+    failed = set(ThumbnailJob.objects.filter(
+        photo__in=[pk for pk in photo_ids if pk not in ready],
+        attempts__gte=MAX_THUMBNAIL_ATTEMPTS).values_list('photo', flat=True))
+    return JsonResponse({
+        'ready': ready,
+        'pending': [pk for pk in photo_ids
+                    if pk not in ready and pk not in failed],
+        'failed': sorted(failed),
+    })
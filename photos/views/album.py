@@ -1,19 +1,17 @@
-import os
-import tempfile
-import zipfile
-
 from django.utils.translation import ugettext as _
 from django.conf import settings
 from django.contrib.auth.decorators import login_required, permission_required
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404
 
+from photos.deletion import delete_albums
 from photos.forms import AlbumForm, AlbumMergeForm
-from photos.models import Album, Location
+from photos.models import Album, Location, prefetch_thumbnails
 from photos.views import get_photo_queryset
-from utils.paginate import paginate
+from utils.paginate import keyset_paginate, paginate
 from utils.views import json_redirect, json_render
+from utils.zipstream import ZipStream
 
 
 def get_back_link(request, album, **kwargs):
@@ -37,7 +35,7 @@ def get_back_link(request, album, **kwargs):
 @login_required
 def list(request):
     paginator, queryset = paginate(
-        request, Album.objects.all(), settings.PHOTOS_PER_PAGE)
+        request, Album.objects.with_covers(), settings.PHOTOS_PER_PAGE)
     context = {'paginator': paginator, 'album_list': queryset}
     return render(request, 'photos/album_list.html', context)
 
@@ -45,13 +43,16 @@ def list(request):
 @login_required
 def detail(request, pk, **kwargs):
     album = get_object_or_404(Album, pk=pk)
-    paginator, queryset = paginate(
-        request, get_photo_queryset(album=album), settings.PHOTOS_PER_PAGE)
+    paginator, queryset = keyset_paginate(
+        request, get_photo_queryset(album=album), settings.PHOTOS_PER_PAGE,
+        count=album.photo_count)
+    photo_list = prefetch_thumbnails(queryset, '200x200-fit')
     context = {
         'location_pk': kwargs.get('location_pk'),
         'album': album,
         'paginator': paginator,
-        'photo_list': queryset,
+        'photo_list': photo_list,
+        'sorted_query': 'a=%s&o=taken' % album.pk,
         'back_link': get_back_link(request, album, **kwargs)
     }
     return render(request, 'photos/album_detail.html', context)
@@ -90,7 +91,7 @@ def edit(request, pk):
 def delete(request, pk):
     album = get_object_or_404(Album, pk=pk)
     if request.POST:
-        album.delete()
+        delete_albums([album.pk])
         return json_redirect(request, reverse('albums'))
     context = {
         'album': album,
@@ -123,12 +124,11 @@ def merge(request, pk):
 @login_required
 def download(request, pk):
     album = get_object_or_404(Album, pk=pk)
-    temp_zip = tempfile.NamedTemporaryFile()
-    with zipfile.ZipFile(temp_zip, 'w') as zipf:
-        for photo in album.photo_set.all():
-            full_path = os.path.join(settings.MEDIA_ROOT, photo.file.name)
-            zipf.write(full_path, '%s' % (photo.file.name.split('/')[-1]))
-    temp_zip.seek(0)
-    response = HttpResponse(temp_zip.read(), content_type='application/zip')
+    files = ((photo.file.path, photo.file.name.split('/')[-1])
+             for photo in album.photo_set.only('file').iterator())
+    zip_stream = ZipStream(files)
+    response = StreamingHttpResponse(
+        zip_stream, content_type='application/zip')
+    response['Content-Length'] = len(zip_stream)
     response['Content-Disposition'] = 'attachment; filename=%s.zip' % album.name
     return response
@@ -0,0 +1,68 @@
+from django.contrib.auth.decorators import permission_required
+from django.core.urlresolvers import reverse
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404
+from django.views.decorators.http import require_POST
+
+from photos.forms import UploadSessionForm
+from photos.models import UploadSession
+from photos.uploads import ChunkError, get_status, start_upload, write_chunk
+from stream.utils import send_action
+
+
+def session_response(session, **kwargs):
+    status = get_status(session)
+    status['url'] = reverse('upload_session', kwargs={'pk': session.pk})
+    return JsonResponse(status, **kwargs)
+
+
+@require_POST
+@permission_required('photos.add_photo')
+def create(request):
+    """
+    Starts uploading a file in chunks, or resumes the upload with the same
+    key. Returns the status of the upload session.
+    """
+    form = UploadSessionForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    session = start_upload(request.user, **form.cleaned_data)
+    return session_response(session)
+
+
+@permission_required('photos.add_photo')
+def detail(request, pk):
+    session = get_object_or_404(UploadSession, pk=pk, user=request.user)
+    return session_response(session)
+
+
+@require_POST
+@permission_required('photos.add_photo')
+def chunk(request, pk, index):
+    """
+    Receives one chunk of an upload session. The body of the request is the
+    chunk and the X-Checksum header its SHA-256 checksum. Every file of an
+    upload finishes on its own, and the actions they send are merged in to
+    one for the whole upload. Bodies bigger than a chunk are refused before
+    they are read.
+    """
+    session = get_object_or_404(UploadSession, pk=pk, user=request.user)
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    if length > session.chunk_size:
+        return JsonResponse(
+            {'errors': 'Chunks are at most %s bytes.' % session.chunk_size},
+            status=413)
+    try:
+        count = write_chunk(session, int(index),
+                            request.read(session.chunk_size),
+                            request.META.get('HTTP_X_CHECKSUM', ''))
+    except ChunkError as e:
+        return JsonResponse({'errors': str(e)}, status=400)
+    if count:
+        send_action(
+            request.user, 'added %(count)s photos to the album',
+            target=session.album, count=count)
+    return session_response(session)
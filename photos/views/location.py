@@ -4,6 +4,7 @@ from django.contrib.auth.decorators import login_required, permission_required
 from django.core.urlresolvers import reverse
 from django.shortcuts import render, get_object_or_404
 
+from photos.deletion import delete_locations
 from photos.forms import LocationRenameForm
 from photos.models import Location
 from stream.utils import send_action
@@ -14,7 +15,7 @@ from utils.views import json_redirect, json_render
 @login_required
 def list(request):
     paginator, queryset = paginate(
-        request, Location.objects.all(), settings.PHOTOS_PER_PAGE)
+        request, Location.objects.with_covers(), settings.PHOTOS_PER_PAGE)
     context = {'paginator': paginator, 'location_list': queryset}
     return render(request, 'photos/location_list.html', context)
 
@@ -23,7 +24,7 @@ def list(request):
 def detail(request, pk):
     location = get_object_or_404(Location, pk=pk)
     paginator, queryset = paginate(
-        request, location.album_set.all(), settings.PHOTOS_PER_PAGE)
+        request, location.album_set.with_covers(), settings.PHOTOS_PER_PAGE)
     context = {
         'location': location,
         'paginator': paginator,
@@ -70,7 +71,7 @@ def rename(request, pk):
 def delete(request, pk):
     location = get_object_or_404(Location, pk=pk)
     if request.POST:
-        location.delete()
+        delete_locations([location.pk])
         return json_redirect(request, reverse('locations'))
     context = {
         'location': location,
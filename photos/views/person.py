@@ -5,17 +5,17 @@ from django.core.urlresolvers import reverse
 from django.shortcuts import render, get_object_or_404
 
 from photos.forms import PersonRenameForm
-from photos.models import Person
+from photos.models import Person, prefetch_thumbnails
 from photos.views import get_photo_queryset
 from stream.utils import send_action
-from utils.paginate import paginate
+from utils.paginate import keyset_paginate, paginate
 from utils.views import json_redirect, json_render
 
 
 @login_required
 def list(request):
     paginator, queryset = paginate(
-        request, Person.objects.all(), settings.PHOTOS_PER_PAGE)
+        request, Person.objects.with_covers(), settings.PHOTOS_PER_PAGE)
     context = {'paginator': paginator, 'person_list': queryset}
     return render(request, 'photos/person_list.html', context)
 
@@ -23,12 +23,14 @@ def list(request):
 @login_required
 def detail(request, pk):
     person = get_object_or_404(Person, pk=pk)
-    paginator, queryset = paginate(
-        request, get_photo_queryset(person=person), settings.PHOTOS_PER_PAGE)
+    paginator, queryset = keyset_paginate(
+        request, get_photo_queryset(person=person), settings.PHOTOS_PER_PAGE,
+        count=person.photo_count)
+    photo_list = prefetch_thumbnails(queryset, '200x200-fit')
     context = {
         'person': person,
         'paginator': paginator,
-        'photo_list': queryset,
+        'photo_list': photo_list,
         'back_link': {'url': reverse('people'), 'title': _('People')}
     }
     return render(request, 'photos/person_detail.html', context)
@@ -1,15 +1,19 @@
-import mimetypes
-
 from django.utils.translation import ugettext as _
 from django.contrib.auth.decorators import login_required, permission_required
+from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse
+from django.db.models import Q
+from django.http import Http404, JsonResponse
 from django.shortcuts import get_object_or_404, render
 
+from photos.duplicates import unshare_file
 from photos.forms import PhotoMoveForm, PhotoRenameForm, PhotoTagForm
-from photos.models import Person, Photo
-from photos.utils import rotate_image
+from photos.models import Person, Photo, Thumbnail, ThumbnailJob
+from photos.search import get_result_ids
+from photos.utils import render_photo, rotate_image
 from photos.views import get_photo_queryset
+from utils.filestorage.uploads import file_sha256
+from utils.sendfile import serve_file
 from utils.views import json_redirect, json_render
 
 
@@ -48,27 +52,45 @@ def get_back_link(request, photo, **kwargs):
 
 def get_paginator(request, photo, **kwargs):
     """
-    This is a big messy function that I should probably revisit some day. Here
-    is what it tries to accomplish:
-    We need to figure out where this photo is (index) in the queryset. The
-    problem is that queryset is variable. If the user came from an album, then
-    the queryset is the album's list of photos. If the user came from a person,
-    then the queryset is the person's list of photos. If the user came from
-    search, then the queryset is the search results list. This also impacts the
-    'next' and 'previous' URLs which need to know about the current context as
-    well. So that's what this does. Fancy.
+    Figures out where this photo is in the list of photos it was reached from
+    and what the next and previous photos are. The list depends on the URL:
+    if the user came from an album, then it's the album's list of photos; if
+    the user came from a person, then it's the person's list of photos; if
+    the user came from search, then it's the search results. This also
+    impacts the 'next' and 'previous' URLs which need to know about the
+    current context as well.
+    The lists are ordered by (name, id), so the neighbours are found with
+    keyset queries (the first row before or after this photo) and the index
+    with an indexed count, instead of loading the whole list. Search results
+    are ordered by relevance instead, so their neighbours are looked up in
+    the cached list of result IDs.
     """
-    if 'person_pk' in kwargs:
-        person = get_object_or_404(Person, pk=kwargs['person_pk'])
-        queryset = get_photo_queryset(person=person)
-    elif 'query' in kwargs:
-        queryset = get_photo_queryset(query=kwargs['query'])
+    if 'query' in kwargs:
+        photo_ids = get_result_ids(kwargs['query'])
+        try:
+            index = photo_ids.index(photo.pk)
+        except ValueError:
+            raise Http404('The photo is not in the search results.')
+        prev_pk = photo_ids[index - 1] if index > 0 else None
+        next_pk = photo_ids[index + 1] if index + 1 < len(photo_ids) else None
+        count = len(photo_ids)
     else:
-        queryset = get_photo_queryset(album=photo.album)
-
-    # We really only need the list of sorted names and IDs.
-    values_list = list(queryset.order_by('name').values_list('id', 'name'))
-    index = values_list.index((photo.pk, photo.name))
+        if 'person_pk' in kwargs:
+            person = get_object_or_404(Person, pk=kwargs['person_pk'])
+            queryset = get_photo_queryset(person=person)
+            count = person.photo_count
+        else:
+            queryset = get_photo_queryset(album=photo.album)
+            count = photo.album.photo_count
+        before = queryset.filter(
+            Q(name__lt=photo.name) | Q(name=photo.name, id__lt=photo.pk))
+        after = queryset.filter(
+            Q(name__gt=photo.name) | Q(name=photo.name, id__gt=photo.pk))
+        prev_pk = before.order_by('-name', '-id').values_list(
+            'id', flat=True).first()
+        next_pk = after.order_by('name', 'id').values_list(
+            'id', flat=True).first()
+        index = before.count()
 
     def build_url(pk):
         url_kwargs = kwargs.copy()
@@ -76,11 +98,10 @@ def get_paginator(request, photo, **kwargs):
         return reverse('photo', kwargs=url_kwargs)
 
     next_url, prev_url = None, None
-    if len(values_list) > 1:
-        if index != len(values_list) - 1:  # not last
-            next_url = build_url(values_list[index + 1][0])
-        if index != 0:  # not first
-            prev_url = build_url(values_list[index - 1][0])
+    if next_pk is not None:
+        next_url = build_url(next_pk)
+    if prev_pk is not None:
+        prev_url = build_url(prev_pk)
 
     return {
         'has_next': (next_url is not None),
@@ -88,7 +109,7 @@ def get_paginator(request, photo, **kwargs):
         'has_previous': (prev_url is not None),
         'previous_url': prev_url,
         'index': (index + 1),
-        'count': len(values_list)
+        'count': count
     }
 
 
@@ -105,12 +126,36 @@ def detail(request, pk, **kwargs):
 
 @permission_required('photos.edit_photo')
 def rotate(request, pk):
+    """
+    Rotates the photo clockwise without losing quality (see rotate_image)
+    and renders its thumbnails again from the rotated photo in one pass.
+    The thumbnails get new file names, which are returned so the page can
+    show the new one.
+    """
+    if not request.is_ajax():
+        raise PermissionDenied('Must be an AJAX request.')
     photo = get_object_or_404(Photo, pk=pk)
     if request.POST:
-        rotate_image(photo.file)
-        for thumb in photo.thumbnail_set.all():
-            rotate_image(thumb.file)
-    return json_redirect(request, photo.get_absolute_url())
+        # Other copies of the photo must stay the way they are.
+        unshare_file(photo)
+        orientation = rotate_image(photo.file)
+        photo.version += 1
+        paths, dhash = render_photo(photo.file, photo.version)
+        with photo.file.storage.open(photo.file.name) as file_handle:
+            sha256 = file_sha256(file_handle)
+        Photo.objects.filter(pk=photo.pk).update(
+            version=photo.version, sha256=sha256, dhash=dhash,
+            exif_orientation=orientation)
+        for size, path in paths.items():
+            # Saving the new file name deletes the old thumbnail.
+            Thumbnail.objects.update_or_create(
+                photo=photo, size=size, defaults={'file': path})
+        ThumbnailJob.objects.filter(photo=photo).delete()
+    thumbnail = photo.thumbnail('800x600-thumb')
+    return JsonResponse({
+        'url': photo.get_absolute_url(),
+        'thumbnail': thumbnail.url if thumbnail else None,
+    })
 
 
 @permission_required('photos.edit_photo')
@@ -179,8 +224,5 @@ def delete(request, pk):
 @login_required
 def download(request, pk):
     photo = get_object_or_404(Photo, pk=pk)
-    file_data = photo.file.file.read()
-    mimetype = mimetypes.guess_type(photo.file.name, strict=False)[0]
-    response = HttpResponse(file_data, content_type=mimetype)
-    response['Content-Disposition'] = 'attachment; filename=%s' % photo.file.name.split('/')[-1]
-    return response
+    return serve_file(request, photo.file.path,
+                      filename=photo.file.name.split('/')[-1])
@@ -4,6 +4,6 @@ from stream.models import Action
 
 
 class ActionAdmin(admin.ModelAdmin):
-    list_display = ['user', 'verb', 'target', 'timestamp']
+    list_display = ['user', 'verb', 'count', 'target', 'timestamp']
 
 admin.site.register(Action, ActionAdmin)
@@ -0,0 +1,18 @@
+from stream.utils import discard_buffer, flush_buffer, start_buffer
+
+
+class ActionBufferMiddleware:
+    """
+    Buffers the actions sent while handling a request and saves them in
+    bulk once the response is ready, instead of one INSERT per action in the
+    middle of the view. The actions of views that fail are dropped.
+    """
+    def process_request(self, request):
+        start_buffer()
+
+    def process_exception(self, request, exception):
+        discard_buffer()
+
+    def process_response(self, request, response):
+        flush_buffer()
+        return response
@@ -1,11 +1,34 @@
+import time
+
 from django.contrib.contenttypes.fields import GenericRelation
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone
 from django.db import models
-from django.db.models import signals
+
+# The ETags of the feeds include this counter, which is bumped whenever an
+# object that can be in an action is saved or deleted, since the feeds show
+# their names.
+FEED_VERSION_KEY = 'stream:feed:version'
+
+
+class ActionQuerySet(models.QuerySet):
+    """
+    A queryset for the activity feed, which shows the user, target and
+    action object of every action.
+    """
+
+    def with_related(self):
+        """
+        Loads the users along with the actions, and the targets and action
+        objects with one query per content type, instead of a few queries
+        per action.
+        """
+        return self.select_related('user').prefetch_related(
+            'target', 'action_object')
 
 
 class Action(models.Model):
@@ -26,9 +49,13 @@ class Action(models.Model):
         <tim> <tagged> <john> <in the album> <Album Name>
     """
 
-    timestamp = models.DateTimeField(_('timestamp'), default=timezone.now)
+    timestamp = models.DateTimeField(
+        _('timestamp'), default=timezone.now, db_index=True)
     verb = models.CharField(_('verb'), max_length=200)
     join = models.CharField(_('join'), max_length=50, null=True, blank=True)
+    # The number of times the action was repeated, when they were merged in
+    # to one (see stream.utils.flush_buffer).
+    count = models.PositiveIntegerField(_('count'), default=1)
 
     user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name=_('user'))
 
@@ -45,15 +72,28 @@ class Action(models.Model):
     action_object = generic.GenericForeignKey(
         'action_object_content_type', 'action_object_object_id')
 
+    objects = ActionQuerySet.as_manager()
+
     class Meta:
         verbose_name = _('action')
         verbose_name_plural = _('actions')
-        ordering = ['-timestamp', ]
+        ordering = ['-timestamp', '-id', ]
+        index_together = [
+            ['target_content_type', 'target_object_id'],
+            ['action_object_content_type', 'action_object_object_id'],
+        ]
+
+    def get_verb_display(self):
+        """
+        Returns the verb with the count filled in, for verbs such as "added
+        %(count)s photos to the album".
+        """
+        return self.verb % {'count': self.count}
 
     def __str__(self):
         ctx = {
             'actor': self.user.get_full_name() or self.user.username,
-            'verb': self.verb,
+            'verb': self.get_verb_display(),
             'join': self.join,
             'action_object': self.action_object,
             'target': self.target
@@ -68,22 +108,52 @@ class Action(models.Model):
         return '%(actor)s %(verb)s' % ctx
 
 
-def delete_actions_on_delete(sender, **kwargs):
+class StreamModel(models.Model):
     """
-    This signal attempts to delete any activity which is related to Action
-    through a generic relation.
+    An abstract model for the models whose instances can be the target or
+    action object of an action. Their actions are deleted along with them,
+    and since this is a relation that Django knows about, deleting many of
+    them at once (such as the photos of an album) deletes their actions in
+    bulk.
     """
-    content_type = ContentType.objects.get_for_model(kwargs['instance'])
-    instance_pk = kwargs['instance'].pk
 
-    Action.objects.filter(
-        action_object_object_id=instance_pk,
-        action_object_content_type=content_type
-    ).delete()
+    target_actions = GenericRelation(
+        Action, content_type_field='target_content_type',
+        object_id_field='target_object_id')
+    object_actions = GenericRelation(
+        Action, content_type_field='action_object_content_type',
+        object_id_field='action_object_object_id')
+
+    class Meta:
+        abstract = True
+
+
+def get_feed_version():
+    version = cache.get(FEED_VERSION_KEY)
+    if version is None:
+        # Start from the time rather than 1 so a counter that was evicted
+        # can't come back to the version of a stale ETag.
+        version = int(time.time())
+        cache.add(FEED_VERSION_KEY, version, None)
+    return version
+
+
+def bump_feed_version(sender, **kwargs):
+    try:
+        cache.incr(FEED_VERSION_KEY)
+    except ValueError:
+        get_feed_version()
+
+
+def connect_feed_version(sender, **kwargs):
+    """
+    Bumps the feed version when an instance of a StreamModel is saved or
+    deleted. The signals are only connected for those models, so the
+    deletes of other models stay fast.
+    """
+    if issubclass(sender, StreamModel) and not sender._meta.abstract:
+        models.signals.post_save.connect(bump_feed_version, sender=sender)
+        models.signals.post_delete.connect(bump_feed_version, sender=sender)
 
-    Action.objects.filter(
-        target_object_id=instance_pk,
-        target_content_type=content_type
-    ).delete()
 
-models.signals.pre_delete.connect(delete_actions_on_delete)
+models.signals.class_prepared.connect(connect_feed_version)
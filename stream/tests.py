@@ -1,6 +1,18 @@
+import datetime
+import json
+from unittest import mock
+
 from django.test import TestCase, Client
 from django.core.urlresolvers import reverse
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from photos.models import Album, Person, Photo, UploadSession
+from stream.models import Action
+from stream.utils import buffer_actions, send_action
 
 
 class StreamViews(TestCase):
@@ -29,3 +41,241 @@ class StreamViews(TestCase):
         response = client.get(reverse('home'))
         self.assertEqual(response.status_code, 200)
         self.assertTrue('action_list' in response.context)
+
+
+class ActionCleanup(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='jacob', email='jacob@example.com', password='secret')
+
+    def get_action_deletes(self, queries):
+        return [query for query in queries if
+                'DELETE' in query['sql'] and 'stream_action' in query['sql']]
+
+    def test_delete(self):
+        """
+        Test that the actions of a deleted instance are deleted with it.
+        """
+        person = Person.objects.create(name='person')
+        send_action(self.user, 'created the person', target=person)
+        other = Person.objects.create(name='other')
+        send_action(self.user, 'created the person', target=other)
+        person.delete()
+        self.assertEqual(
+            [action.target for action in Action.objects.all()], [other])
+
+    def test_unrelated_models(self):
+        """
+        Test that deleting models that can't be in the stream doesn't touch
+        the actions.
+        """
+        album = Album.objects.create(name='album')
+        session = UploadSession.objects.create(
+            user=self.user, key='key', album=album, filename='photo.jpg',
+            file='photo.jpg', size=1, chunk_size=1,
+            completed=timezone.now())
+        with CaptureQueriesContext(connection) as queries:
+            session.delete()
+        self.assertFalse(self.get_action_deletes(queries))
+
+    def test_cascade(self):
+        """
+        Test that the actions of the photos in a deleted album are deleted in
+        bulk, not one photo at a time.
+        """
+        album = Album.objects.create(name='album')
+        for index in range(5):
+            photo = Photo.objects.create(
+                album=album, name='photo', file='photo%s.jpg' % index)
+            send_action(self.user, 'tagged', action_object=photo)
+        send_action(self.user, 'added photos to', target=album)
+        with CaptureQueriesContext(connection) as queries:
+            album.delete()
+        self.assertFalse(Action.objects.exists())
+        # target and action object, for the album and for its photos
+        self.assertEqual(len(self.get_action_deletes(queries)), 4)
+
+
+class ActionListQueries(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='jacob', email='jacob@example.com', password='secret')
+        self.client.login(username='jacob', password='secret')
+
+    def add_actions(self, count):
+        for index in range(count):
+            album = Album.objects.create(name='album')
+            photo = Photo.objects.create(
+                album=album, name='photo', file='photo%s.jpg' % index)
+            send_action(self.user, 'tagged', action_object=photo,
+                        join='in', target=album)
+            send_action(self.user, 'created the person',
+                        target=Person.objects.create(name='person'))
+
+    def test_constant_queries(self):
+        """
+        Test that the feed takes the same number of queries however many
+        actions it shows.
+        """
+        self.add_actions(1)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('home'))
+        self.assertContains(response, 'album')
+        self.add_actions(5)
+        with self.assertNumQueries(len(queries)):
+            self.client.get(reverse('home'))
+
+
+@mock.patch('stream.views.ACTIONS_PER_PAGE', 2)
+class ActionFeeds(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='jacob', email='jacob@example.com', password='secret')
+        self.client.login(username='jacob', password='secret')
+        self.start = timezone.now()
+        for index, seconds in enumerate([1, 2, 2, 3]):
+            Action.objects.create(
+                user=self.user, verb='did %s' % index,
+                timestamp=self.start + datetime.timedelta(seconds=seconds))
+
+    def get_json(self, url, **kwargs):
+        response = self.client.get(url, **kwargs)
+        return response, json.loads(response.content.decode('utf-8'))
+
+    def test_json_pages(self):
+        """
+        Test that the pages of the feed follow each other without skipping
+        actions that share a timestamp.
+        """
+        verbs = []
+        url = reverse('action_json')
+        while url:
+            response, data = self.get_json(url)
+            verbs.extend(item['verb'] for item in data['items'])
+            url = data.get('next')
+        self.assertEqual(verbs, ['did 3', 'did 2', 'did 1', 'did 0'])
+
+    def test_json_etag(self):
+        """
+        Test that polling the feed returns 304 until there's a new action.
+        """
+        response, data = self.get_json(reverse('action_json'))
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('"'))
+        response = self.client.get(
+            reverse('action_json'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        Action.objects.create(
+            user=self.user, verb='did more',
+            timestamp=self.start + datetime.timedelta(seconds=4))
+        response = self.client.get(
+            reverse('action_json'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_json_etag_rename(self):
+        """
+        Test that renaming the target of an action changes the ETag of the
+        feed, which shows its name.
+        """
+        album = Album.objects.create(name='album')
+        Action.objects.all().delete()
+        send_action(self.user, 'added photos to the album', target=album)
+        response, data = self.get_json(reverse('action_json'))
+        etag = response['ETag']
+        album.name = 'renamed'
+        album.save()
+        response, data = self.get_json(
+            reverse('action_json'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['items'][0]['target']['displayName'], 'renamed')
+
+    def test_atom(self):
+        response = self.client.get(reverse('action_atom'))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'did 3')
+        self.assertContains(response, 'rel="next"')
+
+    def test_html_pages(self):
+        response = self.client.get(reverse('home'))
+        self.assertContains(response, 'did 3')
+        response = self.client.get(response.context['next_url'])
+        self.assertContains(response, 'did 0')
+        self.assertIsNone(response.context['next_url'])
+        for before in ('yesterday', '2014-13-01T00:00:00'):
+            for name in ('home', 'action_json', 'action_atom'):
+                response = self.client.get(reverse(name), {'before': before})
+                self.assertEqual(response.status_code, 404)
+
+
+class ActionMerging(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='jacob', email='jacob@example.com', password='secret')
+        self.album = Album.objects.create(name='album')
+
+    def add_photos(self, count, album=None, user=None):
+        send_action(user or self.user, 'added %(count)s photos to the album',
+                    target=album or self.album, count=count)
+
+    def test_buffer(self):
+        """
+        Test that buffered actions are saved in bulk at the end, with the
+        repeated ones merged.
+        """
+        other = User.objects.create_user(username='other')
+        with CaptureQueriesContext(connection) as queries:
+            with buffer_actions():
+                for index in range(3):
+                    self.add_photos(2)
+                    self.add_photos(1, user=other)
+                self.assertFalse(queries)
+        self.assertEqual(
+            sorted(action.get_verb_display()
+                   for action in Action.objects.all()),
+            ['added 3 photos to the album', 'added 6 photos to the album'])
+
+    def test_merge_saved(self):
+        """
+        Test that an action is merged in to the latest saved action of the
+        user, but only if that repeats it and is recent enough.
+        """
+        self.add_photos(2)
+        self.add_photos(3)
+        self.assertEqual(Action.objects.get().count, 5)
+
+        send_action(self.user, 'created the person',
+                    target=Person.objects.create(name='person'))
+        self.add_photos(1)
+        self.add_photos(1, album=Album.objects.create(name='other'))
+        self.assertEqual(
+            list(Action.objects.values_list('count', flat=True)),
+            [1, 1, 1, 5])
+
+        Action.objects.update(timestamp=timezone.now() - datetime.timedelta(
+            seconds=settings.STREAM_MERGE_WINDOW + 1))
+        self.add_photos(1, album=Album.objects.get(name='other'))
+        self.assertEqual(Action.objects.count(), 5)
+
+    def test_request(self):
+        """
+        Test that the actions of a request are saved once it is done, and
+        dropped if it fails.
+        """
+        self.user.is_superuser = True
+        self.user.save()
+        self.client.login(username='jacob', password='secret')
+        self.client.post(reverse('location_create'), {'name': 'location'},
+                         HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(Action.objects.get().verb, 'created the location')
+        with mock.patch('photos.views.location.json_redirect',
+                        side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                self.client.post(
+                    reverse('location_create'), {'name': 'other'},
+                    HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(Action.objects.count(), 1)
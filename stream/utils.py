@@ -1,13 +1,152 @@
+import datetime
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import models, transaction
+from django.db.models import Q
+
 from stream.models import Action
+from utils.db import raw_delete
+
+# Number of object IDs in each query of delete_actions, which stays below the
+# limit of 999 query parameters of SQLite.
+BATCH_SIZE = 400
+
+# The fields that decide whether two actions can be merged.
+MERGE_FIELDS = ['timestamp', 'verb', 'join', 'user', 'target_content_type',
+                'target_object_id', 'action_object_content_type',
+                'action_object_object_id']
+
+# The actions sent in this thread that haven't been saved yet, when buffering.
+_buffer = threading.local()
+
+
+def get_merge_key(action):
+    # The object IDs are only strings once the action has been saved.
+    return (action.user_id, action.verb, action.join,
+            action.target_content_type_id,
+            get_object_id(action.target_object_id),
+            action.action_object_content_type_id,
+            get_object_id(action.action_object_object_id))
+
+
+def get_object_id(object_id):
+    return None if object_id is None else str(object_id)
+
+
+def can_merge(action, later):
+    """
+    Returns whether the later action repeats the same thing soon enough to
+    be merged in to action.
+    """
+    window = datetime.timedelta(seconds=settings.STREAM_MERGE_WINDOW)
+    return get_merge_key(action) == get_merge_key(later) and \
+        later.timestamp - action.timestamp <= window
+
+
+def start_buffer():
+    """
+    Starts buffering the actions sent in this thread until flush_buffer is
+    called. ActionBufferMiddleware does this for every request.
+    """
+    _buffer.actions = []
+
+
+def discard_buffer():
+    _buffer.__dict__.pop('actions', None)
+
+
+def flush_buffer():
+    """
+    Saves the buffered actions and stops buffering. Consecutive actions of a
+    user that can be merged are saved as one action with their total count,
+    and the first one of each user is merged in to the latest saved action
+    of the user if it can be, so a burst of uploads ends up as a single
+    "added 312 photos to the album".
+    """
+    actions = _buffer.__dict__.pop('actions', None)
+    if not actions:
+        return
+    last_actions = {}
+    merged = []
+    for action in actions:
+        last = last_actions.get(action.user_id)
+        if last is not None and can_merge(last, action):
+            last.count += action.count
+            last.timestamp = action.timestamp
+        else:
+            last_actions[action.user_id] = action
+            merged.append(action)
+
+    with transaction.atomic():
+        new_actions = []
+        users = set()
+        for action in merged:
+            if action.user_id in users:
+                new_actions.append(action)
+                continue
+            users.add(action.user_id)
+            latest = Action.objects.filter(user=action.user_id).only(
+                *MERGE_FIELDS).first()
+            if latest is not None and can_merge(latest, action):
+                Action.objects.filter(pk=latest.pk).update(
+                    count=models.F('count') + action.count,
+                    timestamp=action.timestamp)
+            else:
+                new_actions.append(action)
+        Action.objects.bulk_create(new_actions)
 
 
-def send_action(user, verb, action_object=None, join=None, target=None):
+@contextmanager
+def buffer_actions():
+    """
+    Buffers the actions sent in the with block and saves them at the end,
+    for long running code outside of requests such as management commands.
+    Inside a buffer that was already started, the actions are left to it.
+    """
+    if hasattr(_buffer, 'actions'):
+        yield
+        return
+    start_buffer()
+    try:
+        yield
+    except Exception:
+        discard_buffer()
+        raise
+    flush_buffer()
+
+
+def send_action(user, verb, action_object=None, join=None, target=None,
+                count=1):
     """
     A shortcut method for creating an Action instance. This helps abstract out
     the actual Action model so other apps don't really need to know about its
     implementation.
+    The verb can include the count as %(count)s, such as "added %(count)s
+    photos to the album", so that repeated actions can be merged. While a
+    buffer is started (such as during a request) the action is saved when
+    the buffer is flushed, otherwise right away.
     """
-    action = Action.objects.create(
+    action = Action(
         user=user, verb=verb, action_object=action_object, join=join,
-        target=target)
+        target=target, count=count)
+    with buffer_actions():
+        _buffer.actions.append(action)
     return action
+
+
+def delete_actions(model, object_ids):
+    """
+    Deletes the actions whose action object or target is one of the given
+    instances of model, for when they are deleted in bulk without signals.
+    """
+    content_type = ContentType.objects.get_for_model(model)
+    object_ids = [str(pk) for pk in object_ids]
+    for start in range(0, len(object_ids), BATCH_SIZE):
+        batch = object_ids[start:start + BATCH_SIZE]
+        raw_delete(Action.objects.filter(
+            Q(action_object_content_type=content_type,
+              action_object_object_id__in=batch) |
+            Q(target_content_type=content_type, target_object_id__in=batch)))
@@ -1,10 +1,186 @@
+import hashlib
+import json
+
 from django.contrib.auth.decorators import login_required
+from django.core.urlresolvers import reverse
+from django.http import Http404, HttpResponse
 from django.shortcuts import render
+from django.utils.dateparse import parse_datetime
+from django.utils.feedgenerator import Atom1Feed
+from django.utils.http import urlencode
+from django.utils.timezone import is_naive, make_aware, utc
+from django.utils.translation import ugettext as _
+from django.views.decorators.http import condition
+
+from stream.models import Action, get_feed_version
+
+ACTIONS_PER_PAGE = 50
+
+
+def get_before(request):
+    """
+    Returns the timestamp in the "before" GET parameter, or None for the
+    latest actions.
+    """
+    before = request.GET.get('before')
+    if not before:
+        return None
+    try:
+        timestamp = parse_datetime(before)
+    except ValueError:
+        # Well formatted, but not a real date or time.
+        timestamp = None
+    if timestamp is None:
+        raise Http404('Invalid timestamp: %s' % before)
+    if is_naive(timestamp):
+        timestamp = make_aware(timestamp, utc)
+    return timestamp
+
+
+def get_actions(request):
+    """
+    Returns the page of actions before the timestamp in the "before" GET
+    parameter, newest first, and the timestamp to get the next (older) page
+    with, or None if this is the last page. The timestamp index makes every
+    page as fast as the first. A page that ends in the middle of actions with
+    the same timestamp is extended with the rest of them, so that paging by
+    timestamp never skips any.
+    """
+    queryset = Action.objects.with_related()
+    before = get_before(request)
+    if before is not None:
+        queryset = queryset.filter(timestamp__lt=before)
+    actions = list(queryset[:ACTIONS_PER_PAGE + 1])
+    if len(actions) <= ACTIONS_PER_PAGE:
+        return actions, None
+    last = actions[ACTIONS_PER_PAGE - 1]
+    actions = actions[:ACTIONS_PER_PAGE]
+    actions.extend(queryset.filter(
+        timestamp=last.timestamp, id__lt=last.pk))
+    return actions, actions[-1].timestamp
+
+
+def get_page_url(request, name, before):
+    if before is None:
+        return None
+    return '%s?%s' % (reverse(name), urlencode({'before': before.isoformat()}))
+
+
+def get_feed_etag(request):
+    """
+    Returns a strong ETag for a page of the JSON or Atom feed, built from
+    the IDs, timestamps and counts of its actions and the version of the
+    names they show (see get_feed_version). Polling clients get a 304 for
+    the price of a single index scan when nothing was added, merged,
+    deleted or renamed.
+    """
+    before = get_before(request)
+    queryset = Action.objects.all()
+    if before is not None:
+        queryset = queryset.filter(timestamp__lt=before)
+    rows = queryset.values_list(
+        'id', 'timestamp', 'count')[:ACTIONS_PER_PAGE + 1]
+    key = '%s|%s|%s|%r' % (
+        request.path, before, get_feed_version(), list(rows))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
 
-from stream.models import Action
+
+def get_object_data(request, obj):
+    """
+    Returns an activitystrea.ms JSON object for the target or action object
+    of an action.
+    """
+    data = {
+        'objectType': obj._meta.model_name,
+        'displayName': str(obj),
+    }
+    url = getattr(obj, 'get_absolute_url', None)
+    if url:
+        data['url'] = request.build_absolute_uri(url())
+    return data
 
 
 @login_required
 def action_list(request):
-    context = {'action_list': Action.objects.all()[:50]}
+    actions, before = get_actions(request)
+    context = {
+        'action_list': actions,
+        'next_url': get_page_url(request, 'home', before),
+    }
     return render(request, 'stream/action_list.html', context)
+
+
+@login_required
+@condition(etag_func=get_feed_etag)
+def action_json(request):
+    """
+    The activity feed as activitystrea.ms JSON, with a link to the next
+    page.
+    """
+    actions, before = get_actions(request)
+    items = []
+    for action in actions:
+        item = {
+            'id': action.pk,
+            'published': action.timestamp.isoformat(),
+            'actor': {
+                'objectType': 'person',
+                'displayName': action.user.get_full_name() or
+                action.user.username,
+            },
+            'verb': action.get_verb_display(),
+            'title': str(action),
+        }
+        if action.action_object:
+            item['object'] = get_object_data(request, action.action_object)
+        if action.target:
+            item['target'] = get_object_data(request, action.target)
+        items.append(item)
+    data = {'items': items}
+    next_url = get_page_url(request, 'action_json', before)
+    if next_url:
+        data['next'] = request.build_absolute_uri(next_url)
+    return HttpResponse(json.dumps(data), content_type='application/json')
+
+
+class PagedAtom1Feed(Atom1Feed):
+    """
+    An Atom feed with a link to its next page (RFC 5005).
+    """
+
+    def add_root_elements(self, handler):
+        super().add_root_elements(handler)
+        if self.feed.get('next_url'):
+            handler.addQuickElement(
+                'link', '', {'rel': 'next', 'href': self.feed['next_url']})
+
+
+@login_required
+@condition(etag_func=get_feed_etag)
+def action_atom(request):
+    """
+    The activity feed as an Atom feed, with a link to the next page.
+    """
+    actions, before = get_actions(request)
+    next_url = get_page_url(request, 'action_atom', before)
+    feed = PagedAtom1Feed(
+        title=_('Recent Activity'),
+        link=request.build_absolute_uri(reverse('home')),
+        description='',
+        feed_url=request.build_absolute_uri(),
+        next_url=next_url and request.build_absolute_uri(next_url))
+    for action in actions:
+        obj = action.target or action.action_object
+        url = getattr(obj, 'get_absolute_url', None)
+        feed.add_item(
+            title=str(action),
+            link=request.build_absolute_uri(url() if url else reverse('home')),
+            description='',
+            unique_id=request.build_absolute_uri(
+                '%s#action-%s' % (reverse('home'), action.pk)),
+            pubdate=action.timestamp,
+            updateddate=action.timestamp,
+            author_name=action.user.get_full_name() or action.user.username)
+    response = HttpResponse(content_type=feed.mime_type)
+    feed.write(response, 'utf-8')
+    return response
@@ -0,0 +1,44 @@
+from django.db import connections, DEFAULT_DB_ALIAS, transaction
+
+
+def on_commit(func, using=None):
+    """
+    Calls func once the current transaction commits, or right away when
+    there is no transaction, and forgets it if the transaction is rolled
+    back. Django 1.7 has no transaction.on_commit, so the hooks come from the
+    database backends in utils.db.backends; with any other backend func is
+    called right away.
+    """
+    if hasattr(transaction, 'on_commit'):
+        transaction.on_commit(func, using=using)
+        return
+    connection = connections[using or DEFAULT_DB_ALIAS]
+    if hasattr(connection, 'on_commit'):
+        connection.on_commit(func)
+    else:
+        func()
+
+
+def raw_delete(queryset):
+    """
+    Deletes the rows of a queryset in a single DELETE query without loading
+    them. No signals are sent and nothing is cascaded, so the rows that refer
+    to them have to be deleted first.
+    """
+    queryset._raw_delete(using=queryset.db)
+
+
+def insert_from_select(model, columns, queryset):
+    """
+    Inserts a row in to the table of model for every row of queryset, which
+    has to select the given columns in order (with values_list()), in a
+    single INSERT ... SELECT query.
+    """
+    connection = connections[queryset.db]
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    quote_name = connection.ops.quote_name
+    connection.cursor().execute('INSERT INTO %s (%s) %s' % (
+        quote_name(model._meta.db_table),
+        ', '.join(quote_name(model._meta.get_field(column).column)
+                  for column in columns),
+        sql), params)
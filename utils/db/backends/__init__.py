@@ -0,0 +1,47 @@
+"""
+Database backends with transaction hooks: functions that run after the
+current transaction commits, so that files on disk are only touched once the
+rows that point at them are final. Use them as the ENGINE of a database, for
+example 'utils.db.backends.sqlite3', and register hooks with
+utils.db.on_commit.
+"""
+
+
+class TransactionHooksMixin:
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Pairs of the savepoints open when the hook was added and the hook.
+        self.run_on_commit = []
+
+    def on_commit(self, func):
+        if self.in_atomic_block:
+            self.run_on_commit.append((set(self.savepoint_ids), func))
+        elif not self.get_autocommit():
+            # Transactions managed by hand don't tell us when they end.
+            self.run_on_commit.append((set(), func))
+        else:
+            func()
+
+    def run_and_clear_commit_hooks(self):
+        hooks, self.run_on_commit = self.run_on_commit, []
+        for savepoint_ids, func in hooks:
+            func()
+
+    def commit(self):
+        super().commit()
+        if not self.in_atomic_block:
+            self.run_and_clear_commit_hooks()
+
+    def rollback(self):
+        super().rollback()
+        self.run_on_commit = []
+
+    def savepoint_rollback(self, sid):
+        super().savepoint_rollback(sid)
+        self.run_on_commit = [
+            (savepoint_ids, func) for savepoint_ids, func in self.run_on_commit
+            if sid not in savepoint_ids]
+
+    def close(self):
+        super().close()
+        self.run_on_commit = []
@@ -0,0 +1,9 @@
+from django.db.backends.postgresql_psycopg2.base import *  # NOQA
+from django.db.backends.postgresql_psycopg2.base import \
+    DatabaseWrapper as BaseWrapper
+
+from utils.db.backends import TransactionHooksMixin
+
+
+class DatabaseWrapper(TransactionHooksMixin, BaseWrapper):
+    pass
@@ -0,0 +1,8 @@
+from django.db.backends.sqlite3.base import *  # NOQA
+from django.db.backends.sqlite3.base import DatabaseWrapper as BaseWrapper
+
+from utils.db.backends import TransactionHooksMixin
+
+
+class DatabaseWrapper(TransactionHooksMixin, BaseWrapper):
+    pass
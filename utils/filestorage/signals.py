@@ -1,45 +1,103 @@
+from functools import partial
+
 from django.db.models import FileField
 
+from utils.db import on_commit
+
+
+def file_is_shared(instance, field, name):
+    """
+    Returns whether a file is still referenced by another instance of the same
+    model, such as photos that share the stored file of a duplicate. Shared
+    files must not be deleted along with one of their instances.
+    """
+    return instance.__class__._default_manager.filter(
+        **{field.name: name}).exclude(pk=instance.pk).exists()
+
 
 def delete_files_on_delete(sender, instance, **kwargs):
     """
     Deletes files from filesystem when corresponding instance object is
-    deleted.
+    deleted, unless another instance still uses them. This runs on
+    post_delete and waits for the deletion to commit, because Django sends
+    pre_delete for every object of a bulk delete before deleting any rows,
+    so instances that share a file and are deleted together would each see
+    the others still using it.
+    """
+    for field in get_file_fields(instance):
+        name = getattr(instance, field.attname).name
+        if name:
+            on_commit(partial(delete_unused_file, instance, field, name))
+
+
+def get_file_fields(instance):
+    return [field for field in instance._meta.fields
+            if isinstance(field, FileField)]
+
+
+def get_file_name(value):
+    return getattr(value, 'name', value)
+
+
+def remember_files_on_init(sender, instance, **kwargs):
     """
-    for field in instance._meta.fields:
-        if not isinstance(field, FileField):
-            continue
-        file_field = getattr(instance, field.name)
-        storage = file_field.storage
+    Remembers the names of the files an instance was loaded with, so
+    delete_files_on_change can tell whether they changed without loading
+    the instance again. The raw value is read instead of the field, because
+    building a FieldFile for every row of a queryset isn't free.
+    """
+    instance._original_files = {
+        field.attname: get_file_name(instance.__dict__.get(field.attname))
+        for field in get_file_fields(instance)}
+
+
+def get_original_files(instance):
+    """
+    Returns the names of the files the instance had when it was loaded or
+    last saved. Deferred instances (from only() or defer()) don't send
+    post_init for the model, so those are loaded from the database.
+    """
+    original_files = getattr(instance, '_original_files', None)
+    if original_files is None:
         try:
-            path = file_field.path
-        except ValueError:
-            # This means that for some reason the file is already deleted.
-            return False
-        storage.delete(path)
+            old_instance = instance.__class__._default_manager.get(
+                pk=instance.pk)
+        except instance.__class__.DoesNotExist:
+            return {}
+        remember_files_on_init(sender=None, instance=old_instance)
+        original_files = old_instance._original_files
+    return original_files
 
 
 def delete_files_on_change(sender, instance, **kwargs):
     """
-    Deletes old file from filesystem when a file is changed on an instance.
+    Notes the old files that are changed on an instance, so
+    delete_changed_files can delete them after the save.
     """
+    instance._changed_files = []
     if not instance.pk:
         return False
 
-    try:
-        old_instance = instance.__class__.objects.get(pk=instance.pk)
-    except instance.__class__.DoesNotExist:
-        return False
+    original_files = get_original_files(instance)
+    for field in get_file_fields(instance):
+        old_name = original_files.get(field.attname)
+        if old_name and old_name != getattr(instance, field.attname).name:
+            instance._changed_files.append((field, old_name))
 
-    for field in instance._meta.fields:
-        if not isinstance(field, FileField):
-            continue
-        old_file_field = getattr(old_instance, field.name)
-        new_file_field = getattr(instance, field.name)
-        try:
-            path = old_file_field.path
-        except ValueError:
-            # This means that for some reason the file is already deleted.
-            return False
-        if old_file_field.name != new_file_field.name:
-            old_file_field.storage.delete(path)
+
+def delete_changed_files(sender, instance, **kwargs):
+    """
+    Deletes the old files noted by delete_files_on_change from filesystem,
+    unless another instance still uses them. They are deleted once the save
+    has committed, so a transaction that is rolled back leaves them in
+    place.
+    """
+    for field, name in getattr(instance, '_changed_files', []):
+        on_commit(partial(delete_unused_file, instance, field, name))
+    instance._changed_files = []
+    remember_files_on_init(sender, instance)
+
+
+def delete_unused_file(instance, field, name):
+    if not file_is_shared(instance, field, name):
+        field.storage.delete(name)
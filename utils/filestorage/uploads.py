@@ -1,6 +1,10 @@
+import hashlib
 import os
 import uuid
 
+from django.core.files.uploadhandler import MemoryFileUploadHandler, \
+    TemporaryFileUploadHandler
+
 
 def get_unique_upload_path(instance, filename):
     """
@@ -13,3 +17,56 @@ def get_unique_upload_path(instance, filename):
     new_filename = "%s%s" % (
         str(uuid.uuid4()).replace("-", ""), extension.lower())
     return os.path.join(instance._meta.app_label.lower(), new_filename)
+
+
+def file_sha256(file_handle, chunk_size=64 * 1024):
+    """
+    Returns the SHA-256 hex digest of the contents of a file, reading it in
+    chunks. Files that can seek are read from the start and rewound
+    afterwards, others (such as zip members) from where they are.
+    """
+    sha256 = hashlib.sha256()
+    seekable = getattr(file_handle, 'seekable', lambda: True)()
+    if seekable:
+        file_handle.seek(0)
+    for chunk in iter(lambda: file_handle.read(chunk_size), b''):
+        sha256.update(chunk)
+    if seekable:
+        file_handle.seek(0)
+    return sha256.hexdigest()
+
+
+class HashingUploadHandlerMixin:
+    """
+    Computes the SHA-256 digest of an uploaded file while it streams in and
+    sets it as the sha256 attribute of the resulting UploadedFile, so the
+    file never has to be read again to be hashed.
+    """
+
+    def new_file(self, *args, **kwargs):
+        # The memory handler raises StopFutureHandlers from new_file.
+        self.sha256 = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        # The memory handler passes big files on to the next handler, which
+        # hashes them itself.
+        if getattr(self, 'activated', True):
+            self.sha256.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        uploaded_file = super().file_complete(file_size)
+        if uploaded_file is not None:
+            uploaded_file.sha256 = self.sha256.hexdigest()
+        return uploaded_file
+
+
+class HashingMemoryFileUploadHandler(HashingUploadHandlerMixin,
+                                     MemoryFileUploadHandler):
+    pass
+
+
+class HashingTemporaryFileUploadHandler(HashingUploadHandlerMixin,
+                                        TemporaryFileUploadHandler):
+    pass
@@ -0,0 +1,166 @@
+"""
+Lossless changes to JPEG files: transforming the compressed image with
+jpegtran, which moves the DCT blocks around instead of decoding and encoding
+the image again, and rewriting the EXIF orientation tag.
+"""
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+
+from django.conf import settings
+
+# The jpegtran options for each transform, named after what it does to the
+# image (rotations are clockwise).
+JPEGTRAN_OPTIONS = {
+    'flip_horizontal': ['-flip', 'horizontal'],
+    'flip_vertical': ['-flip', 'vertical'],
+    'rotate_90': ['-rotate', '90'],
+    'rotate_180': ['-rotate', '180'],
+    'rotate_270': ['-rotate', '270'],
+    'transpose': ['-transpose'],
+    'transverse': ['-transverse'],
+}
+
+ORIENTATION_TAG = 0x0112
+
+
+def replace_file(path, write):
+    """
+    Replaces the file at path with the one that write(temp_path) writes, so
+    readers never see a half-written file. The new file keeps the
+    permissions of the old one.
+    """
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), suffix=os.path.splitext(path)[1])
+    os.close(fd)
+    try:
+        write(temp_path)
+        shutil.copymode(path, temp_path)
+        os.replace(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+def jpegtran(path, transform):
+    """
+    Applies a transform (see JPEGTRAN_OPTIONS) to the JPEG at path with
+    jpegtran, keeping all its metadata. Returns False and leaves the file
+    alone when the JPEGTRAN setting is None, jpegtran isn't installed, or it
+    can't transform the image perfectly, which is the case when the
+    dimensions of the image aren't a multiple of the block size.
+    """
+    command = settings.JPEGTRAN and shutil.which(settings.JPEGTRAN)
+    if not command:
+        return False
+
+    def write(temp_path):
+        subprocess.check_call(
+            [command, '-copy', 'all', '-perfect'] +
+            JPEGTRAN_OPTIONS[transform] + ['-outfile', temp_path, path],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        replace_file(path, write)
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return True
+
+
+def read_segments(file_handle):
+    """
+    Yields the offset, marker and data of each segment of a JPEG up to the
+    image data.
+    """
+    if file_handle.read(2) != b'\xff\xd8':
+        raise ValueError('Not a JPEG file.')
+    while True:
+        offset = file_handle.tell()
+        header = file_handle.read(4)
+        if len(header) < 4 or header[0] != 0xFF:
+            return
+        marker, length = header[1], struct.unpack('>H', header[2:])[0]
+        if marker == 0xDA:
+            # The image data starts here.
+            return
+        yield offset, marker, file_handle.read(length - 2)
+
+
+def find_orientation(file_handle):
+    """
+    Returns where the value of the EXIF orientation tag of a JPEG is (its
+    offset in the file and the byte order of the EXIF data), None if the
+    EXIF data has no orientation tag, or False if the file has no EXIF data.
+    EXIF data that points past the end of its segment is taken to have no
+    orientation tag.
+    """
+    for offset, marker, data in read_segments(file_handle):
+        if marker != 0xE1 or not data.startswith(b'Exif\x00\x00'):
+            continue
+        tiff = data[6:]
+        byte_order = '<' if tiff[:2] == b'II' else '>'
+        try:
+            ifd = struct.unpack(byte_order + 'L', tiff[4:8])[0]
+            if ifd + 2 > len(tiff):
+                return None
+            count = struct.unpack(byte_order + 'H', tiff[ifd:ifd + 2])[0]
+        except struct.error:
+            return None
+        for index in range(count):
+            entry = ifd + 2 + index * 12
+            if entry + 12 > len(tiff):
+                return None
+            tag, value_type = struct.unpack(
+                byte_order + 'HH', tiff[entry:entry + 4])
+            if tag == ORIENTATION_TAG and value_type == 3:
+                # The value of the entry is after the tag, the type and the
+                # count, in the segment after its header and 'Exif\0\0'.
+                return offset + 4 + 6 + entry + 8, byte_order
+        return None
+    return False
+
+
+def exif_segment(orientation):
+    """
+    Returns an APP1 segment with EXIF data that holds only an orientation.
+    """
+    tiff = b'MM\x00\x2a' + struct.pack(
+        '>LHHHLHHL', 8, 1, ORIENTATION_TAG, 3, 1, orientation, 0, 0)
+    data = b'Exif\x00\x00' + tiff
+    return b'\xff\xe1' + struct.pack('>H', len(data) + 2) + data
+
+
+def set_orientation(path, orientation):
+    """
+    Sets the EXIF orientation of the JPEG at path. The orientation tag is
+    rewritten in place, and a JPEG without EXIF data gets a segment with
+    just the orientation after its JFIF header. Neither touches the image
+    data. Returns False when the EXIF data has no orientation tag, which
+    can't be added without rewriting the EXIF data.
+    """
+    with open(path, 'r+b') as file_handle:
+        location = find_orientation(file_handle)
+        if location:
+            offset, byte_order = location
+            file_handle.seek(offset)
+            file_handle.write(struct.pack(byte_order + 'H', orientation))
+            return True
+        if location is None:
+            return False
+        file_handle.seek(0)
+        insert_at = 2
+        for offset, marker, data in read_segments(file_handle):
+            if marker != 0xE0:
+                break
+            insert_at = offset + 4 + len(data)
+
+    def write(temp_path):
+        with open(path, 'rb') as source, open(temp_path, 'wb') as target:
+            target.write(source.read(insert_at))
+            target.write(exif_segment(orientation))
+            shutil.copyfileobj(source, target)
+
+    replace_file(path, write)
+    return True
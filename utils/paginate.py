@@ -1,4 +1,9 @@
+import base64
+import binascii
+import json
+
 from django.core.paginator import Paginator, InvalidPage
+from django.db.models import Q
 from django.http import Http404
 
 
@@ -44,3 +49,162 @@ def paginate(request, queryset, page_size, page_arg="p", allow_empty=True):
         paginator.next_url = build_page_url(page.next_page_number())
 
     return (paginator, page.object_list)
+
+
+class KeysetPage:
+    """
+    A page of a keyset paginated list. Mimics the parts of Django's Page that
+    the templates use.
+    """
+
+    def __init__(self, object_list, start_index, has_previous, has_next):
+        self.object_list = object_list
+        self._start_index = start_index
+        self._has_previous = has_previous
+        self._has_next = has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_next(self):
+        return self._has_next
+
+    def start_index(self):
+        return self._start_index if self.object_list else 0
+
+    def end_index(self):
+        return self._start_index + len(self.object_list) - 1
+
+
+class KeysetPaginator:
+    """
+    The paginator returned by keyset_paginate. It has the same "count",
+    "this_page", "page_arg", "previous_url" and "next_url" variables as the
+    paginator returned by paginate. The count is only queried if it wasn't
+    given and something actually uses it.
+    """
+
+    def __init__(self, queryset, count=None):
+        self.queryset = queryset
+        self._count = count
+
+    @property
+    def count(self):
+        if self._count is None:
+            self._count = self.queryset.count()
+        return self._count
+
+
+def encode_cursor(direction, position, values):
+    """
+    Encodes the position and the ordering key of a row into an opaque cursor
+    for the URL. The direction is '>' for the rows after the key and '<' for
+    the rows before it.
+    """
+    data = json.dumps([direction, position, values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, fields):
+    """
+    Decodes a cursor created by encode_cursor. Raises ValueError if the
+    cursor is not valid for the given ordering fields.
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        direction, position, values = json.loads(data.decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError, binascii.Error):
+        raise ValueError('The cursor could not be decoded.')
+    if direction not in ('<', '>') or not isinstance(position, int) or \
+            position < 1 or not isinstance(values, list) or \
+            len(values) != len(fields):
+        raise ValueError('The cursor is not valid for this list.')
+    return direction, position, values
+
+
+def keyset_filter(ordering, values, direction):
+    """
+    Returns the Q object that selects the rows after (direction '>') or
+    before (direction '<') the given values of the ordering fields. Fields
+    starting with '-' are ordered descending. The condition on the first
+    field is repeated as an inclusive bound so that the database can use it
+    for an index range scan.
+    """
+    def is_after(field):
+        return field.startswith('-') == (direction == '<')
+
+    first = ordering[0]
+    bound = Q(**{'%s__%s' % (first.lstrip('-'), 'gte' if is_after(first)
+                             else 'lte'): values[0]})
+    condition = Q()
+    for index, field in enumerate(ordering):
+        lookup = {'%s__%s' % (field.lstrip('-'), 'gt' if is_after(field)
+                              else 'lt'): values[index]}
+        for previous, value in zip(ordering[:index], values):
+            lookup[previous.lstrip('-')] = value
+        condition |= Q(**lookup)
+    return bound & condition
+
+
+def keyset_paginate(request, queryset, page_size, ordering=('name', 'id'),
+                    page_arg="c", count=None):
+    """
+    Paginates a queryset with keyset (seek) pagination instead of counting
+    and offsetting. Each page is fetched as the first rows after (or before)
+    the ordering key of the row at the edge of the neighbouring page, so deep
+    pages are as fast as the first one. The ordering fields must uniquely
+    order the queryset and must not be null. The page is given by an opaque
+    cursor in the page_arg GET parameter. Pass the total count if it is known
+    to avoid a COUNT query.
+    Returns the paginator instance and the object list for the current page,
+    just like paginate does.
+    """
+    ordering = list(ordering)
+    reverse_ordering = [field[1:] if field.startswith('-') else '-' + field
+                        for field in ordering]
+    direction, position = '>', 1
+    cursor = request.GET.get(page_arg)
+    if cursor:
+        try:
+            direction, position, values = decode_cursor(cursor, ordering)
+        except ValueError as e:
+            raise Http404('Invalid page (%s): %s' % (cursor, str(e)))
+        queryset_page = queryset.filter(
+            keyset_filter(ordering, values, direction))
+    else:
+        queryset_page = queryset
+
+    if direction == '>':
+        rows = list(queryset_page.order_by(*ordering)[:page_size + 1])
+        object_list = rows[:page_size]
+        has_next = len(rows) > page_size
+        has_previous = position > 1
+    else:
+        rows = list(queryset_page.order_by(*reverse_ordering)[:page_size + 1])
+        object_list = rows[:page_size][::-1]
+        has_next = True
+        has_previous = len(rows) > page_size
+        position = max(position - page_size, 1)
+
+    paginator = KeysetPaginator(queryset, count)
+    paginator.this_page = KeysetPage(
+        object_list, position, has_previous, has_next)
+    paginator.page_arg = page_arg
+
+    def build_page_url(direction, position, obj):
+        values = [getattr(obj, field.lstrip('-')) for field in ordering]
+        get_params = request.GET.copy()
+        get_params[page_arg] = encode_cursor(direction, position, values)
+        return '%s?%s' % (request.path, get_params.urlencode())
+
+    paginator.previous_url = None
+    if has_previous and object_list:
+        paginator.previous_url = build_page_url(
+            '<', position, object_list[0])
+
+    paginator.next_url = None
+    if has_next and object_list:
+        paginator.next_url = build_page_url(
+            '>', position + len(object_list), object_list[-1])
+
+    return (paginator, object_list)
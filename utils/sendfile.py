@@ -0,0 +1,156 @@
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified, \
+    StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe, urlquote
+from django.views.static import was_modified_since
+
+CHUNK_SIZE = 64 * 1024
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def get_etag(stat):
+    """
+    Returns a strong ETag built from the modification time and size of a
+    file, which is enough to tell if a photo has been replaced or rotated.
+    """
+    return '"%x-%x"' % (int(stat.st_mtime), stat.st_size)
+
+
+def parse_range(header, size):
+    """
+    Parses a Range header into an inclusive (first, last) byte range of a
+    file of the given size. Returns None when the whole file should be sent,
+    which includes headers that can't be parsed and requests for multiple
+    ranges, and raises ValueError when the range can't be satisfied.
+    """
+    match = RANGE_RE.match(header.replace(' ', ''))
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # bytes=-500 is the last 500 bytes.
+        length = int(last)
+        if length == 0:
+            raise ValueError('Empty suffix range.')
+        return max(size - length, 0), size - 1
+    first = int(first)
+    last = int(last) if last else size - 1
+    if first >= size or last < first:
+        raise ValueError('Range not satisfiable.')
+    return first, min(last, size - 1)
+
+
+def iter_file(file_handle, first, length):
+    """
+    Yields length bytes of the file starting at first, in chunks.
+    """
+    file_handle.seek(first)
+    while length > 0:
+        chunk = file_handle.read(min(CHUNK_SIZE, length))
+        if not chunk:
+            break
+        length -= len(chunk)
+        yield chunk
+
+
+def offload_response(path):
+    """
+    Returns an empty response that tells the web server to send the file
+    itself, or None when SENDFILE_BACKEND isn't set. nginx handles the Range
+    and conditional headers of X-Accel-Redirect responses on its own.
+    """
+    backend = getattr(settings, 'SENDFILE_BACKEND', None)
+    if backend == 'x-sendfile':
+        response = HttpResponse()
+        response['X-Sendfile'] = path
+        return response
+    if backend == 'x-accel-redirect':
+        relative_path = os.path.relpath(
+            path, settings.MEDIA_ROOT).replace(os.sep, '/')
+        response = HttpResponse()
+        response['X-Accel-Redirect'] = settings.SENDFILE_URL + \
+            urlquote(relative_path)
+        return response
+    return None
+
+
+def serve_file(request, path, filename=None, content_type=None):
+    """
+    Returns a response that sends the file at path without reading it in to
+    memory.
+    - If SENDFILE_BACKEND is set, then the web server sends the file.
+    - Otherwise the file is streamed, honouring If-None-Match,
+      If-Modified-Since, Range and If-Range so that interrupted downloads of
+      big files can be resumed. Whole files are handed to the WSGI server's
+      file wrapper (see gallery.wsgi) so it can use sendfile.
+    """
+    if content_type is None:
+        content_type = mimetypes.guess_type(path, strict=False)[0] or \
+            'application/octet-stream'
+
+    response = offload_response(path)
+    if response is not None:
+        response['Content-Type'] = content_type
+        if filename:
+            response['Content-Disposition'] = \
+                'attachment; filename=%s' % filename
+        return response
+
+    stat = os.stat(path)
+    etag = get_etag(stat)
+    last_modified = http_date(stat.st_mtime)
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        not_modified = if_none_match.strip() == '*' or etag in [
+            tag.strip() for tag in if_none_match.split(',')]
+    else:
+        not_modified = not was_modified_since(
+            request.META.get('HTTP_IF_MODIFIED_SINCE'),
+            stat.st_mtime, stat.st_size)
+    if not_modified:
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        response['Last-Modified'] = last_modified
+        return response
+
+    byte_range = None
+    range_header = request.META.get('HTTP_RANGE')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if range_header and (if_range is None or if_range == etag or
+                         parse_http_date_safe(if_range) == int(stat.st_mtime)):
+        try:
+            byte_range = parse_range(range_header, stat.st_size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % stat.st_size
+            return response
+
+    file_handle = open(path, 'rb')
+    if byte_range is None:
+        first, last = 0, stat.st_size - 1
+        response = StreamingHttpResponse(
+            iter_file(file_handle, 0, stat.st_size),
+            content_type=content_type)
+        response.file_to_stream = file_handle
+    else:
+        first, last = byte_range
+        response = StreamingHttpResponse(
+            iter_file(file_handle, first, last - first + 1),
+            content_type=content_type, status=206)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (
+            first, last, stat.st_size)
+    response._closable_objects.append(file_handle)
+    response['Content-Length'] = max(last - first + 1, 0)
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = last_modified
+    if filename:
+        response['Content-Disposition'] = 'attachment; filename=%s' % filename
+    return response
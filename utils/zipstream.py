@@ -0,0 +1,179 @@
+import os
+import struct
+import time
+import zlib
+
+# Sizes and offsets from this value up need the zip64 extensions.
+ZIP64_LIMIT = 0xFFFFFFFF
+# Number of entries from which the zip64 end of central directory is needed.
+ZIP64_ENTRY_LIMIT = 0xFFFF
+
+CHUNK_SIZE = 64 * 1024
+
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+DATA_DESCRIPTOR = struct.Struct('<4sLLL')
+DATA_DESCRIPTOR64 = struct.Struct('<4sLQQ')
+CENTRAL_HEADER = struct.Struct('<4s6H3L5H2L')
+END_RECORD = struct.Struct('<4s4H2LH')
+END_RECORD64 = struct.Struct('<4sQ2H2L4Q')
+END_LOCATOR64 = struct.Struct('<4sLQL')
+
+# Bit 3 means the CRC and sizes follow the data in a data descriptor, bit 11
+# means the file name is UTF-8.
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+
+def dos_datetime(timestamp):
+    """
+    Converts a timestamp to the DOS date and time used in zip headers. Zip
+    files can't represent anything before 1980.
+    """
+    t = time.localtime(max(timestamp, 315532800))
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+class ZipMember:
+    """
+    A file in a ZipStream along with everything needed to write its headers.
+    """
+
+    def __init__(self, path, name, offset):
+        stat = os.stat(path)
+        self.path = path
+        self.size = stat.st_size
+        self.dos_time, self.dos_date = dos_datetime(stat.st_mtime)
+        self.offset = offset
+        self.crc = 0
+        try:
+            self.name = name.encode('ascii')
+            self.flags = FLAG_DATA_DESCRIPTOR
+        except UnicodeEncodeError:
+            self.name = name.encode('utf-8')
+            self.flags = FLAG_DATA_DESCRIPTOR | FLAG_UTF8
+        self.zip64 = self.size >= ZIP64_LIMIT
+        self.version = 45 if self.zip64 or offset >= ZIP64_LIMIT else 20
+
+    def local_header(self):
+        """
+        The CRC and sizes are unknown until the data is written, so they are
+        left as zero (or as zip64 placeholders) and written to the data
+        descriptor instead.
+        """
+        extra = b''
+        size = 0
+        if self.zip64:
+            extra = struct.pack('<2H2Q', 1, 16, 0, 0)
+            size = 0xFFFFFFFF
+        return LOCAL_HEADER.pack(
+            b'PK\x03\x04', self.version, self.flags, 0, self.dos_time,
+            self.dos_date, 0, size, size, len(self.name),
+            len(extra)) + self.name + extra
+
+    def data_descriptor(self):
+        if self.zip64:
+            return DATA_DESCRIPTOR64.pack(
+                b'PK\x07\x08', self.crc, self.size, self.size)
+        return DATA_DESCRIPTOR.pack(
+            b'PK\x07\x08', self.crc, self.size, self.size)
+
+    def central_header(self):
+        extra_fields = []
+        size = self.size
+        offset = self.offset
+        if self.zip64:
+            extra_fields += [self.size, self.size]
+            size = 0xFFFFFFFF
+        if self.offset >= ZIP64_LIMIT:
+            extra_fields.append(self.offset)
+            offset = 0xFFFFFFFF
+        extra = b''
+        if extra_fields:
+            extra = struct.pack('<2H%dQ' % len(extra_fields), 1,
+                                8 * len(extra_fields), *extra_fields)
+        # Made by Unix (3) so the external attributes are file permissions.
+        return CENTRAL_HEADER.pack(
+            b'PK\x01\x02', (3 << 8) | self.version, self.version, self.flags,
+            0, self.dos_time, self.dos_date, self.crc, size, size,
+            len(self.name), len(extra), 0, 0, 0, 0o100644 << 16,
+            offset) + self.name + extra
+
+    def length(self):
+        """
+        Returns the number of bytes this member takes in the archive, not
+        counting its central directory entry.
+        """
+        return len(self.local_header()) + self.size + \
+            len(self.data_descriptor())
+
+
+class ZipStream:
+    """
+    A zip archive of existing files that is generated while it is iterated
+    over, so it can be streamed to a client with constant memory and no
+    temporary file. Files are stored without compression, which is what
+    photos need anyway, so the exact length of the archive is known before
+    any of it is generated. Archives of more than 4 GB use zip64.
+    Pass an iterable of (path, name in the archive) tuples.
+    """
+
+    def __init__(self, files):
+        self.members = []
+        offset = 0
+        for path, name in files:
+            member = ZipMember(path, name, offset)
+            self.members.append(member)
+            offset += member.length()
+        self.central_offset = offset
+
+    def __len__(self):
+        central_size = sum(
+            len(member.central_header()) for member in self.members)
+        return self.central_offset + central_size + \
+            len(self.end_records(central_size))
+
+    def __iter__(self):
+        for member in self.members:
+            yield member.local_header()
+            remaining = member.size
+            crc = 0
+            with open(member.path, 'rb') as file_handle:
+                while remaining > 0:
+                    chunk = file_handle.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise IOError('%s is shorter than when the archive '
+                                      'was started.' % member.path)
+                    crc = zlib.crc32(chunk, crc)
+                    remaining -= len(chunk)
+                    yield chunk
+            member.crc = crc & 0xFFFFFFFF
+            yield member.data_descriptor()
+        central_size = 0
+        for member in self.members:
+            header = member.central_header()
+            central_size += len(header)
+            yield header
+        yield self.end_records(central_size)
+
+    def end_records(self, central_size):
+        """
+        Returns the end of central directory record, preceded by the zip64
+        end of central directory record and locator when they are needed.
+        """
+        count = len(self.members)
+        offset = self.central_offset
+        records = b''
+        if count >= ZIP64_ENTRY_LIMIT or offset >= ZIP64_LIMIT or \
+                central_size >= ZIP64_LIMIT:
+            end_offset = offset + central_size
+            records = END_RECORD64.pack(
+                b'PK\x06\x06', END_RECORD64.size - 12, 45, 45, 0, 0, count,
+                count, central_size, offset)
+            records += END_LOCATOR64.pack(b'PK\x06\x07', 0, end_offset, 1)
+            count = min(count, 0xFFFF)
+            offset = min(offset, 0xFFFFFFFF)
+            central_size = min(central_size, 0xFFFFFFFF)
+        return records + END_RECORD.pack(
+            b'PK\x05\x06', 0, 0, count, count, central_size, offset, 0)